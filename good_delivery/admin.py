@@ -1,5 +1,7 @@
 from django.contrib import admin
-from django.urls import path
+from django.urls import path, reverse
+from django.utils.html import format_html
+from django.utils.translation import gettext_lazy as _
 
 from . admin_actions import *
 from . admin_inlines import *
@@ -26,7 +28,19 @@ class DeliveryCampaignAdmin(admin.ModelAdmin):
                    'require_agreement', 'is_active')
     search_fields = ('name',)
     inlines = [DeliveryCampaignAgreementInline,]
-    actions = [export_waiting_deliveries]
+    actions = [download_waiting_deliveries_csv,
+               download_waiting_deliveries_jsonl,
+               download_waiting_deliveries_xlsx,
+               export_waiting_deliveries,
+               send_waiting_deliveries_tokens,
+               mark_waiting_deliveries_as_delivered]
+
+    def get_actions(self, request):
+        actions = super().get_actions(request)
+        # XLSX needs openpyxl
+        if 'xlsx' not in get_export_formats():
+            actions.pop('download_waiting_deliveries_xlsx', None)
+        return actions
 
 
 @admin.register(DeliveryPoint)
@@ -82,7 +96,7 @@ class GoodDeliveryAdmin(admin.ModelAdmin):
     search_fields = ('delivered_to__first_name',
                      'delivered_to__last_name',
                      'delivered_to__username')
-    inlines = [GoodDeliveryItemInline,]
+    inlines = [GoodDeliveryItemInline, GoodDeliveryEventInline]
     autocomplete_fields = ('delivered_to', 'delivered_by', 'disabled_by')
 
 @admin.register(Agreement)
@@ -96,3 +110,77 @@ class DeliveryCampaignAgreementAdmin(admin.ModelAdmin):
     list_display = ('campaign', 'agreement')
     list_filter = ('campaign', 'agreement')
     search_fields = ('campaign__name', 'agreement__name')
+
+
+@admin.register(OutboundMail)
+class OutboundMailAdmin(admin.ModelAdmin):
+    list_display = ('subject', 'recipients', 'status',
+                    'attempts', 'next_attempt', 'sent_date')
+    list_filter = ('status', 'create', 'sent_date')
+    search_fields = ('subject', 'recipients')
+    readonly_fields = ('create', 'modified', 'claim_date',
+                       'sent_date', 'last_error')
+    actions = [requeue_outbound_mails]
+
+
+@admin.register(BackgroundJob)
+class BackgroundJobAdmin(admin.ModelAdmin):
+    list_display = ('kind', 'status', 'progress_display',
+                    'created_by', 'create', 'end_date', 'result_link')
+    list_filter = ('kind', 'status', 'create')
+    readonly_fields = ('kind', 'status', 'params', 'input_file',
+                       'progress_display', 'result_message', 'result_link',
+                       'created_by', 'create', 'start_date', 'end_date')
+    exclude = ('progress', 'total', 'result_file')
+    change_form_template = 'custom_admin/background_job_change_form.html'
+    actions = [requeue_background_jobs]
+
+    def has_add_permission(self, request):
+        return False
+
+    def progress_display(self, obj):
+        percentage = obj.get_progress_percentage()
+        if percentage is None: return obj.progress
+        return '{}%'.format(percentage)
+    progress_display.short_description = _('Avanzamento')
+
+    def result_link(self, obj):
+        if not obj.result_file: return '-'
+        return format_html('<a href="{}">{}</a>',
+                           reverse('good_delivery:background_job_result',
+                                   args=[obj.pk]),
+                           _('Scarica'))
+    result_link.short_description = _('Risultato')
+
+
+@admin.register(ArchivedCampaign)
+class ArchivedCampaignAdmin(admin.ModelAdmin):
+    list_display = ('name', 'date_start', 'date_end', 'deliveries',
+                    'items', 'events', 'archived_by', 'create')
+    list_filter = ('date_end', 'create')
+    search_fields = ('name', 'slug')
+    readonly_fields = ('campaign_pk', 'name', 'slug', 'date_start',
+                       'date_end', 'bundle', 'deliveries', 'items',
+                       'events', 'archived_by', 'create', 'modified')
+    actions = [restore_archived_campaigns]
+
+    def has_add_permission(self, request):
+        return False
+
+
+@admin.register(ArchivedGoodDelivery)
+class ArchivedGoodDeliveryAdmin(admin.ModelAdmin):
+    # audits: who received what in archived campaigns
+    list_display = ('archive', 'delivered_to', 'delivery_date',
+                    'disabled_date', 'identifiers')
+    list_filter = ('archive',)
+    search_fields = ('delivered_to__first_name',
+                     'delivered_to__last_name',
+                     'delivered_to__username')
+    list_select_related = ('archive', 'delivered_to')
+    raw_id_fields = ('delivered_to',)
+    readonly_fields = ('archive', 'good_delivery_pk', 'delivered_to',
+                       'delivery_date', 'disabled_date', 'identifiers')
+
+    def has_add_permission(self, request):
+        return False
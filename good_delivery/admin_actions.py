@@ -1,22 +1,118 @@
-import os
-
-from django.http import HttpResponse
+from django.contrib import messages
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.html import format_html
+from django.utils.translation import gettext as _
 
+from . archive import CampaignRestoreError, restore_campaign
+from . exporters import get_export_formats, waiting_deliveries_response
+from . jobs import requeue_jobs
 from . models import *
-from . utils import export_waiting_deliveries_on_file
-
 
-def _export_waiting_deliveries(modeladmin,
-                               request,
-                               queryset):
-    response = HttpResponse(content_type='text/csv')
-    response['Content-Disposition'] = 'attachment; filename="{}.csv"'.format(queryset.first().name)
-    return export_waiting_deliveries_on_file(queryset=queryset, fopen=response)
 
 def export_waiting_deliveries(modeladmin, request, queryset):
     """
     """
-    return _export_waiting_deliveries(modeladmin=modeladmin,
-                                      request=request,
-                                      queryset=queryset)
-export_waiting_deliveries.short_description = "Download consegne pendenti"
+    # the export runs in background (run_background_jobs)
+    job = BackgroundJob.enqueue(kind=BackgroundJob.EXPORT_WAITING_DELIVERIES,
+                                user=request.user,
+                                params={'campaigns': list(queryset.values_list('pk', flat=True))})
+    url = reverse('admin:good_delivery_backgroundjob_change', args=[job.pk])
+    modeladmin.message_user(request,
+                            format_html(_('Esportazione in coda: <a href="{}">stato</a>'), url),
+                            messages.SUCCESS)
+export_waiting_deliveries.short_description = "Esporta consegne pendenti in background"
+
+
+def _download_waiting_deliveries(export_format):
+    def download_waiting_deliveries(modeladmin, request, queryset):
+        """
+        """
+        # all selected campaigns, streamed while rows are read
+        return waiting_deliveries_response(campaigns=queryset,
+                                           export_format=export_format)
+    download_waiting_deliveries.__name__ = 'download_waiting_deliveries_{}'.format(export_format)
+    download_waiting_deliveries.short_description = "Download consegne pendenti ({})".format(export_format.upper())
+    return download_waiting_deliveries
+
+download_waiting_deliveries_csv = _download_waiting_deliveries('csv')
+download_waiting_deliveries_jsonl = _download_waiting_deliveries('jsonl')
+download_waiting_deliveries_xlsx = _download_waiting_deliveries('xlsx')
+
+
+def send_waiting_deliveries_tokens(modeladmin, request, queryset):
+    """
+    """
+    # emails are sent in background (run_background_jobs)
+    uri = request.build_absolute_uri(reverse('good_delivery:user_use_token'))
+    job = BackgroundJob.enqueue(kind=BackgroundJob.SEND_DELIVERY_TOKENS,
+                                user=request.user,
+                                params={'campaigns': list(queryset.values_list('pk', flat=True)),
+                                        'uri': uri})
+    url = reverse('admin:good_delivery_backgroundjob_change', args=[job.pk])
+    modeladmin.message_user(request,
+                            format_html(_('Invio token in coda: <a href="{}">stato</a>'), url),
+                            messages.SUCCESS)
+send_waiting_deliveries_tokens.short_description = "Invia token di attivazione consegne in attesa"
+
+
+def mark_waiting_deliveries_as_delivered(modeladmin, request, queryset):
+    """
+    """
+    for campaign in queryset:
+        if campaign.require_agreement:
+            modeladmin.message_user(request,
+                                    _("{}: agreement richiesto. Impossibile consegnare").format(campaign),
+                                    messages.ERROR)
+            continue
+        msg = _("Consegna massiva (senza conferma da parte dell'utente)")
+        delivered = GoodDelivery.bulk_mark_as_delivered(deliveries=GoodDelivery.objects.filter(campaign=campaign),
+                                                        operator=request.user,
+                                                        msg=msg)
+        modeladmin.message_user(request,
+                                _("{}: {} consegne effettuate").format(campaign, delivered),
+                                messages.SUCCESS)
+mark_waiting_deliveries_as_delivered.short_description = "Segna come consegnate le consegne in attesa"
+
+
+def requeue_outbound_mails(modeladmin, request, queryset):
+    """
+    """
+    # emails being sent by a worker are left to it
+    count = queryset.exclude(status__in=[OutboundMail.SENT,
+                                         OutboundMail.SENDING])\
+                    .update(status=OutboundMail.QUEUED,
+                            attempts=0,
+                            next_attempt=timezone.now())
+    modeladmin.message_user(request,
+                            _("{} email rimesse in coda").format(count),
+                            messages.SUCCESS)
+requeue_outbound_mails.short_description = "Rimetti in coda"
+
+
+def requeue_background_jobs(modeladmin, request, queryset):
+    """
+    failed jobs and running ones of dead workers
+    """
+    count = requeue_jobs(queryset)
+    modeladmin.message_user(request,
+                            _("{} attività rimesse in coda").format(count),
+                            messages.SUCCESS)
+requeue_background_jobs.short_description = "Rimetti in coda"
+
+
+def restore_archived_campaigns(modeladmin, request, queryset):
+    """
+    archives whose users and goods are missing are not
+    restored (error message), the others are
+    """
+    for archived in queryset:
+        try:
+            campaign = restore_campaign(archived)
+        except CampaignRestoreError as e:
+            modeladmin.message_user(request, str(e), messages.ERROR)
+            continue
+        modeladmin.message_user(request,
+                                _("{}: campagna ripristinata").format(campaign),
+                                messages.SUCCESS)
+restore_archived_campaigns.short_description = "Ripristina le campagne archiviate"
@@ -1,5 +1,6 @@
 from django import forms
 from django.contrib import admin
+from django.utils.translation import gettext_lazy as _
 
 from .models import *
 
@@ -34,3 +35,25 @@ class GoodDeliveryItemInline(admin.TabularInline):
     model = GoodDeliveryItem
     autocomplete_fields = ('good_stock_identifier',)
     extra = 0
+
+
+class GoodDeliveryEventInline(admin.TabularInline):
+    # append-only history
+    model = GoodDeliveryEvent
+    fields = ('create', 'code', 'message', 'user')
+    readonly_fields = fields
+    extra = 0
+    can_delete = False
+
+    def has_add_permission(self, request, obj=None):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).select_related('user')
+
+    def message(self, obj):
+        return obj.get_message()
+    message.short_description = _('Messaggio')
@@ -1,9 +1,16 @@
 from django.apps import AppConfig
+from django.conf import settings
 
 
 class GoodDeliveryConfig(AppConfig):
     name = 'good_delivery'
 
-    # def ready(self):
+    def ready(self):
         # Signals
-        # import good_delivery.signals
+        import good_delivery.signals
+
+        # reload JWE keys on signal (e.g. signal.SIGUSR1)
+        reload_signal = getattr(settings, 'JWE_KEYS_RELOAD_SIGNAL', None)
+        if reload_signal:
+            from good_delivery.jwts import install_jwe_keys_reload_signal
+            install_jwe_keys_reload_signal(reload_signal)
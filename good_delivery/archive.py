@@ -0,0 +1,248 @@
+import gzip
+import io
+import json
+import logging
+import tempfile
+
+from django.apps import apps
+from django.conf import settings
+from django.core import serializers
+from django.core.files import File
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import IntegrityError, connections, router, transaction
+from django.utils import timezone
+from django.utils.translation import gettext as _
+
+from . models import (ArchivedCampaign,
+                      ArchivedGoodDelivery,
+                      DeliveryCampaign,
+                      DeliveryCampaignAgreement,
+                      DeliveryPoint,
+                      DeliveryPointGoodStock,
+                      DeliveryPointGoodStockCounter,
+                      DeliveryPointGoodStockIdentifier,
+                      GoodDelivery,
+                      GoodDeliveryAttachment,
+                      GoodDeliveryEvent,
+                      GoodDeliveryItem,
+                      OperatorDeliveryPoint)
+from . permissions import invalidate_grants
+from . settings import ARCHIVE_CHUNK_SIZE
+
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_FORMAT_VERSION = 1
+
+
+class CampaignNotArchivable(Exception):
+    pass
+
+
+class CampaignRestoreError(Exception):
+    pass
+
+
+def _campaign_querysets(campaign):
+    """
+    campaign rows, parents before children
+    (restore inserts them in this order)
+    """
+    return ((DeliveryCampaign, DeliveryCampaign.objects.filter(pk=campaign.pk)),
+            (DeliveryCampaignAgreement, DeliveryCampaignAgreement.objects.filter(campaign=campaign)),
+            (DeliveryPoint, DeliveryPoint.objects.filter(campaign=campaign)),
+            (OperatorDeliveryPoint, OperatorDeliveryPoint.objects.filter(delivery_point__campaign=campaign)),
+            (DeliveryPointGoodStock, DeliveryPointGoodStock.objects.filter(delivery_point__campaign=campaign)),
+            (DeliveryPointGoodStockCounter,
+             DeliveryPointGoodStockCounter.objects.filter(stock__delivery_point__campaign=campaign)),
+            (DeliveryPointGoodStockIdentifier,
+             DeliveryPointGoodStockIdentifier.objects.filter(delivery_point_stock__delivery_point__campaign=campaign)),
+            (GoodDelivery, GoodDelivery.objects.filter(campaign=campaign)),
+            (GoodDeliveryItem, GoodDeliveryItem.objects.filter(good_delivery__campaign=campaign)),
+            (GoodDeliveryAttachment, GoodDeliveryAttachment.objects.filter(good_delivery__campaign=campaign)),
+            (GoodDeliveryEvent, GoodDeliveryEvent.objects.filter(good_delivery__campaign=campaign)))
+
+
+def _chunks(iterable, chunk_size):
+    chunk = []
+    for obj in iterable:
+        chunk.append(obj)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk: yield chunk
+
+
+def _raw_delete(queryset):
+    # no per-row signals: counters, statistics and
+    # search documents go away with the campaign
+    queryset._raw_delete(using=router.db_for_write(queryset.model))
+
+
+def _archive_deliveries(archive, deliveries):
+    """
+    audit rows of a chunk of deliveries, with the
+    identifiers codes of their items (one query)
+    """
+    identifiers = {}
+    for good_delivery, code in GoodDeliveryItem.objects\
+                                    .filter(good_delivery__in=deliveries,
+                                            good_identifier__isnull=False)\
+                                    .order_by('pk')\
+                                    .values_list('good_delivery', 'good_identifier'):
+        identifiers.setdefault(good_delivery, []).append(code)
+    ArchivedGoodDelivery.objects.bulk_create(
+        [ArchivedGoodDelivery(archive=archive,
+                              good_delivery_pk=good_delivery.pk,
+                              delivered_to_id=good_delivery.delivered_to_id,
+                              delivery_date=good_delivery.delivery_date,
+                              disabled_date=good_delivery.disabled_date,
+                              identifiers=identifiers.get(good_delivery.pk, []))
+         for good_delivery in deliveries])
+
+
+def archive_campaign(campaign, user=None, chunk_size=None):
+    """
+    Moves a finished (not active, ended) campaign out of live tables.
+    Campaign, delivery points, stocks, identifiers, deliveries,
+    items, attachments and events are written in a gzipped JSON Lines
+    bundle (one serialized row for each line, read chunk_size at a time)
+    and deleted. Deliveries are kept in ArchivedGoodDelivery
+    (recipient, dates and identifiers codes) for audits,
+    written for each chunk of deliveries read.
+
+    :type campaign: DeliveryCampaign
+    :type user: User
+    :type chunk_size: Int
+
+    :param campaign: campaign to archive
+    :param user: archiving user
+    :param chunk_size: rows read from database each time
+
+    :return: ArchivedCampaign
+    """
+    if campaign.is_active or not campaign.is_end():
+        raise CampaignNotArchivable(_("{}: solo le campagne terminate e "
+                                      "non attive possono essere archiviate").format(campaign))
+    chunk_size = chunk_size or getattr(settings, 'ARCHIVE_CHUNK_SIZE', ARCHIVE_CHUNK_SIZE)
+    querysets = _campaign_querysets(campaign)
+    counts = {}
+
+    with transaction.atomic(), tempfile.TemporaryFile() as bundle_file:
+        # rows are read and deleted in the same transaction
+        DeliveryCampaign.objects.select_for_update().filter(pk=campaign.pk).first()
+        archive = ArchivedCampaign.objects.create(campaign_pk=campaign.pk,
+                                                  name=campaign.name,
+                                                  slug=campaign.slug,
+                                                  date_start=campaign.date_start,
+                                                  date_end=campaign.date_end,
+                                                  archived_by=user)
+        with gzip.GzipFile(fileobj=bundle_file, mode='wb') as bundle:
+            header = {'version': ARCHIVE_FORMAT_VERSION,
+                      'campaign': campaign.slug,
+                      'created': timezone.now()}
+            bundle.write((json.dumps(header, cls=DjangoJSONEncoder) + '\n').encode())
+            for model, queryset in querysets:
+                counts[model] = 0
+                rows = queryset.order_by('pk').iterator(chunk_size=chunk_size)
+                for chunk in _chunks(rows, chunk_size):
+                    for record in serializers.serialize('python', chunk):
+                        bundle.write((json.dumps(record, cls=DjangoJSONEncoder) + '\n').encode())
+                    if model is GoodDelivery:
+                        _archive_deliveries(archive, chunk)
+                    counts[model] += len(chunk)
+
+        archive.deliveries = counts[GoodDelivery]
+        archive.items = counts[GoodDeliveryItem]
+        archive.events = counts[GoodDeliveryEvent]
+        bundle_file.seek(0)
+        archive.bundle.save('{}.jsonl.gz'.format(campaign.slug),
+                            File(bundle_file), save=False)
+        try:
+            archive.save()
+            delivery_points = list(DeliveryPoint.objects.filter(campaign=campaign)\
+                                                        .values_list('pk', flat=True))
+            # children first, campaign (with delivery points
+            # and operators) at last. Agreements protect
+            # the campaign: they are deleted before it
+            for model, queryset in reversed(querysets[4:]):
+                _raw_delete(queryset)
+            _raw_delete(querysets[1][1])
+            campaign.delete()
+        except Exception:
+            archive.bundle.delete(save=False)
+            raise
+
+    DeliveryPoint.invalidate_statistics(*delivery_points)
+    invalidate_grants()
+    logger.info('Campaign {} archived: {} deliveries, {} items, {} events'\
+                .format(campaign.slug, archive.deliveries, archive.items, archive.events))
+    return archive
+
+
+def _restore_chunk(model, records):
+    objects = [obj.object for obj in serializers.deserialize('python', records)]
+    # bulk_create doesn't send signals: counters
+    # are restored as they were archived
+    model.objects.bulk_create(objects)
+
+
+def restore_campaign(archived, chunk_size=None):
+    """
+    Inserts back in live tables the rows of an archived
+    campaign bundle and deletes the archive.
+    Users (recipients, operators) and goods must still exist,
+    otherwise nothing is restored (CampaignRestoreError).
+
+    :type archived: ArchivedCampaign
+    :type chunk_size: Int
+
+    :param archived: archive to restore
+    :param chunk_size: rows inserted with each query
+
+    :return: DeliveryCampaign
+    """
+    chunk_size = chunk_size or getattr(settings, 'ARCHIVE_CHUNK_SIZE', ARCHIVE_CHUNK_SIZE)
+    if DeliveryCampaign.objects.filter(slug=archived.slug).exists():
+        raise CampaignRestoreError(_("{}: esiste già una campagna "
+                                     "con questo slug").format(archived.slug))
+    delivery_points = []
+    restored = set()
+    with transaction.atomic():
+        with archived.bundle.open('rb') as bundle_file, \
+             gzip.GzipFile(fileobj=bundle_file) as bundle:
+            lines = io.TextIOWrapper(bundle, encoding='utf-8')
+            header = json.loads(next(lines))
+            if header.get('version') != ARCHIVE_FORMAT_VERSION:
+                raise CampaignRestoreError(_("{}: versione del bundle "
+                                             "non supportata").format(archived.slug))
+            model, records = None, []
+            try:
+                for line in lines:
+                    record = json.loads(line)
+                    if records and (record['model'] != records[0]['model'] or \
+                                    len(records) == chunk_size):
+                        _restore_chunk(model, records)
+                        records = []
+                    if not records:
+                        model = apps.get_model(record['model'])
+                    if model is DeliveryPoint:
+                        delivery_points.append(record['pk'])
+                    records.append(record)
+                    restored.add(model)
+                if records: _restore_chunk(model, records)
+                # foreign keys are deferred until commit: rows referencing
+                # users or goods deleted after the archival are found here
+                connections[router.db_for_write(DeliveryCampaign)]\
+                    .check_constraints(table_names=[m._meta.db_table for m in restored])
+            except IntegrityError as e:
+                raise CampaignRestoreError(_("{}: impossibile ripristinare "
+                                             "la campagna ({})").format(archived.slug, e))
+        campaign = DeliveryCampaign.objects.get(pk=archived.campaign_pk)
+        archived.delete()
+
+    archived.bundle.delete(save=False)
+    DeliveryPoint.invalidate_statistics(*delivery_points)
+    invalidate_grants()
+    logger.info('Campaign {} restored'.format(campaign.slug))
+    return campaign
@@ -1,9 +1,12 @@
+from asgiref.sync import sync_to_async
 from django.conf import settings
 from django.contrib import messages
+from django.contrib.auth.views import redirect_to_login
 from django.shortcuts import get_object_or_404, redirect, render
 from django.utils.translation import gettext as _
 
 from .models import *
+from .permissions import get_operator_grants
 from .utils import custom_message
 
 
@@ -13,8 +16,11 @@ def campaign_is_active(func_to_decorate):
     def new_func(*original_args, **original_kwargs):
         request = original_args[0]
         campaign_id = original_kwargs['campaign_id']
-        campaign = DeliveryCampaign.objects.filter(slug=campaign_id,
-                                                   is_active=True).first()
+        # operators campaigns are already in their grants
+        campaign = get_operator_grants(request).get_campaign(campaign_id)
+        if not campaign:
+            campaign = DeliveryCampaign.objects.filter(slug=campaign_id,
+                                                       is_active=True).first()
         if campaign:
             original_kwargs['campaign'] = campaign
             return func_to_decorate(*original_args, **original_kwargs)
@@ -67,21 +73,7 @@ def is_operator(func_to_decorate):
     """
     def new_func(*original_args, **original_kwargs):
         request = original_args[0]
-        user = request.user
-
-        delivery_points = []
-        if user.is_superuser:
-            delivery_points = DeliveryPoint.objects.filter(is_active=True,
-                                                           campaign__is_active=True)
-        else:
-            my_delivery_points = OperatorDeliveryPoint.objects.filter(operator=user,
-                                                                      is_active=True,
-                                                                      delivery_point__is_active=True,
-                                                                      delivery_point__campaign__is_active=True)\
-                                                              .select_related('delivery_point')
-
-            for dp in my_delivery_points:
-                delivery_points.append(dp.delivery_point)
+        delivery_points = get_operator_grants(request).get_active_delivery_points()
         if delivery_points:
             original_kwargs['my_delivery_points'] = delivery_points
             return func_to_decorate(*original_args, **original_kwargs)
@@ -97,24 +89,11 @@ def is_campaign_operator(func_to_decorate):
     def new_func(*original_args, **original_kwargs):
         request = original_args[0]
         campaign = original_kwargs['campaign']
-        user = request.user
-
-        if user.is_superuser:
-            delivery_points = DeliveryPoint.objects.filter(campaign=campaign,
-                                                           is_active=True)
+        grants = get_operator_grants(request)
+        delivery_points = grants.get_campaign_delivery_points(campaign)
+        if delivery_points or grants.is_superuser:
             original_kwargs['delivery_points'] = delivery_points
             return func_to_decorate(*original_args, **original_kwargs)
-
-        operator_delivery_points = OperatorDeliveryPoint.objects.filter(operator=user,
-                                                                        is_active=True,
-                                                                        delivery_point__is_active=True,
-                                                                        delivery_point__campaign=campaign)
-        if operator_delivery_points:
-            delivery_points = set()
-            for odp in operator_delivery_points:
-                delivery_points.add(odp.delivery_point)
-            original_kwargs['delivery_points'] = tuple(delivery_points)
-            return func_to_decorate(*original_args, **original_kwargs)
         return custom_message(request,
                               _("Non sei un operatore abilitato per questa campagna"))
     return new_func
@@ -125,27 +104,22 @@ def is_delivery_point_operator(func_to_decorate):
     """
     def new_func(*original_args, **original_kwargs):
         request = original_args[0]
-        user = request.user
         campaign = original_kwargs['campaign']
         delivery_point_id = original_kwargs['delivery_point_id']
 
-        delivery_point = get_object_or_404(DeliveryPoint,
-                                           campaign=campaign,
-                                           pk=delivery_point_id,
-                                           is_active=True)
-
-        if user.is_superuser:
+        grants = get_operator_grants(request)
+        delivery_point, multi_tenant = grants.get_delivery_point(campaign,
+                                                                 int(delivery_point_id))
+        if delivery_point:
             original_kwargs['delivery_point'] = delivery_point
-            original_kwargs['multi_tenant'] = True
+            original_kwargs['multi_tenant'] = multi_tenant
             return func_to_decorate(*original_args, **original_kwargs)
 
-        operator = OperatorDeliveryPoint.objects.filter(operator=user,
-                                                        delivery_point=delivery_point,
-                                                        is_active=True).first()
-        if operator:
-            original_kwargs['delivery_point'] = delivery_point
-            original_kwargs['multi_tenant'] = operator.multi_tenant
-            return func_to_decorate(*original_args, **original_kwargs)
+        # not granted: 404 if the delivery point doesn't exist
+        get_object_or_404(DeliveryPoint,
+                          campaign=campaign,
+                          pk=delivery_point_id,
+                          is_active=True)
         return custom_message(request,
                               _("Non sei un operatore abilitato "
                                 "per questo punto di consegna"))
@@ -163,11 +137,11 @@ def can_manage_good_delivery(func_to_decorate):
         delivery_point = original_kwargs['delivery_point']
 
         if multi_tenant:
-            good_delivery = get_object_or_404(GoodDelivery,
+            good_delivery = get_object_or_404(GoodDelivery.objects.with_state(),
                                               choosen_delivery_point__campaign=campaign,
                                               pk=good_delivery_id)
         else:
-            good_delivery = get_object_or_404(GoodDelivery,
+            good_delivery = get_object_or_404(GoodDelivery.objects.with_state(),
                                               Q(choosen_delivery_point=delivery_point) |
                                               Q(delivery_point=delivery_point),
                                               pk=good_delivery_id)
@@ -175,3 +149,16 @@ def can_manage_good_delivery(func_to_decorate):
         original_kwargs['good_delivery'] = good_delivery
         return func_to_decorate(*original_args, **original_kwargs)
     return new_func
+
+
+def async_login_required(func_to_decorate):
+    """
+    login_required for async views
+    (session user is loaded in the ORM thread)
+    """
+    async def new_func(request, *args, **kwargs):
+        is_authenticated = await sync_to_async(lambda: request.user.is_authenticated)()
+        if is_authenticated:
+            return await func_to_decorate(request, *args, **kwargs)
+        return redirect_to_login(request.get_full_path())
+    return new_func
@@ -0,0 +1,162 @@
+import csv
+import io
+import json
+import tempfile
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db.models import CharField, Value
+from django.http import StreamingHttpResponse
+from django.utils.text import slugify
+
+from . models import GoodDelivery
+from . settings import EXPORT_CHUNK_SIZE
+
+try:
+    # optional, XLSX exports (pip install django-good-delivery[xlsx])
+    import openpyxl
+except ImportError: # pragma: no cover
+    openpyxl = None
+
+
+WAITING_DELIVERIES_HEAD = ['CF', 'Cognome', 'Nome',
+                           'Via', 'Num', 'Città', 'CAP', 'Prov', 'Tel',
+                           'Campagna']
+
+EXPORT_FORMATS = {'csv': ('text/csv', 'csv'),
+                  'jsonl': ('application/x-ndjson', 'jsonl'),
+                  'xlsx': ('application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+                           'xlsx')}
+
+
+class ExportFormatNotAvailable(Exception):
+    pass
+
+
+def get_export_formats():
+    """
+    export formats available with installed libraries
+    """
+    return [export_format for export_format in EXPORT_FORMATS
+            if export_format != 'xlsx' or openpyxl]
+
+
+def get_waiting_deliveries_rows(campaigns, chunk_size=None):
+    """
+    Waiting deliveries (no delivery point assigned) of campaigns
+    as tuples of WAITING_DELIVERIES_HEAD values.
+    Users and campaigns are joined in the same query and
+    rows are fetched chunk_size at a time
+    (one query and bounded memory, whatever the deliveries number).
+
+    :type campaigns: QuerySet of DeliveryCampaign (or list)
+    :type chunk_size: Int
+
+    :param campaigns: campaigns to export
+    :param chunk_size: rows fetched from database cursor each time
+
+    :return: rows iterator
+    """
+    chunk_size = chunk_size or getattr(settings, 'EXPORT_CHUNK_SIZE', EXPORT_CHUNK_SIZE)
+    # taxpayer_id only exists on custom user models
+    user_fields = {field.name for field in get_user_model()._meta.get_fields()}
+    taxpayer_id = 'delivered_to__taxpayer_id' if 'taxpayer_id' in user_fields \
+                  else Value('', output_field=CharField())
+    deliveries = GoodDelivery.objects.filter(campaign__in=campaigns,
+                                             delivery_point__isnull=True)\
+                                     .order_by('campaign', 'pk')
+    return deliveries.values_list(taxpayer_id,
+                                  'delivered_to__last_name',
+                                  'delivered_to__first_name',
+                                  'address_road',
+                                  'address_number',
+                                  'address_city',
+                                  'address_zip_code',
+                                  'address_state',
+                                  'phone',
+                                  'campaign__name')\
+                     .iterator(chunk_size=chunk_size)
+
+
+def csv_chunks(rows, chunk_size, delimiter=';', quotechar='"'):
+    """
+    waiting deliveries rows as CSV text, chunk_size rows at a time
+    (header in the first chunk)
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, delimiter=delimiter, quotechar=quotechar)
+    writer.writerow(WAITING_DELIVERIES_HEAD)
+    for count, row in enumerate(rows, start=1):
+        writer.writerow(row)
+        if count % chunk_size == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def _jsonl_chunks(rows, chunk_size):
+    lines = []
+    for row in rows:
+        lines.append(json.dumps(dict(zip(WAITING_DELIVERIES_HEAD, row))))
+        if len(lines) == chunk_size:
+            yield '\n'.join(lines) + '\n'
+            lines = []
+    if lines: yield '\n'.join(lines) + '\n'
+
+
+def _xlsx_chunks(rows, chunk_size):
+    # write-only workbooks keep rows on disk, not in memory
+    workbook = openpyxl.Workbook(write_only=True)
+    sheet = workbook.create_sheet()
+    sheet.append(WAITING_DELIVERIES_HEAD)
+    for row in rows:
+        sheet.append(row)
+    with tempfile.TemporaryFile() as xlsx_file:
+        workbook.save(xlsx_file)
+        xlsx_file.seek(0)
+        for chunk in iter(lambda: xlsx_file.read(64 * 1024), b''):
+            yield chunk
+
+
+def stream_waiting_deliveries(campaigns, export_format='csv', chunk_size=None):
+    """
+    campaigns waiting deliveries export, as an iterator of bytes chunks
+
+    :type campaigns: QuerySet of DeliveryCampaign (or list)
+    :type export_format: String (csv, jsonl, xlsx)
+    :type chunk_size: Int
+
+    :param campaigns: campaigns to export
+    :param export_format: export file format
+    :param chunk_size: rows for each chunk
+
+    :return: bytes iterator
+    """
+    if export_format not in get_export_formats():
+        raise ExportFormatNotAvailable(export_format)
+    chunk_size = chunk_size or getattr(settings, 'EXPORT_CHUNK_SIZE', EXPORT_CHUNK_SIZE)
+    rows = get_waiting_deliveries_rows(campaigns, chunk_size=chunk_size)
+    if export_format == 'xlsx':
+        return _xlsx_chunks(rows, chunk_size)
+    chunks = csv_chunks if export_format == 'csv' else _jsonl_chunks
+    return (chunk.encode(settings.DEFAULT_CHARSET)
+            for chunk in chunks(rows, chunk_size))
+
+
+def get_export_filename(campaigns, export_format='csv'):
+    name = '_'.join(slugify(campaign.name) for campaign in campaigns)
+    return '{}.{}'.format(name or 'export', EXPORT_FORMATS[export_format][1])
+
+
+def waiting_deliveries_response(campaigns, export_format='csv'):
+    """
+    campaigns waiting deliveries export, streamed as attachment
+    """
+    campaigns = list(campaigns)
+    chunks = stream_waiting_deliveries(campaigns, export_format=export_format)
+    response = StreamingHttpResponse(chunks,
+                                     content_type=EXPORT_FORMATS[export_format][0])
+    response['Content-Disposition'] = 'attachment; filename="{}"'.format(get_export_filename(campaigns,
+                                                                                             export_format))
+    return response
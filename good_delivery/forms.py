@@ -9,6 +9,7 @@ from bootstrap_italia_template.widgets import (BootstrapItaliaSelectWidget,
                                                BootstrapItaliaSelectMultipleWidget)
 
 from . models import *
+from . search import get_user_label
 
 
 IDENTITY_DOCUMENT_TYPES = (
@@ -46,15 +47,40 @@ class GoodDeliveryDisableForm(forms.Form):
         js = ('js/textarea-autosize.js',)
 
 
+class UserChoiceField(forms.ModelChoiceField):
+    def label_from_instance(self, obj):
+        return get_user_label(obj)
+
+
 class GoodDeliveryPreloadForm(forms.Form):
-    user = forms.ModelChoiceField(label=_('Destinatario'),
-                                  queryset=None, required=True,
-                                  widget=BootstrapItaliaSelectWidget)
+    user = UserChoiceField(label=_('Destinatario'),
+                           queryset=None, required=True)
 
     def __init__(self, *args, **kwargs):
-        users = get_user_model().objects.filter(is_active=True)
+        # users autocomplete URL (operator_users JSON endpoint)
+        remote_url = kwargs.pop('remote_url', None)
         super().__init__(*args, **kwargs)
-        self.fields['user'].queryset = users
+        # the submitted pk is validated with one lookup,
+        # options are only the selected user (searched by operator)
+        field = self.fields['user']
+        field.queryset = get_user_model().objects.filter(is_active=True)
+        field.widget = forms.Select(attrs={'data-remote-url': remote_url,
+                                           'data-placeholder': _('Cerca per username, '
+                                                                 'codice fiscale o nome...')})
+        field.choices = self._get_user_choices
+
+    def _get_user_choices(self):
+        # evaluated on rendering only
+        field = self.fields['user']
+        user = getattr(self, 'cleaned_data', {}).get('user')
+        selected = self.data.get(self.add_prefix('user'))
+        if not user and selected and str(selected).isdigit():
+            user = field.queryset.filter(pk=selected).first()
+        return [('', field.empty_label)] + \
+               ([(user.pk, field.label_from_instance(user))] if user else [])
+
+    class Media:
+        js = ('js/remote-select.js',)
 
 
 class GoodDeliveryQuantityForm(forms.Form):
@@ -91,6 +117,25 @@ class GoodDeliveryQuantityForm(forms.Form):
         js = ('js/textarea-autosize.js',)
 
 
+class PrefetchedModelChoiceField(forms.ModelChoiceField):
+    """
+    ModelChoiceField that validates the value against
+    already loaded objects (no query for each form),
+    if any, instead of its queryset
+    """
+    prefetched = None
+
+    def to_python(self, value):
+        if self.prefetched is None or value in self.empty_values:
+            return super().to_python(value)
+        obj = self.prefetched.get(str(value))
+        if obj is None:
+            raise ValidationError(self.error_messages['invalid_choice'],
+                                  code='invalid_choice',
+                                  params={'value': value})
+        return obj
+
+
 class GoodDeliveryItemForm(forms.ModelForm):
     class Meta:
         model = GoodDeliveryItem
@@ -101,38 +146,61 @@ class GoodDeliveryItemForm(forms.ModelForm):
         help_texts = {'good_identifier': _('Digita manualmente il codice '
                                            'scelto dall\'elenco')}
         widgets = {'good_stock_identifier': BootstrapItaliaSelectWidget}
+        field_classes = {'good_stock_identifier': PrefetchedModelChoiceField}
 
     def __init__(self, *args, **kwargs):
         stock = kwargs.pop('stock', None)
+        # stock.get_free_identifiers() list,
+        # shared by all the forms of the same stock
+        free_identifiers = kwargs.pop('free_identifiers', None)
+        # identifiers autocomplete URL (remote lookup widget mode)
+        remote_url = kwargs.pop('remote_url', None)
+        # {str(pk): identifier} the submitted value can be
+        # (free identifiers of stock), loaded once for all the forms
+        identifiers = kwargs.pop('identifiers', None)
+        # (good, code) pairs assigned to other items of the campaign,
+        # loaded once for all the forms
+        assigned_codes = kwargs.pop('assigned_codes', None)
         super().__init__(*args, **kwargs)
         self.fields['good_identifier'].required = True
         self.fields['good_stock_identifier'].required = True
         self.stock = stock
+        self.assigned_codes = assigned_codes
 
-        # retrieve stock data
-        good = stock.good
-        delivery_point = stock.delivery_point
-        campaign = delivery_point.campaign
-
-        # all stock identifiers
-        identifiers = DeliveryPointGoodStockIdentifier.objects.filter(delivery_point_stock=stock)
-        # good_deliveries made in this campaign
-        existent_deliveries = GoodDeliveryItem.objects.filter(good_delivery__campaign=campaign,
-                                                              good=good)
-        # used stock good identifiers list
-        excluded_stock_ids = []
-        for ed in existent_deliveries:
-            if ed.good_stock_identifier:
-                excluded_stock_ids.append(ed.good_stock_identifier.good_identifier)
         # if operator is editing an existent delivery
-        # its stock identifier must be included (and not be present in exclusion list)
-        if self.instance.pk and self.instance.good_stock_identifier:
-            good_identifier = self.instance.good_stock_identifier.good_identifier
-            if good_identifier in excluded_stock_ids:
-                excluded_stock_ids.remove(self.instance.good_stock_identifier.good_identifier)
-        # exclude list from queryset
-        identifiers = identifiers.exclude(good_identifier__in=excluded_stock_ids)
-        self.fields['good_stock_identifier'].queryset = identifiers
+        # its stock identifier must be included
+        current = self.instance.good_stock_identifier_id if self.instance.pk else None
+        field = self.fields['good_stock_identifier']
+        field.queryset = stock.get_free_identifiers(include=current)
+        if identifiers is not None:
+            field.prefetched = identifiers
+            if current:
+                field.prefetched = dict(identifiers)
+                field.prefetched[str(current)] = self.instance.good_stock_identifier
+        if remote_url:
+            # big stocks: identifiers are searched by
+            # operator_stock_identifiers JSON endpoint,
+            # options are only the current (or submitted) one
+            field.widget = forms.Select(attrs={'data-remote-url': remote_url,
+                                               'data-placeholder': _('Cerca...')})
+            selected = self.data.get(self.add_prefix('good_stock_identifier')) or current
+            identifiers = []
+            if field.prefetched is not None:
+                selected = field.prefetched.get(str(selected))
+                if selected: identifiers = [selected]
+            elif current and str(selected) == str(current):
+                identifiers = [self.instance.good_stock_identifier]
+            elif selected and str(selected).isdigit():
+                identifiers = DeliveryPointGoodStockIdentifier.objects.filter(pk=selected,
+                                                                              delivery_point_stock=stock)
+            field.choices = [('', field.empty_label)] + \
+                            [(i.pk, field.label_from_instance(i)) for i in identifiers]
+        elif free_identifiers is not None:
+            identifiers = list(free_identifiers)
+            if current and current not in [i.pk for i in identifiers]:
+                identifiers.append(self.instance.good_stock_identifier)
+            field.choices = [('', field.empty_label)] + \
+                            [(i.pk, field.label_from_instance(i)) for i in identifiers]
 
     def clean(self):
         cleaned_data = super().clean()
@@ -142,14 +210,25 @@ class GoodDeliveryItemForm(forms.ModelForm):
 
         if good_stock_identifier and good_stock_identifier.good_identifier != good_identifier:
             self.add_error('good_identifier', _("Identificatori non coincidenti"))
-        existent_delivery = GoodDeliveryItem.objects.filter(Q(good_identifier=good_identifier) &
-                                                            Q(good_identifier__isnull=False),
-                                                            good=self.instance.good,
-                                                            good_delivery__campaign=self.instance.good_delivery.campaign)
-        if existent_delivery and good_identifier!=self.instance.good_identifier:
+        # codes used in the campaign are not among the free identifiers
+        # (field queryset), concurrent assignments are rejected by
+        # gdi_assigned_identifier_uniq constraint (IntegrityError on save)
+        if self.assigned_codes is None: return cleaned_data
+        if good_identifier == self.instance.good_identifier: return cleaned_data
+        if (self.instance.good_id, good_identifier) in self.assigned_codes:
             self.add_error('good_identifier', _("Esiste già una consegna di questo prodotto, "
                                                 "per questa campagna, "
                                                 "con questo codice identificativo"))
+        return cleaned_data
+
+    def _get_validation_exclusions(self):
+        exclude = super()._get_validation_exclusions()
+        # identifier already checked against prefetched ones:
+        # skip the model field existence query
+        if self.fields['good_stock_identifier'].prefetched is not None:
+            exclude.append('good_stock_identifier')
+        return exclude
 
     class Media:
-        js = ('js/textarea-autosize.js',)
+        js = ('js/textarea-autosize.js',
+              'js/remote-select.js',)
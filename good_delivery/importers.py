@@ -0,0 +1,129 @@
+import csv
+import logging
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count
+from django.utils.translation import gettext as _
+
+from . models import (DeliveryPointGoodStock,
+                      DeliveryPointGoodStockCounter,
+                      DeliveryPointGoodStockIdentifier)
+from . settings import IMPORT_CHUNK_SIZE
+
+
+logger = logging.getLogger(__name__)
+
+
+def _count_identifiers(stocks, codes):
+    counts = DeliveryPointGoodStockIdentifier.objects\
+                .filter(delivery_point_stock__in=stocks,
+                        good_identifier__in=codes)\
+                .order_by()\
+                .values('delivery_point_stock')\
+                .annotate(count=Count('pk'))\
+                .values_list('delivery_point_stock', 'count')
+    return dict(counts)
+
+
+def _import_chunk(chunk):
+    """
+    inserts the chunk (stock, identifier) pairs not already present,
+    with one existence query and one bulk insert.
+    Stock counters are adjusted by the rows actually inserted
+    (counted again in the transaction, concurrent imports of
+    the same stocks wait for the counters lock)
+    """
+    stocks = sorted({stock.pk for stock, identifier in chunk})
+    codes = {identifier for stock, identifier in chunk}
+    with transaction.atomic():
+        list(DeliveryPointGoodStockCounter.objects.filter(stock__in=stocks)\
+                                                  .select_for_update()\
+                                                  .order_by('stock'))
+        existent = set(DeliveryPointGoodStockIdentifier.objects\
+                            .filter(delivery_point_stock__in=stocks,
+                                    good_identifier__in=codes)\
+                            .values_list('delivery_point_stock_id', 'good_identifier'))
+        before = {}
+        for stock_id, identifier in existent:
+            before[stock_id] = before.get(stock_id, 0) + 1
+        new_identifiers = []
+        for stock, identifier in chunk:
+            key = (stock.pk, identifier)
+            # no duplicates (in database or in file)
+            if key in existent: continue
+            existent.add(key)
+            new_identifiers.append(DeliveryPointGoodStockIdentifier(delivery_point_stock=stock,
+                                                                    good_identifier=identifier))
+        if not new_identifiers: return 0
+
+        DeliveryPointGoodStockIdentifier.objects.bulk_create(new_identifiers,
+                                                             ignore_conflicts=True)
+        # bulk_create doesn't send post_save (and doesn't tell
+        # the ignored conflicts): update stock counters here
+        inserted = 0
+        for stock_id, count in _count_identifiers(stocks, codes).items():
+            stock_inserted = count - before.get(stock_id, 0)
+            if not stock_inserted: continue
+            DeliveryPointGoodStockCounter.adjust(identifiers=stock_inserted,
+                                                 free_identifiers=stock_inserted,
+                                                 stock_id=stock_id)
+            inserted += stock_inserted
+    return inserted
+
+
+def import_stock_identifiers(csv_file, campaign, good,
+                             errors_file=None, chunk_size=None,
+                             progress=None):
+    """
+    Imports stock identifiers from a CSV file with
+    "identifier,delivery point name" rows, reading it as a stream
+    in chunks (constant memory, a few queries for each chunk).
+    Rows that can't be imported are written in errors_file (CSV)
+    with their line number and the error.
+
+    :type csv_file: text file (or lines iterable)
+    :type campaign: DeliveryCampaign
+    :type good: Good
+    :type errors_file: text file
+    :type chunk_size: Int
+    :type progress: callable
+
+    :param csv_file: CSV to import
+    :param campaign: campaign of delivery points
+    :param good: good of delivery points stocks
+    :param errors_file: per-row errors CSV destination
+    :param chunk_size: rows inserted for each transaction
+    :param progress: called with the lines read after each chunk
+
+    :return: (inserted, errors) tuple
+    """
+    chunk_size = chunk_size or getattr(settings, 'IMPORT_CHUNK_SIZE', IMPORT_CHUNK_SIZE)
+    # delivery point name -> stock, resolved once
+    stocks = {stock.delivery_point.name: stock for stock in
+              DeliveryPointGoodStock.objects.filter(delivery_point__campaign=campaign,
+                                                    good=good)\
+                                            .select_related('delivery_point')}
+    errors_writer = csv.writer(errors_file) if errors_file else None
+    inserted = errors = line = 0
+    chunk = []
+    for line, row in enumerate(csv.reader(csv_file), start=1):
+        if not any(row): continue
+        if len(row) < 2 or not row[0].strip():
+            error = _('Riga non valida')
+        elif row[1].strip() not in stocks:
+            error = _('Punto di consegna {} inesistente o senza stock').format(row[1])
+        else:
+            chunk.append((stocks[row[1].strip()], row[0].strip()))
+            if len(chunk) == chunk_size:
+                inserted += _import_chunk(chunk)
+                chunk = []
+                if progress: progress(line)
+            continue
+        errors += 1
+        if errors_writer: errors_writer.writerow([line] + row + [error])
+    if chunk:
+        inserted += _import_chunk(chunk)
+    if progress: progress(line)
+    logger.info('Stock identifiers import: {} inserted, {} errors'.format(inserted, errors))
+    return inserted, errors
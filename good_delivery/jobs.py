@@ -0,0 +1,188 @@
+import io
+import logging
+import os
+import tempfile
+
+from django.conf import settings
+from django.core.files import File
+from django.db import connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.translation import gettext as _
+
+from . exporters import get_export_filename, stream_waiting_deliveries
+from . importers import import_stock_identifiers
+from . models import BackgroundJob, DeliveryCampaign, Good
+from . settings import BACKGROUND_JOB_STALE_TIMEOUT
+from . tokens import (exclude_notified_since,
+                      get_deliveries_to_notify,
+                      issue_delivery_tokens)
+
+
+logger = logging.getLogger(__name__)
+
+
+def _count_lines(field_file):
+    lines = 0
+    with field_file.open('rb'):
+        for chunk in iter(lambda: field_file.read(64 * 1024), b''):
+            lines += chunk.count(b'\n')
+    return lines
+
+
+def run_import_stock_identifiers(job):
+    """
+    imports job input CSV, rows not imported are saved as result file
+    """
+    campaign = DeliveryCampaign.objects.get(pk=job.params['campaign'])
+    good = Good.objects.get(pk=job.params['good'])
+    job.set_progress(0, total=_count_lines(job.input_file))
+    with tempfile.TemporaryFile(mode='w+', newline='') as errors_file:
+        with job.input_file.open('rb'):
+            csv_file = io.TextIOWrapper(job.input_file.file,
+                                        encoding=settings.DEFAULT_CHARSET,
+                                        newline='')
+            inserted, errors = import_stock_identifiers(csv_file=csv_file,
+                                                        campaign=campaign,
+                                                        good=good,
+                                                        errors_file=errors_file,
+                                                        progress=job.set_progress)
+            csv_file.detach()
+        if errors:
+            errors_file.seek(0)
+            job.result_file.save('import_errors_{}.csv'.format(job.pk),
+                                 File(errors_file), save=False)
+    message = _("{} record inseriti.").format(inserted)
+    if errors:
+        message += ' ' + _("{} righe non importate").format(errors)
+    return message
+
+
+def run_export_waiting_deliveries(job):
+    """
+    exports campaigns waiting deliveries as result (CSV) file
+    """
+    campaigns = list(DeliveryCampaign.objects.filter(pk__in=job.params['campaigns']))
+    with tempfile.TemporaryFile() as export_file:
+        for chunk in stream_waiting_deliveries(campaigns):
+            export_file.write(chunk)
+            job.heartbeat()
+        export_file.seek(0)
+        name, extension = os.path.splitext(get_export_filename(campaigns))
+        job.result_file.save('{}_{}{}'.format(name, job.pk, extension),
+                             File(export_file), save=False)
+    return _("Esportazione completata")
+
+
+def run_send_delivery_tokens(job):
+    """
+    emails confirmation tokens of campaigns waiting deliveries,
+    a requeued job skips the deliveries it already notified
+    """
+    user = job.created_by
+    sent = 0
+    deliveries = []
+    for campaign in DeliveryCampaign.objects.filter(pk__in=job.params['campaigns']):
+        deliveries.append(exclude_notified_since(get_deliveries_to_notify(campaign),
+                                                 job.create))
+    job.set_progress(0, total=sum(d.count() for d in deliveries))
+    for campaign_deliveries in deliveries:
+        done = sent
+        sent += issue_delivery_tokens(deliveries=campaign_deliveries,
+                                      uri=job.params['uri'],
+                                      user=user,
+                                      progress=lambda count: job.set_progress(done + count))
+    return _("{} token di attivazione inviati").format(sent)
+
+
+JOB_RUNNERS = {
+    BackgroundJob.IMPORT_STOCK_IDENTIFIERS: run_import_stock_identifiers,
+    BackgroundJob.EXPORT_WAITING_DELIVERIES: run_export_waiting_deliveries,
+    BackgroundJob.SEND_DELIVERY_TOKENS: run_send_delivery_tokens,
+}
+
+
+def get_stale_condition():
+    """
+    running jobs whose worker gave no progress (or heartbeat)
+    for BACKGROUND_JOB_STALE_TIMEOUT seconds: the worker died
+    """
+    timeout = getattr(settings, 'BACKGROUND_JOB_STALE_TIMEOUT', BACKGROUND_JOB_STALE_TIMEOUT)
+    return Q(status=BackgroundJob.RUNNING,
+             modified__lt=timezone.now() - timezone.timedelta(seconds=timeout))
+
+
+def requeue_jobs(jobs):
+    """
+    queues again failed and stale jobs
+
+    :type jobs: QuerySet of BackgroundJob
+
+    :return: number of queued jobs
+    """
+    return jobs.filter(Q(status=BackgroundJob.FAILED) | get_stale_condition())\
+               .update(status=BackgroundJob.QUEUED,
+                       progress=0,
+                       result_message=None,
+                       modified=timezone.now())
+
+
+def requeue_stale_jobs():
+    """
+    queues again the jobs of dead workers
+    """
+    requeued = BackgroundJob.objects.filter(get_stale_condition())\
+                                    .update(status=BackgroundJob.QUEUED,
+                                            progress=0,
+                                            modified=timezone.now())
+    if requeued:
+        logger.warning('{} stale background jobs queued again'.format(requeued))
+    return requeued
+
+
+def _claim_job():
+    with transaction.atomic():
+        jobs = BackgroundJob.objects.filter(status=BackgroundJob.QUEUED)\
+                                    .order_by('create', 'pk')
+        # concurrent workers skip rows locked by the others
+        if connection.features.has_select_for_update_skip_locked:
+            jobs = jobs.select_for_update(skip_locked=True)
+        job = jobs.first()
+        if not job: return None
+        job.status = BackgroundJob.RUNNING
+        job.start_date = timezone.now()
+        job.save(update_fields=['status', 'start_date', 'modified'])
+    return job
+
+
+def process_background_jobs(max_jobs=1):
+    """
+    Runs queued jobs, one at a time and outside of the claim
+    transaction (progress is visible while the job runs).
+    A failing job is marked as failed with its error,
+    jobs of dead workers are queued again.
+
+    :type max_jobs: Int
+
+    :param max_jobs: max number of jobs to run
+
+    :return: (done, failed) tuple
+    """
+    requeue_stale_jobs()
+    done = failed = 0
+    for i in range(max_jobs):
+        job = _claim_job()
+        if not job: break
+        try:
+            job.result_message = JOB_RUNNERS[job.kind](job)
+            job.status = BackgroundJob.DONE
+            done += 1
+        except Exception as e:
+            logger.exception('Background job {} failed'.format(job.pk))
+            job.result_message = '{}'.format(e)
+            job.status = BackgroundJob.FAILED
+            failed += 1
+        job.end_date = timezone.now()
+        job.save(update_fields=['status', 'result_message', 'result_file',
+                                'end_date', 'modified'])
+    return done, failed
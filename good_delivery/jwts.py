@@ -1,16 +1,107 @@
 import json
+import logging
+import os
+import threading
 
+from asgiref.sync import sync_to_async
+from cryptography.hazmat.primitives.asymmetric import rsa
 from cryptojwt.jwk.rsa import import_private_rsa_key_from_file, RSAKey
 from cryptojwt.jwe.jwe import factory
 from cryptojwt.jwe.jwe_rsa import JWE_RSA
 from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
 
 
+logger = logging.getLogger(__name__)
+
 RSA_KEY = settings.JWE_RSA_KEY_PATH
 JWE_ALG = settings.JWE_ALG
 JWE_ENC = settings.JWE_ENC
 
 
+class JWEKeyStore(object):
+    """
+    Process-wide cache of the RSA keys used to encrypt/decrypt tokens.
+
+    Keys are read from settings.JWE_RSA_KEYS ({kid: key path}, the first
+    one encrypts new tokens, the others only decrypt the ones already sent)
+    or, if not defined, from settings.JWE_RSA_KEY_PATH (tokens without kid).
+    A key file is parsed again only if its mtime changes or reload() is called.
+    """
+
+    def __init__(self):
+        # reentrant: reload() can run (signal handler, setting_changed)
+        # while the same thread is loading a key
+        self._lock = threading.RLock()
+        self._keys = {}
+        self._paths = None
+
+    def get_paths(self):
+        if self._paths is None:
+            keys = getattr(settings, 'JWE_RSA_KEYS', None)
+            self._paths = dict(keys) if keys else {None: settings.JWE_RSA_KEY_PATH}
+        return self._paths
+
+    def reload(self):
+        with self._lock:
+            self._keys = {}
+            self._paths = None
+
+    def _load(self, kid, path):
+        priv_key = import_private_rsa_key_from_file(path)
+        # cryptojwt returns (doesn't raise) a ValueError if not a RSA key
+        if not isinstance(priv_key, rsa.RSAPrivateKey):
+            raise ValueError('{} is not a RSA private key'.format(path))
+        key = RSAKey(priv_key=priv_key, kid=kid or '')
+        logger.info('JWE RSA key {} loaded'.format(path))
+        return key
+
+    def get(self, kid=None):
+        """
+        returns the RSAKey identified by kid (the encryption one if None)
+        """
+        paths = self.get_paths()
+        if kid is None:
+            kid = next(iter(paths))
+        path = paths[kid]
+        mtime = os.stat(path).st_mtime
+        cached = self._keys.get(kid)
+        if cached and cached[0] == mtime:
+            return cached[1]
+        with self._lock:
+            key = self._load(kid, path)
+            self._keys[kid] = (mtime, key)
+        return key
+
+    def get_all(self):
+        return [self.get(kid) for kid in self.get_paths()]
+
+    @property
+    def encryption_kid(self):
+        return next(iter(self.get_paths()))
+
+
+jwe_key_store = JWEKeyStore()
+
+
+@receiver(setting_changed)
+def reload_jwe_keys(setting, **kwargs):
+    if setting in ('JWE_RSA_KEYS', 'JWE_RSA_KEY_PATH'):
+        jwe_key_store.reload()
+
+
+def install_jwe_keys_reload_signal(signum):
+    """
+    reloads keys when the process receives signum (e.g. signal.SIGUSR1)
+    """
+    import signal
+    if threading.current_thread() is not threading.main_thread():
+        return False
+    signal.signal(signum, lambda *args: jwe_key_store.reload())
+    return True
+
+
 def encrypt_to_jwe(content):
     """Returns a string
     a serialized encryption from cryptojwt.jwe.jwe_rsa.JWE_RSA
@@ -23,21 +114,32 @@ def encrypt_to_jwe(content):
     if not isinstance(content, bytes):
         raise Exception('encrypt_to_jwe content must be a bytes object')
 
-    priv_key = import_private_rsa_key_from_file(RSA_KEY)
-    pub_key = priv_key.public_key()
-    _rsa = JWE_RSA(content, alg=JWE_ALG, enc=JWE_ENC)
-    jwe = _rsa.encrypt(pub_key)
+    kid = jwe_key_store.encryption_kid
+    key = jwe_key_store.get(kid)
+    headers = {'kid': kid} if kid else {}
+    _rsa = JWE_RSA(content, alg=JWE_ALG, enc=JWE_ENC, **headers)
+    jwe = _rsa.encrypt(key.public_key())
     return jwe
 
 
 def decrypt_from_jwe(jwe):
-    # RSA_KEY = settings.UNITICKET_JWT_RSA_KEY_PATH
-    RSA_KEY = settings.JWE_RSA_KEY_PATH
     JWE_ALG = settings.JWE_ALG
     JWE_ENC = settings.JWE_ENC
 
-    priv_key = import_private_rsa_key_from_file(RSA_KEY)
     _decryptor = factory(jwe, alg=JWE_ALG, enc=JWE_ENC)
-    _dkey = RSAKey(priv_key=priv_key)
-    msg = _decryptor.decrypt(jwe, [_dkey])
+    kid = _decryptor.jwt.headers.get('kid')
+    if kid and kid in jwe_key_store.get_paths():
+        keys = [jwe_key_store.get(kid)]
+    else:
+        # tokens issued before keys rotation (without kid)
+        keys = jwe_key_store.get_all()
+    msg = _decryptor.decrypt(jwe, keys)
     return msg
+
+
+async def decrypt_from_jwe_async(jwe):
+    """
+    decrypt_from_jwe() for async views, run in the thread pool
+    (RSA decryption would block the event loop)
+    """
+    return await sync_to_async(decrypt_from_jwe, thread_sensitive=False)(jwe)
@@ -0,0 +1,114 @@
+import logging
+
+from django.conf import settings
+from django.core.mail import get_connection
+from django.db import connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from . models import OutboundMail
+from . settings import (MAIL_QUEUE_BATCH_SIZE,
+                        MAIL_QUEUE_CLAIM_TIMEOUT,
+                        MAIL_QUEUE_MAX_ATTEMPTS,
+                        MAIL_QUEUE_RETRY_BACKOFF)
+
+
+logger = logging.getLogger(__name__)
+
+
+def _mail_failed(mail, error, max_attempts, backoff):
+    mail.attempts += 1
+    mail.last_error = '{}'.format(error)
+    if mail.attempts >= max_attempts:
+        # dead letter
+        mail.status = OutboundMail.FAILED
+        logger.error('Outbound mail {} failed: {}'.format(mail.pk, error))
+    else:
+        delay = backoff * 2 ** (mail.attempts - 1)
+        mail.status = OutboundMail.QUEUED
+        mail.next_attempt = timezone.now() + timezone.timedelta(seconds=delay)
+    mail.save(update_fields=['attempts', 'last_error',
+                             'status', 'next_attempt', 'modified'])
+
+
+def _claim_mails(batch_size, claim_timeout):
+    """
+    marks a batch of queued emails (and of emails claimed by
+    dead workers) as sending, in a short transaction
+    """
+    now = timezone.now()
+    stale = now - timezone.timedelta(seconds=claim_timeout)
+    with transaction.atomic():
+        mails = OutboundMail.objects.filter(Q(status=OutboundMail.QUEUED,
+                                              next_attempt__lte=now) |
+                                            Q(status=OutboundMail.SENDING,
+                                              claim_date__lt=stale))\
+                                    .order_by('next_attempt', 'pk')
+        # concurrent workers skip rows locked by the others
+        if connection.features.has_select_for_update_skip_locked:
+            mails = mails.select_for_update(skip_locked=True)
+        mails = list(mails[:batch_size])
+        OutboundMail.objects.filter(pk__in=[mail.pk for mail in mails])\
+                            .update(status=OutboundMail.SENDING,
+                                    claim_date=now,
+                                    modified=now)
+    for mail in mails:
+        mail.status = OutboundMail.SENDING
+    return mails
+
+
+def process_mail_queue(batch_size=None, max_attempts=None, backoff=None):
+    """
+    Sends a batch of queued emails over a single connection.
+    The batch is claimed (committed as sending) before the
+    SMTP session and every email is marked as sent right after
+    its delivery: a worker dying in the middle doesn't send
+    again the emails already delivered.
+    Failed emails are retried with an exponential backoff and
+    marked as failed after max_attempts.
+
+    :type batch_size: Int
+    :type max_attempts: Int
+    :type backoff: Int
+
+    :param batch_size: max number of emails to send
+    :param max_attempts: attempts before marking an email as failed
+    :param backoff: seconds before first retry (doubled for each retry)
+
+    :return: (sent, failed) tuple
+    """
+    batch_size = batch_size or getattr(settings, 'MAIL_QUEUE_BATCH_SIZE', MAIL_QUEUE_BATCH_SIZE)
+    max_attempts = max_attempts or getattr(settings, 'MAIL_QUEUE_MAX_ATTEMPTS', MAIL_QUEUE_MAX_ATTEMPTS)
+    backoff = backoff or getattr(settings, 'MAIL_QUEUE_RETRY_BACKOFF', MAIL_QUEUE_RETRY_BACKOFF)
+    claim_timeout = getattr(settings, 'MAIL_QUEUE_CLAIM_TIMEOUT', MAIL_QUEUE_CLAIM_TIMEOUT)
+
+    sent = failed = 0
+    mails = _claim_mails(batch_size, claim_timeout)
+    if not mails: return sent, failed
+
+    try:
+        mail_connection = get_connection()
+        mail_connection.open()
+    except Exception as e:
+        for mail in mails:
+            _mail_failed(mail, e, max_attempts, backoff)
+        return sent, len(mails)
+
+    try:
+        for mail in mails:
+            try:
+                mail.get_email(connection=mail_connection).send()
+            except Exception as e:
+                _mail_failed(mail, e, max_attempts, backoff)
+                failed += 1
+                continue
+            mail.status = OutboundMail.SENT
+            mail.attempts += 1
+            mail.sent_date = timezone.now()
+            mail.save(update_fields=['status', 'attempts',
+                                     'sent_date', 'modified'])
+            sent += 1
+    finally:
+        mail_connection.close()
+    logger.info('Mail queue: {} sent, {} failed'.format(sent, failed))
+    return sent, failed
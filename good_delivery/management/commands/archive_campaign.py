@@ -0,0 +1,69 @@
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from good_delivery.archive import (CampaignNotArchivable,
+                                   CampaignRestoreError,
+                                   archive_campaign,
+                                   restore_campaign)
+from good_delivery.models import ArchivedCampaign, DeliveryCampaign
+
+
+class Command(BaseCommand):
+    help = 'Archives finished campaigns (out of live tables) or restores them'
+
+    def add_arguments(self, parser):
+        parser.add_argument('campaigns', type=str, nargs='*',
+                            help='campaigns slugs')
+        parser.add_argument('--all-finished', action='store_true',
+                            help='all ended and not active campaigns')
+        parser.add_argument('--restore', action='store_true',
+                            help='restore archived campaigns')
+        parser.add_argument('--user', type=str,
+                            help='username of the archiving user')
+        parser.add_argument('--chunk-size', type=int,
+                            help='rows read (or inserted) each time')
+
+    def handle(self, *args, **options):
+        if options['restore']:
+            return self.restore(options)
+        user = None
+        if options['user']:
+            user = get_user_model().objects.filter(username=options['user']).first()
+            if not user:
+                raise CommandError('User {} not found'.format(options['user']))
+        campaigns = DeliveryCampaign.objects.none()
+        if options['all_finished']:
+            campaigns = DeliveryCampaign.objects.filter(is_active=False,
+                                                        date_end__lte=timezone.now())
+        elif options['campaigns']:
+            campaigns = DeliveryCampaign.objects.filter(slug__in=options['campaigns'])
+            missing = set(options['campaigns']) - set(campaigns.values_list('slug', flat=True))
+            if missing:
+                raise CommandError('Campaigns {} not found'.format(', '.join(sorted(missing))))
+        else:
+            raise CommandError('Campaigns slugs or --all-finished are required')
+
+        for campaign in campaigns:
+            try:
+                archive = archive_campaign(campaign, user=user,
+                                           chunk_size=options['chunk_size'])
+            except CampaignNotArchivable as e:
+                raise CommandError(e)
+            self.stdout.write(self.style.SUCCESS('{}: {} deliveries, {} items archived in {}'.format(
+                              archive.slug, archive.deliveries,
+                              archive.items, archive.bundle.name)))
+
+    def restore(self, options):
+        if not options['campaigns']:
+            raise CommandError('Archived campaigns slugs are required')
+        for slug in options['campaigns']:
+            archived = ArchivedCampaign.objects.filter(slug=slug).first()
+            if not archived:
+                raise CommandError('Archived campaign {} not found'.format(slug))
+            try:
+                campaign = restore_campaign(archived,
+                                            chunk_size=options['chunk_size'])
+            except CampaignRestoreError as e:
+                raise CommandError(e)
+            self.stdout.write(self.style.SUCCESS('{} restored'.format(campaign.slug)))
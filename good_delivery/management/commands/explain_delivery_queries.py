@@ -0,0 +1,134 @@
+import json
+import re
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import Q
+
+from good_delivery.models import (DeliveryCampaign,
+                                  DeliveryPoint,
+                                  DeliveryPointGoodStockIdentifier,
+                                  Good,
+                                  GoodDelivery,
+                                  GoodDeliveryItem)
+
+
+def get_query_shapes():
+    """
+    hot query shapes of views, datatables and models helpers
+    (values taken from existent rows, they only drive the planner)
+    """
+    campaign = DeliveryCampaign.objects.first()
+    delivery_point = DeliveryPoint.objects.first()
+    good = Good.objects.first()
+    identifier = DeliveryPointGoodStockIdentifier.objects.first()
+    good_delivery = GoodDelivery.objects.first()
+    operator_deliveries = GoodDelivery.objects.filter(Q(choosen_delivery_point=delivery_point) |
+                                                      Q(delivery_point=delivery_point))
+    return [
+        ('operator deliveries', operator_deliveries),
+        ('deliveries to define',
+         GoodDelivery.objects.filter(choosen_delivery_point=delivery_point,
+                                     delivery_point__isnull=True)),
+        ('delivered deliveries',
+         operator_deliveries.filter(delivery_date__isnull=False,
+                                    disabled_date__isnull=True)),
+        ('waiting deliveries',
+         GoodDelivery.objects.filter(choosen_delivery_point=delivery_point,
+                                     delivery_point__isnull=False,
+                                     delivery_date__isnull=True,
+                                     disabled_date__isnull=True)),
+        ('disabled deliveries',
+         GoodDelivery.objects.filter(disabled_point=delivery_point,
+                                     disabled_date__isnull=False)),
+        ('user deliveries',
+         GoodDelivery.objects.filter(campaign=campaign,
+                                     delivered_to_id=getattr(good_delivery,
+                                                             'delivered_to_id',
+                                                             None))),
+        ('delivery items not returned',
+         GoodDeliveryItem.objects.filter(good_delivery=good_delivery,
+                                         return_date__isnull=True)),
+        ('good identifier items',
+         GoodDeliveryItem.objects.filter(good=good,
+                                         good_identifier='')),
+        ('assigned stock identifier',
+         GoodDeliveryItem.objects.filter(good_stock_identifier=identifier,
+                                         return_date__isnull=True)),
+        ('delivery point delivered items',
+         GoodDeliveryItem.objects.filter(delivery_point=delivery_point,
+                                         delivery_date__isnull=False)),
+        ('delivery point returned items',
+         GoodDeliveryItem.objects.filter(returned_point=delivery_point,
+                                         return_date__isnull=False)),
+    ]
+
+
+def _mysql_full_scans(plan, table):
+    # JSON plan: full scans (access_type ALL) without any usable index
+    # (MySQL scans small tables even when an index exists)
+    scans = []
+    nodes = [json.loads(plan)]
+    while nodes:
+        node = nodes.pop()
+        if isinstance(node, list):
+            nodes.extend(node)
+            continue
+        if not isinstance(node, dict): continue
+        entry = node.get('table')
+        if isinstance(entry, dict) and entry.get('table_name') == table and \
+           entry.get('access_type') == 'ALL' and not entry.get('possible_keys'):
+            scans.append(table)
+        nodes.extend(node.values())
+    return scans
+
+
+def get_sequential_scans(queryset):
+    """
+    tables of queryset model read with a full scan, according to EXPLAIN
+    (PostgreSQL, SQLite and MySQL/MariaDB). Returns (None, '') on
+    other databases.
+    MySQL doesn't support partial indexes (conditions are ignored),
+    the query shapes they serve use the plain foreign keys indexes.
+    """
+    table = queryset.model._meta.db_table
+    if connection.vendor == 'postgresql':
+        with transaction.atomic():
+            # with a small dataset the planner would prefer a seq scan
+            # anyway: penalize them to check if an index can be used
+            with connection.cursor() as cursor:
+                cursor.execute('SET LOCAL enable_seqscan = off')
+            plan = queryset.explain()
+        pattern = r'Seq Scan on {}\b'.format(table)
+    elif connection.vendor == 'sqlite':
+        plan = queryset.explain()
+        pattern = r'SCAN (TABLE )?{}\b'.format(table)
+    elif connection.vendor == 'mysql':
+        plan = queryset.explain(format='json')
+        return _mysql_full_scans(plan, table), plan
+    else:
+        return None, ''
+    return re.findall(pattern, plan), plan
+
+
+class Command(BaseCommand):
+    help = 'Runs EXPLAIN on delivery query shapes, exits with error on sequential scans'
+
+    def handle(self, *args, **options):
+        failures = 0
+        for name, queryset in get_query_shapes():
+            scans, plan = get_sequential_scans(queryset)
+            if scans is None:
+                self.stdout.write(self.style.WARNING('{} EXPLAIN is not supported, '
+                                                     'skipped'.format(connection.vendor)))
+                return
+            if scans:
+                failures += 1
+                self.stdout.write(self.style.ERROR('{}: sequential scan'.format(name)))
+                self.stdout.write(plan)
+            elif options['verbosity'] > 1:
+                self.stdout.write('{}: OK\n{}'.format(name, plan))
+
+        if failures:
+            raise CommandError('{} query shapes use sequential scans'.format(failures))
+        self.stdout.write(self.style.SUCCESS('No sequential scans'))
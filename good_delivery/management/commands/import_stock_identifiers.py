@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from good_delivery.importers import import_stock_identifiers
+from good_delivery.models import DeliveryCampaign, Good
+
+
+class Command(BaseCommand):
+    help = 'Imports stock identifiers from a CSV file ("identifier,delivery point name" rows)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('campaign', type=str, help='campaign slug')
+        parser.add_argument('good', type=int, help='good id')
+        parser.add_argument('file', type=str, help='CSV file')
+        parser.add_argument('--errors', type=str,
+                            help='CSV file where rows not imported are written')
+        parser.add_argument('--chunk-size', type=int,
+                            help='rows inserted for each transaction')
+        parser.add_argument('--encoding', type=str, default='utf-8')
+
+    def handle(self, *args, **options):
+        campaign = DeliveryCampaign.objects.filter(slug=options['campaign']).first()
+        if not campaign:
+            raise CommandError('Campaign {} not found'.format(options['campaign']))
+        good = Good.objects.filter(pk=options['good']).first()
+        if not good:
+            raise CommandError('Good {} not found'.format(options['good']))
+
+        errors_file = open(options['errors'], 'w', newline='') if options['errors'] else None
+        try:
+            with open(options['file'], encoding=options['encoding'], newline='') as csv_file:
+                inserted, errors = import_stock_identifiers(csv_file=csv_file,
+                                                            campaign=campaign,
+                                                            good=good,
+                                                            errors_file=errors_file,
+                                                            chunk_size=options['chunk_size'])
+        finally:
+            if errors_file: errors_file.close()
+        self.stdout.write(self.style.SUCCESS('{} identifiers inserted, {} errors'.format(inserted, errors)))
@@ -0,0 +1,42 @@
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.translation import gettext as _
+
+from good_delivery.models import DeliveryCampaign, DeliveryPoint, GoodDelivery
+
+
+class Command(BaseCommand):
+    help = 'Marks all waiting deliveries of a campaign (without agreement) as delivered'
+
+    def add_arguments(self, parser):
+        parser.add_argument('campaign', type=str, help='campaign slug')
+        parser.add_argument('--user', type=str, required=True,
+                            help='username of the delivering operator')
+        parser.add_argument('--delivery-point', type=int,
+                            help='only deliveries of this delivery point id')
+        parser.add_argument('--batch-size', type=int,
+                            help='deliveries updated for each query')
+
+    def handle(self, *args, **options):
+        campaign = DeliveryCampaign.objects.filter(slug=options['campaign']).first()
+        if not campaign:
+            raise CommandError('Campaign {} not found'.format(options['campaign']))
+        if campaign.require_agreement:
+            raise CommandError('Campaign {} requires users agreement'.format(campaign.slug))
+        user = get_user_model().objects.filter(username=options['user']).first()
+        if not user:
+            raise CommandError('User {} not found'.format(options['user']))
+        deliveries = GoodDelivery.objects.filter(campaign=campaign)
+        if options['delivery_point']:
+            delivery_point = DeliveryPoint.objects.filter(campaign=campaign,
+                                                          pk=options['delivery_point']).first()
+            if not delivery_point:
+                raise CommandError('Delivery point {} not found'.format(options['delivery_point']))
+            deliveries = deliveries.filter(delivery_point=delivery_point)
+
+        delivered = GoodDelivery.bulk_mark_as_delivered(deliveries=deliveries,
+                                                        operator=user,
+                                                        msg=_("Consegna massiva (senza conferma "
+                                                              "da parte dell'utente)"),
+                                                        batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS('{} deliveries marked as delivered'.format(delivered)))
@@ -0,0 +1,29 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from good_delivery.mail_queue import process_mail_queue
+
+
+class Command(BaseCommand):
+    help = 'Sends queued outbound emails'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int,
+                            help='emails sent for each batch')
+        parser.add_argument('--max-attempts', type=int,
+                            help='attempts before marking an email as failed')
+        parser.add_argument('--loop', action='store_true',
+                            help='keep running, polling the queue')
+        parser.add_argument('--sleep', type=int, default=10,
+                            help='seconds between polls when the queue is empty')
+
+    def handle(self, *args, **options):
+        while True:
+            sent, failed = process_mail_queue(batch_size=options['batch_size'],
+                                              max_attempts=options['max_attempts'])
+            if sent or failed:
+                self.stdout.write('{} sent, {} failed'.format(sent, failed))
+            if not options['loop']: break
+            if not sent and not failed:
+                time.sleep(options['sleep'])
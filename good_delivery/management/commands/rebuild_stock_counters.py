@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from good_delivery.models import (DeliveryPointGoodStock,
+                                  DeliveryPointGoodStockCounter)
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds (or verifies) delivery point stocks availability counters'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--campaign', type=str,
+                            help='campaign slug (default: all campaigns)')
+        parser.add_argument('--check', action='store_true',
+                            help='only verify counters, exit with error on mismatch')
+
+    def handle(self, *args, **options):
+        stocks = DeliveryPointGoodStock.objects.select_related('delivery_point', 'good')
+        if options['campaign']:
+            stocks = stocks.filter(delivery_point__campaign__slug=options['campaign'])
+
+        counters = {c.stock_id: c for c in
+                    DeliveryPointGoodStockCounter.objects.filter(stock__in=stocks)}
+        mismatches = 0
+        for stock in stocks:
+            values = stock.compute_counter_values()
+            counter = counters.get(stock.pk)
+            current = {k: getattr(counter, k) for k in values} if counter else None
+            if current == values: continue
+
+            mismatches += 1
+            self.stdout.write('{}: {} -> {}'.format(stock, current, values))
+            if not options['check']:
+                stock.rebuild_counter()
+
+        if options['check'] and mismatches:
+            raise CommandError('{} stock counters out of sync'.format(mismatches))
+        self.stdout.write(self.style.SUCCESS('{} stocks checked, {} {}'.format(
+                          len(stocks), mismatches,
+                          'mismatches' if options['check'] else 'rebuilt')))
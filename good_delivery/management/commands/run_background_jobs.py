@@ -0,0 +1,26 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from good_delivery.jobs import process_background_jobs
+
+
+class Command(BaseCommand):
+    help = 'Runs queued background imports and exports'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--max-jobs', type=int, default=1,
+                            help='jobs run for each poll')
+        parser.add_argument('--loop', action='store_true',
+                            help='keep running, polling the queue')
+        parser.add_argument('--sleep', type=int, default=5,
+                            help='seconds between polls when the queue is empty')
+
+    def handle(self, *args, **options):
+        while True:
+            done, failed = process_background_jobs(max_jobs=options['max_jobs'])
+            if done or failed:
+                self.stdout.write('{} done, {} failed'.format(done, failed))
+            if not options['loop']: break
+            if not done and not failed:
+                time.sleep(options['sleep'])
@@ -0,0 +1,58 @@
+import os
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.urls import reverse
+
+from good_delivery.models import DeliveryCampaign, DeliveryPoint
+from good_delivery.tokens import get_deliveries_to_notify, issue_delivery_tokens
+
+
+class Command(BaseCommand):
+    help = 'Issues and emails confirmation tokens for all waiting deliveries of a campaign'
+
+    def add_arguments(self, parser):
+        parser.add_argument('campaign', type=str, help='campaign slug')
+        parser.add_argument('--user', type=str, required=True,
+                            help='username of the operator issuing tokens (for logs)')
+        parser.add_argument('--delivery-point', type=int,
+                            help='only deliveries of this delivery point id')
+        parser.add_argument('--journal', type=str,
+                            help='progress journal file (resumes an interrupted run)')
+        parser.add_argument('--processes', type=int, default=os.cpu_count() or 1,
+                            help='encryption processes')
+        parser.add_argument('--batch-size', type=int, default=100,
+                            help='emails sent for each SMTP batch')
+        parser.add_argument('--base-url', type=str,
+                            default='https://{}'.format(settings.HOSTNAME),
+                            help='site URL used in confirmation links')
+        parser.add_argument('--message', type=str, default='',
+                            help='text added to emails')
+
+    def handle(self, *args, **options):
+        campaign = DeliveryCampaign.objects.filter(slug=options['campaign']).first()
+        if not campaign:
+            raise CommandError('Campaign {} not found'.format(options['campaign']))
+        user = get_user_model().objects.filter(username=options['user']).first()
+        if not user:
+            raise CommandError('User {} not found'.format(options['user']))
+        delivery_point = None
+        if options['delivery_point']:
+            delivery_point = DeliveryPoint.objects.filter(campaign=campaign,
+                                                          pk=options['delivery_point']).first()
+            if not delivery_point:
+                raise CommandError('Delivery point {} not found'.format(options['delivery_point']))
+
+        uri = '{}{}'.format(options['base_url'].rstrip('/'),
+                            reverse('good_delivery:user_use_token'))
+        deliveries = get_deliveries_to_notify(campaign=campaign,
+                                              delivery_point=delivery_point)
+        sent = issue_delivery_tokens(deliveries=deliveries,
+                                     uri=uri,
+                                     user=user,
+                                     msg=options['message'],
+                                     journal=options['journal'],
+                                     processes=options['processes'],
+                                     batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS('{} tokens sent'.format(sent)))
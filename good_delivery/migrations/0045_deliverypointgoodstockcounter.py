@@ -0,0 +1,49 @@
+# Generated by Django 3.2.25 on 2026-10-18 05:50
+
+from django.db import migrations, models
+from django.db.models import Sum
+import django.db.models.deletion
+
+
+def build_counters(apps, schema_editor):
+    Stock = apps.get_model('good_delivery', 'DeliveryPointGoodStock')
+    Counter = apps.get_model('good_delivery', 'DeliveryPointGoodStockCounter')
+    Identifier = apps.get_model('good_delivery', 'DeliveryPointGoodStockIdentifier')
+    Item = apps.get_model('good_delivery', 'GoodDeliveryItem')
+    for stock in Stock.objects.all():
+        delivered_quantity = Item.objects.filter(good_delivery__delivery_point=stock.delivery_point_id,
+                                                 good=stock.good_id)\
+                                         .aggregate(total=Sum('quantity'))['total'] or 0
+        identifiers = Identifier.objects.filter(delivery_point_stock=stock).count()
+        assigned = Item.objects.filter(good_stock_identifier__delivery_point_stock=stock).count()
+        Counter.objects.create(stock=stock,
+                               delivered_quantity=delivered_quantity,
+                               identifiers=identifiers,
+                               free_identifiers=identifiers - assigned)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('good_delivery', '0044_deliverycampaign_default_delivered_quantity'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DeliveryPointGoodStockCounter',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('create', models.DateTimeField(auto_now_add=True)),
+                ('modified', models.DateTimeField(auto_now=True)),
+                ('delivered_quantity', models.IntegerField(default=0)),
+                ('identifiers', models.IntegerField(default=0)),
+                ('free_identifiers', models.IntegerField(default=0)),
+                ('stock', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='counter', to='good_delivery.deliverypointgoodstock')),
+            ],
+            options={
+                'verbose_name': 'Contatori stock',
+                'verbose_name_plural': 'Contatori stock',
+            },
+        ),
+        migrations.RunPython(build_counters, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,40 @@
+# Generated by Django 3.2.25 on 2026-10-18 05:54
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('good_delivery', '0045_deliverypointgoodstockcounter'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OutboundMail',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('create', models.DateTimeField(auto_now_add=True)),
+                ('modified', models.DateTimeField(auto_now=True)),
+                ('subject', models.CharField(max_length=255)),
+                ('body', models.TextField()),
+                ('html_body', models.TextField(blank=True, null=True)),
+                ('from_email', models.CharField(max_length=255)),
+                ('recipients', models.TextField(help_text='Indirizzi separati da virgola')),
+                ('status', models.CharField(choices=[('queued', 'In coda'), ('sent', 'Inviata'), ('failed', 'Non recapitabile')], default='queued', max_length=8)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('next_attempt', models.DateTimeField(default=django.utils.timezone.now)),
+                ('last_error', models.TextField(blank=True, null=True)),
+                ('sent_date', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'verbose_name': 'Email in uscita',
+                'verbose_name_plural': 'Email in uscita',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='outboundmail',
+            index=models.Index(fields=['status', 'next_attempt'], name='good_delive_status_0fbc11_idx'),
+        ),
+    ]
@@ -0,0 +1,53 @@
+# Generated by Django 3.2.25 on 2026-10-18 05:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('good_delivery', '0046_outboundmail'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='gooddelivery',
+            index=models.Index(fields=['choosen_delivery_point', 'delivery_point', 'delivery_date', 'disabled_date'], name='gd_choosen_point_state_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='gooddelivery',
+            index=models.Index(fields=['delivery_point', 'delivery_date', 'disabled_date'], name='gd_point_state_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='gooddelivery',
+            index=models.Index(fields=['disabled_point', 'disabled_date'], name='gd_disabled_point_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='gooddelivery',
+            index=models.Index(fields=['campaign', 'delivered_to'], name='gd_campaign_user_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='gooddelivery',
+            index=models.Index(condition=models.Q(('delivery_point__isnull', True)), fields=['choosen_delivery_point'], name='gd_to_define_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='gooddeliveryitem',
+            index=models.Index(fields=['good_delivery', 'return_date'], name='gdi_delivery_return_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='gooddeliveryitem',
+            index=models.Index(fields=['good', 'good_identifier'], name='gdi_good_identifier_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='gooddeliveryitem',
+            index=models.Index(fields=['delivery_point', 'delivery_date'], name='gdi_point_delivery_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='gooddeliveryitem',
+            index=models.Index(fields=['returned_point', 'return_date'], name='gdi_returned_point_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='gooddeliveryitem',
+            index=models.Index(condition=models.Q(('return_date__isnull', True)), fields=['good_stock_identifier'], name='gdi_assigned_identifier_idx'),
+        ),
+    ]
@@ -0,0 +1,54 @@
+# Generated by Django 3.2.25 on 2026-10-18 05:59
+
+from django.db import migrations, models
+
+
+def build_search_documents(apps, schema_editor):
+    GoodDelivery = apps.get_model('good_delivery', 'GoodDelivery')
+    deliveries = GoodDelivery.objects.select_related('delivered_to',
+                                                     'choosen_delivery_point',
+                                                     'delivery_point')
+    to_update = []
+    for good_delivery in deliveries.iterator():
+        values = []
+        user = good_delivery.delivered_to
+        if user:
+            values.extend((user.username, user.first_name, user.last_name))
+        for delivery_point in (good_delivery.choosen_delivery_point,
+                               good_delivery.delivery_point):
+            if delivery_point: values.append(delivery_point.name)
+        values.append(good_delivery.notes)
+        good_delivery.search_document = ' '.join(v for v in values if v).lower()
+        to_update.append(good_delivery)
+    GoodDelivery.objects.bulk_update(to_update, ['search_document'], batch_size=500)
+
+
+def create_trigram_index(apps, schema_editor):
+    # SQLite full text table is created by search.install_sqlite_search_index
+    if schema_editor.connection.vendor != 'postgresql': return
+    schema_editor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    schema_editor.execute('CREATE INDEX gd_search_document_trgm_idx '
+                          'ON good_delivery_gooddelivery '
+                          'USING gin (search_document gin_trgm_ops)')
+
+
+def drop_trigram_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql': return
+    schema_editor.execute('DROP INDEX IF EXISTS gd_search_document_trgm_idx')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('good_delivery', '0047_delivery_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='gooddelivery',
+            name='search_document',
+            field=models.TextField(blank=True, default='', editable=False),
+        ),
+        migrations.RunPython(build_search_documents, migrations.RunPython.noop),
+        migrations.RunPython(create_trigram_index, drop_trigram_index),
+    ]
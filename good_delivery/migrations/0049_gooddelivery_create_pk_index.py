@@ -0,0 +1,17 @@
+# Generated by Django 3.2.25 on 2026-10-18 06:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('good_delivery', '0048_gooddelivery_search_document'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='gooddelivery',
+            index=models.Index(fields=['create', 'id'], name='gd_create_pk_idx'),
+        ),
+    ]
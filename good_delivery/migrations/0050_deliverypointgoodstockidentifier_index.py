@@ -0,0 +1,17 @@
+# Generated by Django 3.2.25 on 2026-10-18 06:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('good_delivery', '0049_gooddelivery_create_pk_index'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='deliverypointgoodstockidentifier',
+            index=models.Index(fields=['good_identifier'], name='dpgsi_good_identifier_idx'),
+        ),
+    ]
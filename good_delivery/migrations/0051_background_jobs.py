@@ -0,0 +1,45 @@
+# Generated by Django 3.2.25 on 2026-10-18 06:08
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import good_delivery.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('good_delivery', '0050_deliverypointgoodstockidentifier_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BackgroundJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('create', models.DateTimeField(auto_now_add=True)),
+                ('modified', models.DateTimeField(auto_now=True)),
+                ('kind', models.CharField(choices=[('import_stock_identifiers', 'Importazione identificativi prodotti'), ('export_waiting_deliveries', 'Esportazione consegne pendenti')], max_length=32)),
+                ('status', models.CharField(choices=[('queued', 'In coda'), ('running', 'In esecuzione'), ('done', 'Completato'), ('failed', 'Fallito')], default='queued', max_length=8)),
+                ('params', models.JSONField(blank=True, default=dict)),
+                ('input_file', models.FileField(blank=True, max_length=255, null=True, upload_to=good_delivery.models._background_job_upload)),
+                ('result_file', models.FileField(blank=True, max_length=255, null=True, upload_to=good_delivery.models._background_job_upload)),
+                ('progress', models.PositiveIntegerField(default=0)),
+                ('total', models.PositiveIntegerField(blank=True, null=True)),
+                ('result_message', models.TextField(blank=True, null=True)),
+                ('start_date', models.DateTimeField(blank=True, null=True)),
+                ('end_date', models.DateTimeField(blank=True, null=True)),
+                ('created_by', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'Attività in background',
+                'verbose_name_plural': 'Attività in background',
+                'ordering': ('-create',),
+            },
+        ),
+        migrations.AddIndex(
+            model_name='backgroundjob',
+            index=models.Index(fields=['status', 'create'], name='bgjob_status_create_idx'),
+        ),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 3.2.25 on 2026-10-18 06:22
+
+from django.db import migrations, models
+from django.db.models import Count, F, Min
+
+
+def clear_duplicate_identifiers(apps, schema_editor):
+    # the same code twice in a delivery: the first item keeps it,
+    # the others give back their identifier (to be chosen again)
+    Counter = apps.get_model('good_delivery', 'DeliveryPointGoodStockCounter')
+    Item = apps.get_model('good_delivery', 'GoodDeliveryItem')
+    duplicates = Item.objects.filter(good_identifier__isnull=False)\
+                             .values('good_delivery', 'good', 'good_identifier')\
+                             .annotate(first=Min('pk'), items=Count('pk'))\
+                             .filter(items__gt=1)\
+                             .order_by()
+    for duplicate in duplicates:
+        items = Item.objects.filter(good_delivery=duplicate['good_delivery'],
+                                    good=duplicate['good'],
+                                    good_identifier=duplicate['good_identifier'])\
+                            .exclude(pk=duplicate['first'])
+        for identifier in items.filter(good_stock_identifier__isnull=False)\
+                               .values_list('good_stock_identifier', flat=True):
+            Counter.objects.filter(stock__deliverypointgoodstockidentifier=identifier)\
+                           .update(free_identifiers=F('free_identifiers') + 1)
+        items.update(good_identifier=None, good_stock_identifier=None)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('good_delivery', '0051_background_jobs'),
+    ]
+
+    operations = [
+        migrations.RunPython(clear_duplicate_identifiers, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='gooddeliveryitem',
+            constraint=models.UniqueConstraint(fields=('good_delivery', 'good', 'good_identifier'), name='gdi_delivery_good_identifier_uniq'),
+        ),
+    ]
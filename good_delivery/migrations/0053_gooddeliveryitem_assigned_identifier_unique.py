@@ -0,0 +1,44 @@
+# Generated by Django 3.2.25 on 2026-10-18 06:24
+
+from django.db import migrations, models
+from django.db.models import Count, F, Min
+
+
+def clear_duplicate_assignments(apps, schema_editor):
+    # a stock identifier assigned to more not returned items:
+    # the first item keeps it, the others give it back
+    # (operators choose them a new one)
+    Counter = apps.get_model('good_delivery', 'DeliveryPointGoodStockCounter')
+    Item = apps.get_model('good_delivery', 'GoodDeliveryItem')
+    duplicates = Item.objects.filter(good_stock_identifier__isnull=False,
+                                     return_date__isnull=True)\
+                             .values('good_stock_identifier')\
+                             .annotate(first=Min('pk'), items=Count('pk'))\
+                             .filter(items__gt=1)\
+                             .order_by()
+    for duplicate in duplicates:
+        items = Item.objects.filter(good_stock_identifier=duplicate['good_stock_identifier'],
+                                    return_date__isnull=True)\
+                            .exclude(pk=duplicate['first'])
+        Counter.objects.filter(stock__deliverypointgoodstockidentifier=duplicate['good_stock_identifier'])\
+                       .update(free_identifiers=F('free_identifiers') + items.count())
+        items.update(good_identifier=None, good_stock_identifier=None)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('good_delivery', '0052_gooddeliveryitem_identifier_unique'),
+    ]
+
+    operations = [
+        migrations.RunPython(clear_duplicate_assignments, migrations.RunPython.noop),
+        migrations.RemoveIndex(
+            model_name='gooddeliveryitem',
+            name='gdi_assigned_identifier_idx',
+        ),
+        migrations.AddConstraint(
+            model_name='gooddeliveryitem',
+            constraint=models.UniqueConstraint(condition=models.Q(('return_date__isnull', True)), fields=('good_stock_identifier',), name='gdi_assigned_identifier_uniq'),
+        ),
+    ]
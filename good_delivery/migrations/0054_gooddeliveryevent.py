@@ -0,0 +1,81 @@
+# Generated by Django 3.2.25 on 2026-10-18 06:26
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models.functions import Cast
+import django.db.models.deletion
+import django.utils.timezone
+
+
+def import_log_entries(apps, schema_editor):
+    # deliveries LogEntry rows become NOTE events (free text)
+    ContentType = apps.get_model('contenttypes', 'ContentType')
+    LogEntry = apps.get_model('admin', 'LogEntry')
+    GoodDelivery = apps.get_model('good_delivery', 'GoodDelivery')
+    GoodDeliveryEvent = apps.get_model('good_delivery', 'GoodDeliveryEvent')
+    content_type = ContentType.objects.filter(app_label='good_delivery',
+                                              model='gooddelivery').first()
+    if not content_type: return
+    # LogEntry.object_id is text: existing deliveries are
+    # matched by a subquery on their pk casted to text
+    deliveries = GoodDelivery.objects.annotate(object_id=Cast('pk', models.TextField()))\
+                                     .values('object_id')
+    logs = LogEntry.objects.filter(content_type=content_type,
+                                   object_id__in=deliveries)\
+                           .order_by('pk')\
+                           .values_list('object_id', 'user_id',
+                                        'action_time', 'change_message')
+    events = []
+    for object_id, user_id, action_time, change_message in logs.iterator(chunk_size=2000):
+        events.append(GoodDeliveryEvent(good_delivery_id=int(object_id),
+                                        code='note',
+                                        user_id=user_id,
+                                        payload={'message': change_message},
+                                        create=action_time))
+        if len(events) == 2000:
+            GoodDeliveryEvent.objects.bulk_create(events)
+            events = []
+    GoodDeliveryEvent.objects.bulk_create(events)
+
+
+def delete_imported_events(apps, schema_editor):
+    GoodDeliveryEvent = apps.get_model('good_delivery', 'GoodDeliveryEvent')
+    GoodDeliveryEvent.objects.filter(code='note').delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('admin', '0003_logentry_add_action_flag_choices'),
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('good_delivery', '0053_gooddeliveryitem_assigned_identifier_unique'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GoodDeliveryEvent',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('code', models.CharField(choices=[('created', 'Creazione'), ('created_after_disable', 'Creazione dopo disabilitazione'), ('items_added', 'Inserimento items'), ('identifiers_assigned', 'Inserimento identificatori'), ('token_sent', 'Invio token'), ('delivered', 'Consegna'), ('confirmed', 'Conferma utente'), ('reset', 'Reset'), ('disabled', 'Disabilitazione'), ('item_returned', 'Restituzione bene'), ('item_replaced', 'Sostituzione bene'), ('item_deleted', 'Eliminazione bene'), ('note', 'Nota')], max_length=32)),
+                ('payload', models.JSONField(blank=True, default=dict)),
+                ('create', models.DateTimeField(default=django.utils.timezone.now)),
+                ('good_delivery', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='good_delivery.gooddelivery')),
+                ('user', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'Evento consegna',
+                'verbose_name_plural': 'Eventi consegne',
+                'ordering': ('-create', '-pk'),
+            },
+        ),
+        migrations.AddIndex(
+            model_name='gooddeliveryevent',
+            index=models.Index(fields=['good_delivery', 'create'], name='gde_delivery_create_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='gooddeliveryevent',
+            index=models.Index(fields=['code', 'create'], name='gde_code_create_idx'),
+        ),
+        migrations.RunPython(import_log_entries, delete_imported_events),
+    ]
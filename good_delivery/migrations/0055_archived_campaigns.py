@@ -0,0 +1,60 @@
+# Generated by Django 3.2.25 on 2026-10-18 06:30
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import good_delivery.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('good_delivery', '0054_gooddeliveryevent'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedCampaign',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('create', models.DateTimeField(auto_now_add=True)),
+                ('modified', models.DateTimeField(auto_now=True)),
+                ('campaign_pk', models.PositiveIntegerField(unique=True)),
+                ('name', models.CharField(max_length=255)),
+                ('slug', models.SlugField(max_length=255, unique=True)),
+                ('date_start', models.DateTimeField()),
+                ('date_end', models.DateTimeField()),
+                ('bundle', models.FileField(max_length=255, upload_to=good_delivery.models._archive_upload)),
+                ('deliveries', models.PositiveIntegerField(default=0)),
+                ('items', models.PositiveIntegerField(default=0)),
+                ('events', models.PositiveIntegerField(default=0)),
+                ('archived_by', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'Campagna archiviata',
+                'verbose_name_plural': 'Campagne archiviate',
+                'ordering': ('-date_end',),
+            },
+        ),
+        migrations.CreateModel(
+            name='ArchivedGoodDelivery',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('good_delivery_pk', models.PositiveIntegerField()),
+                ('delivery_date', models.DateTimeField(blank=True, null=True)),
+                ('disabled_date', models.DateTimeField(blank=True, null=True)),
+                ('identifiers', models.JSONField(blank=True, default=list)),
+                ('archive', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='good_delivery.archivedcampaign')),
+                ('delivered_to', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'Consegna archiviata',
+                'verbose_name_plural': 'Consegne archiviate',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='archivedgooddelivery',
+            index=models.Index(fields=['good_delivery_pk'], name='agd_good_delivery_idx'),
+        ),
+    ]
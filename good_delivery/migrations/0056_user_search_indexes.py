@@ -0,0 +1,48 @@
+# Generated by Django 3.2.25 on 2026-10-18 07:10
+
+from django.conf import settings
+from django.db import migrations
+
+
+USER_SEARCH_FIELDS = ('username', 'taxpayer_id', 'last_name', 'first_name')
+
+
+def _user_search_indexes(apps):
+    User = apps.get_model(settings.AUTH_USER_MODEL)
+    user_fields = {field.name: field for field in User._meta.fields}
+    for name in USER_SEARCH_FIELDS:
+        if name not in user_fields: continue
+        yield (User._meta.db_table,
+               user_fields[name].column,
+               'gd_user_{}_prefix_idx'.format(name))
+
+
+def create_user_search_indexes(apps, schema_editor):
+    # operator_users searches users with UPPER(field) LIKE 'TEXT%'
+    # (istartswith): expression indexes with pattern operators
+    # (SQLite has no expression LIKE optimization)
+    if schema_editor.connection.vendor != 'postgresql': return
+    for table, column, index in _user_search_indexes(apps):
+        schema_editor.execute('CREATE INDEX IF NOT EXISTS {} ON {} '
+                              '(UPPER({}::text) text_pattern_ops)'.format(
+                              schema_editor.quote_name(index),
+                              schema_editor.quote_name(table),
+                              schema_editor.quote_name(column)))
+
+
+def drop_user_search_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql': return
+    for table, column, index in _user_search_indexes(apps):
+        schema_editor.execute('DROP INDEX IF EXISTS {}'.format(schema_editor.quote_name(index)))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('good_delivery', '0055_archived_campaigns'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_user_search_indexes, drop_user_search_indexes),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 3.2.25 on 2026-10-18 06:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('good_delivery', '0056_user_search_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='outboundmail',
+            name='claim_date',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='outboundmail',
+            name='status',
+            field=models.CharField(choices=[('queued', 'In coda'), ('sending', 'In invio'), ('sent', 'Inviata'), ('failed', 'Non recapitabile')], default='queued', max_length=8),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-18 06:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('good_delivery', '0057_outboundmail_claim'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='backgroundjob',
+            name='kind',
+            field=models.CharField(choices=[('import_stock_identifiers', 'Importazione identificativi prodotti'), ('export_waiting_deliveries', 'Esportazione consegne pendenti'), ('send_delivery_tokens', 'Invio token di attivazione consegne')], max_length=32),
+        ),
+    ]
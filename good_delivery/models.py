@@ -2,12 +2,14 @@ import json
 import logging
 
 from django.conf import settings
-from django.contrib.admin.models import LogEntry, ADDITION, CHANGE
 from django.contrib.auth import get_user_model
-from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.core.mail import EmailMultiAlternatives
 from django.core.validators import RegexValidator
-from django.db import models
-from django.db.models import Q
+from django.db import models, transaction
+from django.db.models import (Case, Count, Exists, F, OuterRef,
+                              Q, Subquery, Sum, Value, When)
+from django.db.models.functions import Coalesce
 from django.templatetags.static import static
 from django.utils import timezone
 from django.utils.translation import gettext as _
@@ -16,6 +18,8 @@ from django.utils.text import slugify
 from ckeditor.fields import RichTextField
 
 from . jwts import *
+from . settings import (BULK_DELIVERY_BATCH_SIZE,
+                        DELIVERY_POINT_STATISTICS_CACHE_TTL)
 
 
 logger = logging.getLogger(__name__)
@@ -29,6 +33,20 @@ def _attachment_upload(instance, filename):
     return os.path.join('{}/{}'.format(folder, filename))
 
 
+def _deliver_pending_items(items, now, operator, delivery_point):
+    """
+    sets delivery data on items that miss them, with one UPDATE
+    (already set values are kept, as item.save() loop did)
+    """
+    return items.filter(Q(delivery_date__isnull=True) |
+                        Q(delivered_by__isnull=True) |
+                        Q(delivery_point__isnull=True))\
+                .update(delivery_date=Coalesce('delivery_date', Value(now)),
+                        delivered_by=Coalesce('delivered_by', Value(operator.pk)),
+                        delivery_point=Coalesce('delivery_point', delivery_point),
+                        modified=now)
+
+
 class TimeStampedModel(models.Model):
 	create = models.DateTimeField(auto_now_add=True)
 	modified =  models.DateTimeField(auto_now=True)
@@ -104,6 +122,63 @@ class DeliveryPoint(TimeStampedModel):
         verbose_name = _('Punto di consegna')
         verbose_name_plural = _('Punti di consegna')
 
+    @staticmethod
+    def get_statistics_cache_key(pk):
+        return 'good_delivery:delivery_point_statistics:{}'.format(pk)
+
+    @classmethod
+    def invalidate_statistics(cls, *pks):
+        keys = [cls.get_statistics_cache_key(pk) for pk in set(pks) if pk]
+        if keys: cache.delete_many(keys)
+
+    def compute_statistics(self):
+        """
+        operator dashboard counters
+        (one conditional aggregate query for each table)
+        """
+        is_delivered = Q(delivery_date__isnull=False)
+        is_disabled = Q(disabled_date__isnull=False)
+        choosen = Q(choosen_delivery_point=self)
+        deliveries = GoodDelivery.objects.filter(choosen |
+                                                 Q(delivery_point=self) |
+                                                 Q(disabled_point=self))
+        statistics = deliveries.aggregate(
+            pending_deliveries=Count('pk', filter=choosen & Q(delivery_point__isnull=True)),
+            waiting_deliveries=Count('pk', filter=choosen &
+                                                  Q(delivery_point__isnull=False,
+                                                    delivery_date__isnull=True,
+                                                    disabled_date__isnull=True)),
+            delivered_deliveries=Count('pk', filter=(choosen | Q(delivery_point=self)) & is_delivered),
+            disabled_deliveries=Count('pk', filter=(choosen | Q(disabled_point=self)) & is_disabled),
+            total_disabled_deliveries=Count('pk', filter=Q(disabled_point=self) & is_disabled))
+
+        items = GoodDeliveryItem.objects.filter(Q(delivery_point=self) |
+                                                Q(good_delivery__choosen_delivery_point=self) |
+                                                Q(returned_point=self))
+        statistics.update(items.aggregate(
+            total_delivered_items=Count('pk', filter=Q(delivery_point=self) & is_delivered),
+            total_delivered_by_others_items=Count('pk', filter=Q(good_delivery__choosen_delivery_point=self) &
+                                                               ~Q(delivery_point=self) &
+                                                               is_delivered),
+            total_returned_items=Count('pk', filter=Q(returned_point=self,
+                                                      return_date__isnull=False))))
+        return statistics
+
+    def get_statistics(self):
+        """
+        cached compute_statistics(),
+        invalidated by signals when deliveries or items change
+        """
+        key = self.get_statistics_cache_key(self.pk)
+        statistics = cache.get(key)
+        if statistics is None:
+            statistics = self.compute_statistics()
+            timeout = getattr(settings,
+                              'DELIVERY_POINT_STATISTICS_CACHE_TTL',
+                              DELIVERY_POINT_STATISTICS_CACHE_TTL)
+            cache.set(key, statistics, timeout)
+        return statistics
+
     def __str__(self):
         return '({}) {}'.format(self.campaign, self.name)
 
@@ -156,6 +231,33 @@ class Good(TimeStampedModel):
         return '[{}] {}'.format(self.category, self.name)
 
 
+class StockShortageError(Exception):
+    """
+    requested quantity exceeds stock availability
+    """
+    def __init__(self, stock, requested, available):
+        self.stock = stock
+        self.requested = requested
+        self.available = available
+        super().__init__('{}: {} requested, {} available'.format(stock,
+                                                                 requested,
+                                                                 available))
+
+
+class StockReservation:
+    """
+    units of a stock reserved by DeliveryPointGoodStock.reserve()
+    (counted: delivered_quantity counter already incremented)
+    """
+    def __init__(self, stock, quantity, counted=False):
+        self.stock = stock
+        self.quantity = quantity
+        self.counted = counted
+
+    def __repr__(self):
+        return '<StockReservation {} x {}>'.format(self.quantity, self.stock)
+
+
 class DeliveryPointGoodStock(TimeStampedModel):
     delivery_point = models.ForeignKey(DeliveryPoint,
                                        on_delete=models.CASCADE)
@@ -168,26 +270,144 @@ class DeliveryPointGoodStock(TimeStampedModel):
         verbose_name = _('Stock beni centro di consegna')
         verbose_name_plural = _('Stock beni centri di consegna')
 
-    def get_available_items(self):
+    def compute_counter_values(self):
+        """
+        computes stock counters from the whole GoodDeliveryItem history
+        (used to build and verify DeliveryPointGoodStockCounter)
+        """
         delivered_items = GoodDeliveryItem.objects.filter(good_delivery__delivery_point=self.delivery_point,
                                                           good=self.good)
+        delivered_quantity = delivered_items.aggregate(total=Sum('quantity'))['total'] or 0
+        identifiers = DeliveryPointGoodStockIdentifier.objects.filter(delivery_point_stock=self).count()
+        assigned_identifiers = GoodDeliveryItem.objects.filter(good_stock_identifier__delivery_point_stock=self).count()
+        return {'delivered_quantity': delivered_quantity,
+                'identifiers': identifiers,
+                'free_identifiers': identifiers - assigned_identifiers}
+
+    def get_free_identifiers(self, include=None):
+        """
+        stock identifiers whose code has not been assigned to any item
+        of this good in the campaign (anti-join, one query)
 
-        identifiers = DeliveryPointGoodStockIdentifier.objects.filter(delivery_point_stock=self)
-        if identifiers:
-            delivered_items = delivered_items.filter(good_stock_identifier__in=identifiers)
-            return identifiers.count() - delivered_items.count()
+        :type include: Int
+        :param include: identifier id to keep anyway (edited item one)
+        """
+        used = GoodDeliveryItem.objects.filter(good=self.good_id,
+                                               good_delivery__campaign=self.delivery_point.campaign_id,
+                                               good_stock_identifier__good_identifier=OuterRef('good_identifier'))
+        free = ~Exists(used)
+        if include: free = free | Q(pk=include)
+        return DeliveryPointGoodStockIdentifier.objects.filter(free,
+                                                               delivery_point_stock=self)
+
+    def rebuild_counter(self):
+        values = self.compute_counter_values()
+        counter, created = DeliveryPointGoodStockCounter.objects.update_or_create(stock=self,
+                                                                                  defaults=values)
+        return counter
+
+    def get_counter(self):
+        counter = DeliveryPointGoodStockCounter.objects.filter(stock=self).first()
+        if not counter:
+            counter = self.rebuild_counter()
+        return counter
+
+    def get_pending_identifiers(self):
+        """
+        items of the stock waiting for an identifier
+        """
+        return GoodDeliveryItem.objects.filter(good=self.good_id,
+                                               good_delivery__delivery_point=self.delivery_point_id,
+                                               good_stock_identifier__isnull=True,
+                                               return_date__isnull=True).count()
+
+    def reserve(self, quantity):
+        """
+        Reserves quantity units of the stock, without races between
+        operators: stocks with a max number are decremented by a
+        conditional UPDATE, identifiers stocks lock their counter row
+        while pending items are counted (other stocks are not locked).
+        Call it in the transaction that creates the items
+        (GoodDelivery.add_items()), the good delivery must already
+        be in the stock delivery point.
+
+        :type quantity: Int
+
+        :param quantity: units to reserve
+
+        :raises StockShortageError: not enough available units
 
-        delivered_quantity = 0
-        for delivered_item in delivered_items:
-            delivered_quantity += delivered_item.quantity
+        :return: StockReservation
+        """
+        counters = DeliveryPointGoodStockCounter.objects.filter(stock=self)
+        with transaction.atomic():
+            # the UPDATE locks the counter row until the transaction ends
+            if not counters.update(modified=timezone.now()):
+                self.rebuild_counter()
+            counter = counters.get()
+            if counter.identifiers:
+                available = counter.free_identifiers - self.get_pending_identifiers()
+                if quantity > available:
+                    raise StockShortageError(self, quantity, max(available, 0))
+                return StockReservation(self, quantity)
+            if self.max_number > 0:
+                # availability check and decrement in one statement
+                reserved = counters.filter(delivered_quantity__lte=self.max_number - quantity)\
+                                   .update(delivered_quantity=F('delivered_quantity') + quantity)
+                if not reserved:
+                    available = self.max_number - counters.get().delivered_quantity
+                    raise StockShortageError(self, quantity, max(available, 0))
+                return StockReservation(self, quantity, counted=True)
+        return StockReservation(self, quantity)
+
+    def get_available_items(self):
+        counter = self.get_counter()
+        if counter.identifiers:
+            return counter.free_identifiers
         if self.max_number > 0:
-            return self.max_number - delivered_quantity
+            return self.max_number - counter.delivered_quantity
         return True
 
     def __str__(self):
         return '{} - {}'.format(self.delivery_point, self.good)
 
 
+class DeliveryPointGoodStockCounter(TimeStampedModel):
+    """
+    contatori di disponibilità di uno stock
+    (aggiornati dai signals, ricostruibili con rebuild_stock_counters)
+    """
+    stock = models.OneToOneField(DeliveryPointGoodStock,
+                                 on_delete=models.CASCADE,
+                                 related_name='counter')
+    delivered_quantity = models.IntegerField(default=0)
+    identifiers = models.IntegerField(default=0)
+    free_identifiers = models.IntegerField(default=0)
+
+    class Meta:
+        verbose_name = _('Contatori stock')
+        verbose_name_plural = _('Contatori stock')
+
+    @classmethod
+    def adjust(cls, delivered_quantity=0, identifiers=0,
+               free_identifiers=0, **lookup):
+        """
+        atomically adds deltas to the counters matched by lookup
+        """
+        values = {}
+        if delivered_quantity:
+            values['delivered_quantity'] = F('delivered_quantity') + delivered_quantity
+        if identifiers:
+            values['identifiers'] = F('identifiers') + identifiers
+        if free_identifiers:
+            values['free_identifiers'] = F('free_identifiers') + free_identifiers
+        if not values: return 0
+        return cls.objects.filter(**lookup).update(**values)
+
+    def __str__(self):
+        return '{}'.format(self.stock)
+
+
 class DeliveryPointGoodStockIdentifier(TimeStampedModel):
     """
     identificativo bene presente in stock
@@ -202,11 +422,43 @@ class DeliveryPointGoodStockIdentifier(TimeStampedModel):
         verbose_name = _('Identificativo bene in stock')
         verbose_name_plural = _('Identificativi beni in stock')
         unique_together = ("delivery_point_stock", "good_identifier")
+        # items codes lookup in get_free_identifiers()
+        indexes = [models.Index(fields=['good_identifier'],
+                                name='dpgsi_good_identifier_idx')]
 
     def __str__(self):
         return self.good_identifier
 
 
+class GoodDeliveryQuerySet(models.QuerySet):
+
+    def with_state(self):
+        """
+        annotates deliveries with the items data needed by
+        state, is_waiting(), can_be_deleted() and single_items_to_deliver()
+        so that lists and detail pages don't query them for each row
+        """
+        items = GoodDeliveryItem.objects.filter(good_delivery=OuterRef('pk'))
+        items_to_deliver = items.filter(create__gt=OuterRef('delivery_date'),
+                                        return_date__isnull=True,
+                                        delivery_date__isnull=True)
+        user_deliveries = GoodDelivery.objects.filter(campaign=OuterRef('campaign'),
+                                                      delivered_to=OuterRef('delivered_to'))\
+                                              .order_by()\
+                                              .values('campaign')\
+                                              .annotate(count=Count('pk'))\
+                                              .values('count')
+        same_point = user_deliveries.filter(delivery_point=OuterRef('delivery_point'))
+        no_point = user_deliveries.filter(delivery_point__isnull=True)
+        return self.select_related('campaign')\
+                   .annotate(state_has_items=Exists(items),
+                             state_items_to_deliver=Exists(items_to_deliver),
+                             state_user_deliveries=Case(
+                                When(delivery_point__isnull=True,
+                                     then=Subquery(no_point)),
+                                default=Subquery(same_point)))
+
+
 class GoodDelivery(TimeStampedModel):
     """
     assegnazione di un prodotto a un utente, da parte di un operatore
@@ -255,9 +507,33 @@ class GoodDelivery(TimeStampedModel):
 
     notes = models.TextField(null=True, blank=True)
 
+    # user and delivery points names and notes, kept updated by signals
+    # and indexed for datatables search (see search.py)
+    search_document = models.TextField(blank=True, default='', editable=False)
+
+    objects = GoodDeliveryQuerySet.as_manager()
+
     class Meta:
         verbose_name = _('Consegna prodotto')
         verbose_name_plural = _('Consegne prodotti')
+        # operator lists filter on (choosen_)delivery_point and state dates,
+        # user pages and with_state() on (campaign, delivered_to)
+        indexes = [models.Index(fields=['choosen_delivery_point', 'delivery_point',
+                                        'delivery_date', 'disabled_date'],
+                                name='gd_choosen_point_state_idx'),
+                   models.Index(fields=['delivery_point', 'delivery_date',
+                                        'disabled_date'],
+                                name='gd_point_state_idx'),
+                   models.Index(fields=['disabled_point', 'disabled_date'],
+                                name='gd_disabled_point_idx'),
+                   models.Index(fields=['campaign', 'delivered_to'],
+                                name='gd_campaign_user_idx'),
+                   models.Index(fields=['choosen_delivery_point'],
+                                condition=Q(delivery_point__isnull=True),
+                                name='gd_to_define_idx'),
+                   # keyset pagination ordering
+                   models.Index(fields=['create', 'id'],
+                                name='gd_create_pk_idx')]
 
     def get_stock(self):
         stock = DeliveryPointGoodStock.objects.filter(delivery_point=self.delivery_point,
@@ -268,30 +544,60 @@ class GoodDelivery(TimeStampedModel):
         items = GoodDeliveryItem.objects.filter(good_delivery=self)
         return items
 
-    def log_action(self, msg, action, user):
-        LogEntry.objects.log_action(user_id         = user.pk,
-                                    content_type_id = ContentType.objects.get_for_model(self).pk,
-                                    object_id       = self.pk,
-                                    object_repr     = self.__str__(),
-                                    action_flag     = action,
-                                    change_message  = msg)
-        logger.info(msg)
+    @classmethod
+    def log_events(cls, entries, code, user=None):
+        """
+        appends a GoodDeliveryEvent for every (good_delivery, payload)
+        in entries, with a single query
+        """
+        events = [GoodDeliveryEvent(good_delivery=good_delivery,
+                                    code=code,
+                                    user=user,
+                                    payload=payload or {})
+                  for good_delivery, payload in entries]
+        GoodDeliveryEvent.objects.bulk_create(events)
+        for event in events: logger.info(event.get_message())
+        return events
+
+    def log_event(self, code, user=None, **payload):
+        """
+        appends a GoodDeliveryEvent to the delivery history
+        """
+        event = GoodDeliveryEvent.objects.create(good_delivery=self,
+                                                 code=code,
+                                                 user=user,
+                                                 payload=payload)
+        logger.info(event.get_message())
+        return event
+
+    def get_events(self):
+        """
+        delivery history, newest first
+        """
+        return GoodDeliveryEvent.objects.timeline(self)
 
     def get_year(self):
         return self.create.year
 
-    def build_jwt(self):
+    def get_jwt_data(self):
         data = {'id': self.pk,
-                'user': self.delivered_to.pk,
-                'delivery_point': self.delivery_point.pk,
+                'user': self.delivered_to_id,
+                'delivery_point': self.delivery_point_id,
                 'modified': self.modified.isoformat()}
+        return data
+
+    def build_jwt(self):
+        data = self.get_jwt_data()
         encrypted_data = encrypt_to_jwe(json.dumps(data).encode())
         return encrypted_data
 
     def is_waiting(self):
         if self.delivery_date: return False
         if self.disabled_date: return False
-        return self.get_items()
+        # precomputed by GoodDelivery.objects.with_state()
+        if hasattr(self, 'state_has_items'):
+            return self.state_has_items
+        return self.get_items().exists()
 
     def can_be_disabled(self):
         if self.disabled_date: return False
@@ -300,9 +606,12 @@ class GoodDelivery(TimeStampedModel):
     def can_be_deleted(self):
         if self.delivery_date: return False
         if self.disabled_date: return False
-        user_deliveries = GoodDelivery.objects.filter(campaign=self.campaign,
-                                                      delivered_to=self.delivered_to,
-                                                      delivery_point=self.delivery_point).count()
+        if hasattr(self, 'state_user_deliveries'):
+            user_deliveries = self.state_user_deliveries
+        else:
+            user_deliveries = GoodDelivery.objects.filter(campaign=self.campaign,
+                                                          delivered_to=self.delivered_to,
+                                                          delivery_point=self.delivery_point).count()
         # if good_delivery has been prefilled
         # (not created by operator)
         # operators can't delete it
@@ -315,16 +624,16 @@ class GoodDelivery(TimeStampedModel):
         # without user confirmation
         if not self.campaign.is_in_progress(): return False
         if self.campaign.require_agreement: return False
-        if not self.delivered_by: return False
+        if not self.delivered_by_id: return False
         return self.is_waiting()
 
     def can_be_marked_by_user(self):
         """
         marked as delivered by user action
         """
-        if not self.delivery_point: return False
+        if not self.delivery_point_id: return False
         if not self.campaign.is_in_progress(): return False
-        if not self.delivered_by: return False
+        if not self.delivered_by_id: return False
         return self.is_waiting()
 
     def single_items_to_deliver(self):
@@ -332,15 +641,16 @@ class GoodDelivery(TimeStampedModel):
         check if there are waiting items that operator has added after
         delivery (for a return)
         """
-        if not self.delivery_point: return False
+        if not self.delivery_point_id: return False
         if not self.campaign.is_in_progress(): return False
         if not self.delivery_date: return False
+        if hasattr(self, 'state_items_to_deliver'):
+            return self.state_items_to_deliver
         waiting_items = GoodDeliveryItem.objects.filter(good_delivery=self,
                                                         create__gt=self.delivery_date,
                                                         return_date__isnull=True,
                                                         delivery_date__isnull=True)
-        if waiting_items: return True
-        return False
+        return waiting_items.exists()
 
     @property
     def state(self):
@@ -348,39 +658,216 @@ class GoodDelivery(TimeStampedModel):
             return _('disabilitata')
         elif self.delivery_date:
             return _('consegnato')
-        elif not self.delivery_point:
+        elif not self.delivery_point_id:
             return _('da definire')
         elif self.is_waiting():
             return _('in attesa')
         else:
             return _('unknown')
 
+    def add_items(self, reservations, user):
+        """
+        Creates the items of stocks reservations with one INSERT
+        and writes a single ITEMS_ADDED event, in one transaction.
+        Stocks with identifiers get an item for every unit
+        (identifiers are chosen later), the others one item.
+
+        :type reservations: list of StockReservation
+        :type user: User
+
+        :param reservations: reserved stocks units (DeliveryPointGoodStock.reserve())
+        :param user: operator (for logs)
+
+        :return: created items
+        """
+        items = []
+        for reservation in reservations:
+            stock = reservation.stock
+            if stock.get_counter().identifiers:
+                items.extend(GoodDeliveryItem(good_delivery=self,
+                                              quantity=1,
+                                              good=stock.good)
+                             for i in range(reservation.quantity))
+            else:
+                items.append(GoodDeliveryItem(good_delivery=self,
+                                              quantity=reservation.quantity,
+                                              good=stock.good))
+        if not items: return items
+        with transaction.atomic():
+            GoodDeliveryItem.objects.bulk_create(items)
+            # bulk_create doesn't send post_save: update stock counters here
+            # (if not already done by the reservation)
+            for reservation in reservations:
+                if reservation.counted: continue
+                DeliveryPointGoodStockCounter.adjust(delivered_quantity=reservation.quantity,
+                                                     stock__good_id=reservation.stock.good_id,
+                                                     stock__delivery_point__delivered_point=self.pk)
+            added = [{'good_id': reservation.stock.good_id,
+                      'good': '{}'.format(reservation.stock.good),
+                      'quantity': reservation.quantity}
+                     for reservation in reservations]
+            self.log_event(GoodDeliveryEvent.ITEMS_ADDED, user, items=added)
+        DeliveryPoint.invalidate_statistics(self.delivery_point_id,
+                                            self.choosen_delivery_point_id)
+        return items
+
+    def assign_identifiers(self, items):
+        """
+        Saves items stock identifiers (and codes) with one UPDATE
+        and adjusts stock counters once for each stock,
+        whatever the items number.
+        Items identifiers are unique for each good delivery
+        (database constraint, raises IntegrityError).
+
+        :type items: list of GoodDeliveryItem (of this delivery)
+
+        :param items: items with good_stock_identifier and good_identifier set
+
+        :return: changed items number
+        """
+        now = timezone.localtime()
+        changed = [item for item in items
+                   if item._counter_snapshot[1] != item.good_stock_identifier_id]
+        for item in items: item.modified = now
+        with transaction.atomic():
+            GoodDeliveryItem.objects.bulk_update(items, ['good_stock_identifier',
+                                                         'good_identifier',
+                                                         'modified'])
+            # bulk_update doesn't send post_save: update stock counters here
+            free_identifiers = {}
+            for item in changed:
+                if not item.good_stock_identifier_id: continue
+                stock_id = item.good_stock_identifier.delivery_point_stock_id
+                free_identifiers[stock_id] = free_identifiers.get(stock_id, 0) - 1
+            released = [item._counter_snapshot[1] for item in changed
+                        if item._counter_snapshot[1]]
+            if released:
+                released_by_stock = DeliveryPointGoodStockIdentifier.objects\
+                                        .filter(pk__in=released)\
+                                        .values_list('delivery_point_stock')\
+                                        .annotate(released=Count('pk'))\
+                                        .order_by()
+                for stock_id, count in released_by_stock:
+                    free_identifiers[stock_id] = free_identifiers.get(stock_id, 0) + count
+            for stock_id, delta in free_identifiers.items():
+                DeliveryPointGoodStockCounter.adjust(free_identifiers=delta,
+                                                     stock_id=stock_id)
+        for item in items:
+            item._counter_snapshot = (item.quantity,
+                                      item.good_stock_identifier_id)
+        DeliveryPoint.invalidate_statistics(self.delivery_point_id,
+                                            self.choosen_delivery_point_id)
+        return len(changed)
+
     def mark_as_delivered(self, delivery_point, operator):
-        if not self.delivery_date:
-            self.delivery_date = timezone.localtime()
-            self.delivered_by = operator
-            self.delivery_point = delivery_point
-            self.save()
-        for item in self.get_items():
-            if not item.delivery_date:
-                item.delivery_date = timezone.localtime()
-            if not item.delivered_by:
-                item.delivered_by = operator
-            if not item.delivery_point:
-                item.delivery_point = delivery_point
-            item.save()
-
-    def get_returned_items_to_replace(self):
+        """
+        marks delivery and its pending items as delivered
+        (items with a single UPDATE, all in one transaction)
+        """
+        now = timezone.localtime()
+        with transaction.atomic():
+            if not self.delivery_date:
+                self.delivery_date = now
+                self.delivered_by = operator
+                self.delivery_point = delivery_point
+                self.save()
+            items = GoodDeliveryItem.objects.filter(good_delivery=self)
+            updated = _deliver_pending_items(items, now, operator,
+                                             delivery_point=Value(delivery_point.pk))
+        # update() doesn't send post_save
+        DeliveryPoint.invalidate_statistics(delivery_point.pk)
+        return updated
+
+    @classmethod
+    def bulk_mark_as_delivered(cls, deliveries, operator, msg, batch_size=None):
+        """
+        Marks waiting deliveries that can_be_marked_by_operator()
+        and their pending items as delivered, with a few queries for each batch
+        and without sending signals.
+        Every delivery gets a DELIVERED event with msg.
+
+        :type deliveries: QuerySet of GoodDelivery
+        :type operator: User
+        :type msg: String
+        :type batch_size: Int
+
+        :param deliveries: deliveries to mark (waiting ones only)
+        :param operator: user that delivers
+        :param msg: log message
+        :param batch_size: deliveries updated for each query
+
+        :return: number of delivered deliveries
+        """
+        # search module imports models
+        from . search import refresh_search_documents
+
+        batch_size = batch_size or getattr(settings, 'BULK_DELIVERY_BATCH_SIZE',
+                                           BULK_DELIVERY_BATCH_SIZE)
+        now = timezone.localtime()
+        delivery_point = Subquery(cls.objects.filter(pk=OuterRef('good_delivery'))\
+                                             .values('delivery_point')[:1])
+        # the conditions of can_be_marked_by_operator():
+        # campaign in progress, items prepared by an operator
+        # and identifiers assigned on identifiers stocks
+        items = GoodDeliveryItem.objects.filter(good_delivery=OuterRef('pk'))
+        identifiers = DeliveryPointGoodStockIdentifier.objects\
+                        .filter(delivery_point_stock__delivery_point=OuterRef(OuterRef('delivery_point')),
+                                delivery_point_stock__good=OuterRef('good'))
+        unassigned_items = items.filter(Exists(identifiers),
+                                        good_stock_identifier__isnull=True,
+                                        delivery_date__isnull=True,
+                                        return_date__isnull=True)
+        delivered = 0
+        delivery_points = set()
+        with transaction.atomic():
+            rows = list(deliveries.filter(Exists(items),
+                                          ~Exists(unassigned_items),
+                                          delivery_point__isnull=False,
+                                          delivered_by__isnull=False,
+                                          delivery_date__isnull=True,
+                                          disabled_date__isnull=True,
+                                          campaign__require_agreement=False,
+                                          campaign__date_start__lte=now,
+                                          campaign__date_end__gt=now)\
+                                  .select_for_update(of=('self',))\
+                                  .values_list('pk',
+                                               'delivery_point',
+                                               'choosen_delivery_point'))
+            for i in range(0, len(rows), batch_size):
+                batch = [row[0] for row in rows[i:i + batch_size]]
+                items = GoodDeliveryItem.objects.filter(good_delivery__in=batch)
+                _deliver_pending_items(items, now, operator,
+                                       delivery_point=delivery_point)
+                delivered += cls.objects.filter(pk__in=batch)\
+                                        .update(delivery_date=now,
+                                                modified=now)
+                cls.log_events([(cls(pk=pk), {'message': msg}) for pk in batch],
+                               GoodDeliveryEvent.DELIVERED, operator)
+                # update() skips the pre_save search document builder
+                refresh_search_documents(cls.objects.filter(pk__in=batch))
+            for row in rows: delivery_points.update(row[1:])
+        DeliveryPoint.invalidate_statistics(*delivery_points)
+        return delivered
+
+    def get_returned_items_to_replace(self, items=None):
+        """
+        returned goods not replaced yet (good -> units)
+
+        :type items: list of GoodDeliveryItem
+        :param items: delivery items, if already loaded
+        """
+        if items is None:
+            items = GoodDeliveryItem.objects.filter(good_delivery=self)\
+                                            .select_related('good__category')
         returned_good_items = {}
-        returned_items = GoodDeliveryItem.objects.filter(good_delivery=self,
-                                                         return_date__isnull=False)
-        for returned_item in returned_items:
+        for returned_item in items:
+            if not returned_item.return_date: continue
             if returned_good_items.get(returned_item.good):
                 returned_good_items[returned_item.good] += 1
             else:
                 returned_good_items[returned_item.good] = 1
-        for post_delivered in GoodDeliveryItem.objects.filter(good_delivery=self,
-                                                              create__gt=self.delivery_date):
+        for post_delivered in items:
+            if post_delivered.create <= self.delivery_date: continue
             if returned_good_items.get(post_delivered.good):
                 returned_good_items[post_delivered.good] -= 1
                 if returned_good_items[post_delivered.good] == 0:
@@ -426,6 +913,24 @@ class GoodDeliveryItem(TimeStampedModel):
     class Meta:
         verbose_name = _('Oggetto consegnato')
         verbose_name_plural = _('Oggetti consegnati')
+        indexes = [models.Index(fields=['good_delivery', 'return_date'],
+                                name='gdi_delivery_return_idx'),
+                   models.Index(fields=['good', 'good_identifier'],
+                                name='gdi_good_identifier_idx'),
+                   models.Index(fields=['delivery_point', 'delivery_date'],
+                                name='gdi_point_delivery_idx'),
+                   models.Index(fields=['returned_point', 'return_date'],
+                                name='gdi_returned_point_idx')]
+        constraints = [
+            # an identifier code only once in a good delivery
+            models.UniqueConstraint(fields=['good_delivery', 'good', 'good_identifier'],
+                                    name='gdi_delivery_good_identifier_uniq'),
+            # a stock identifier (of a campaign delivery point) assigned
+            # to one item at a time, returned items excluded
+            # (its unique index also serves assigned identifiers lookups)
+            models.UniqueConstraint(fields=['good_stock_identifier'],
+                                    condition=Q(return_date__isnull=True),
+                                    name='gdi_assigned_identifier_uniq')]
 
     def can_be_returned(self):
         if not self.good_delivery.delivery_date: return False
@@ -443,6 +948,119 @@ class GoodDeliveryItem(TimeStampedModel):
         return '{}'.format(self.good)
 
 
+class GoodDeliveryEventQuerySet(models.QuerySet):
+
+    def timeline(self, good_delivery):
+        """
+        events of a delivery, newest first
+        (gde_delivery_create_idx, users in the same query)
+        """
+        return self.filter(good_delivery=good_delivery)\
+                   .select_related('user')\
+                   .order_by('-create', '-pk')
+
+    def count_by_code(self):
+        """
+        {code: events} of the queryset
+        """
+        return dict(self.order_by()\
+                        .values_list('code')\
+                        .annotate(events=Count('pk')))
+
+
+class GoodDeliveryEvent(models.Model):
+    """
+    evento della storia di una consegna (solo inserimenti)
+    """
+    CREATED = 'created'
+    CREATED_AFTER_DISABLE = 'created_after_disable'
+    ITEMS_ADDED = 'items_added'
+    IDENTIFIERS_ASSIGNED = 'identifiers_assigned'
+    TOKEN_SENT = 'token_sent'
+    DELIVERED = 'delivered'
+    CONFIRMED = 'confirmed'
+    RESET = 'reset'
+    DISABLED = 'disabled'
+    ITEM_RETURNED = 'item_returned'
+    ITEM_REPLACED = 'item_replaced'
+    ITEM_DELETED = 'item_deleted'
+    # free text (legacy LogEntry messages)
+    NOTE = 'note'
+    CODE_CHOICES = ((CREATED, _('Creazione')),
+                    (CREATED_AFTER_DISABLE, _('Creazione dopo disabilitazione')),
+                    (ITEMS_ADDED, _('Inserimento items')),
+                    (IDENTIFIERS_ASSIGNED, _('Inserimento identificatori')),
+                    (TOKEN_SENT, _('Invio token')),
+                    (DELIVERED, _('Consegna')),
+                    (CONFIRMED, _('Conferma utente')),
+                    (RESET, _('Reset')),
+                    (DISABLED, _('Disabilitazione')),
+                    (ITEM_RETURNED, _('Restituzione bene')),
+                    (ITEM_REPLACED, _('Sostituzione bene')),
+                    (ITEM_DELETED, _('Eliminazione bene')),
+                    (NOTE, _('Nota')))
+
+    good_delivery = models.ForeignKey(GoodDelivery,
+                                      on_delete=models.CASCADE)
+    code = models.CharField(max_length=32, choices=CODE_CHOICES)
+    user = models.ForeignKey(get_user_model(),
+                             on_delete=models.SET_NULL,
+                             blank=True, null=True)
+    payload = models.JSONField(default=dict, blank=True)
+    # not auto_now_add: imported events keep their date
+    create = models.DateTimeField(default=timezone.now)
+
+    objects = GoodDeliveryEventQuerySet.as_manager()
+
+    class Meta:
+        ordering = ('-create', '-pk')
+        verbose_name = _('Evento consegna')
+        verbose_name_plural = _('Eventi consegne')
+        indexes = [models.Index(fields=['good_delivery', 'create'],
+                                name='gde_delivery_create_idx'),
+                   models.Index(fields=['code', 'create'],
+                                name='gde_code_create_idx')]
+
+    def get_message(self):
+        """
+        event description, translated when read
+        """
+        payload = self.payload
+        if self.code == self.CREATED:
+            return _("Creazione della consegna")
+        if self.code == self.CREATED_AFTER_DISABLE:
+            return _("Creazione nuova consegna in seguito a "
+                     "disabilitazione di {}").format(payload.get('previous', ''))
+        if self.code == self.ITEMS_ADDED:
+            added = ', '.join('{} x {}'.format(item['quantity'], item['good'])
+                              for item in payload.get('items', []))
+            return _("Inserimento items: {}").format(added)
+        if self.code == self.IDENTIFIERS_ASSIGNED:
+            return _("Inserimento identificatori univoci")
+        if self.code == self.TOKEN_SENT:
+            return _("Token di attivazione generato e inviato a {}").format(payload.get('email', ''))
+        if self.code == self.DELIVERED:
+            if payload.get('message'): return payload['message']
+            return _("Consegna (senza conferma da parte dell'utente) "
+                     "effettuata con successo")
+        if self.code == self.CONFIRMED:
+            return _("Consegna confermata dall'utente")
+        if self.code == self.RESET:
+            return _("Reset effettuato con successo")
+        if self.code == self.DISABLED:
+            return _("Disabilitazione effettuata successo")
+        if self.code == self.ITEM_RETURNED:
+            return _("{} restituito correttamente").format(payload.get('good', ''))
+        if self.code == self.ITEM_REPLACED:
+            return _("{} aggiunto con successo").format(payload.get('good', ''))
+        if self.code == self.ITEM_DELETED:
+            return _("{} eliminato correttamente").format(payload.get('good', ''))
+        return payload.get('message', '')
+
+    def __str__(self):
+        return '{} - {}'.format(self.good_delivery_id, self.get_code_display())
+
+
 class Agreement(TimeStampedModel):
     """
     accettazione condizioni
@@ -502,3 +1120,222 @@ class GoodDeliveryAttachment(TimeStampedModel):
 
     def __str__(self):
         return '{} - {}'.format(self.good_delivery, self.attachment)
+
+
+class OutboundMail(TimeStampedModel):
+    """
+    email in coda di invio (vedi management command process_mail_queue)
+    """
+    QUEUED = 'queued'
+    SENDING = 'sending'
+    SENT = 'sent'
+    FAILED = 'failed'
+    STATUS_CHOICES = ((QUEUED, _('In coda')),
+                      (SENDING, _('In invio')),
+                      (SENT, _('Inviata')),
+                      (FAILED, _('Non recapitabile')))
+
+    subject = models.CharField(max_length=255)
+    body = models.TextField()
+    html_body = models.TextField(blank=True, null=True)
+    from_email = models.CharField(max_length=255)
+    recipients = models.TextField(help_text=_('Indirizzi separati da virgola'))
+    status = models.CharField(max_length=8,
+                              choices=STATUS_CHOICES,
+                              default=QUEUED)
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True, null=True)
+    # taken by a process_mail_queue worker
+    claim_date = models.DateTimeField(blank=True, null=True)
+    sent_date = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        verbose_name = _('Email in uscita')
+        verbose_name_plural = _('Email in uscita')
+        indexes = [models.Index(fields=['status', 'next_attempt'])]
+
+    @classmethod
+    def enqueue(cls, mail):
+        """
+        queues a django.core.mail.EmailMessage
+        """
+        html_body = None
+        for content, mimetype in getattr(mail, 'alternatives', []):
+            if mimetype == 'text/html':
+                html_body = content
+        return cls.objects.create(subject=mail.subject,
+                                  body=mail.body,
+                                  html_body=html_body,
+                                  from_email=mail.from_email,
+                                  recipients=','.join(mail.to))
+
+    def get_email(self, connection=None):
+        mail = EmailMultiAlternatives(subject=self.subject,
+                                      body=self.body,
+                                      from_email=self.from_email,
+                                      to=self.recipients.split(','),
+                                      connection=connection)
+        if self.html_body:
+            mail.attach_alternative(self.html_body, 'text/html')
+        return mail
+
+    def __str__(self):
+        return '{} - {}'.format(self.recipients, self.subject)
+
+
+def _background_job_upload(instance, filename):
+    """
+    background jobs input and result files location
+    """
+    return os.path.join('background_jobs',
+                        timezone.localtime().strftime('%Y/%m/%d'),
+                        filename)
+
+
+class BackgroundJob(TimeStampedModel):
+    """
+    import/export eseguito in background
+    (vedi management command run_background_jobs)
+    """
+    IMPORT_STOCK_IDENTIFIERS = 'import_stock_identifiers'
+    EXPORT_WAITING_DELIVERIES = 'export_waiting_deliveries'
+    SEND_DELIVERY_TOKENS = 'send_delivery_tokens'
+    KIND_CHOICES = ((IMPORT_STOCK_IDENTIFIERS, _('Importazione identificativi prodotti')),
+                    (EXPORT_WAITING_DELIVERIES, _('Esportazione consegne pendenti')),
+                    (SEND_DELIVERY_TOKENS, _('Invio token di attivazione consegne')))
+
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = ((QUEUED, _('In coda')),
+                      (RUNNING, _('In esecuzione')),
+                      (DONE, _('Completato')),
+                      (FAILED, _('Fallito')))
+
+    kind = models.CharField(max_length=32, choices=KIND_CHOICES)
+    status = models.CharField(max_length=8,
+                              choices=STATUS_CHOICES,
+                              default=QUEUED)
+    params = models.JSONField(default=dict, blank=True)
+    input_file = models.FileField(upload_to=_background_job_upload,
+                                  null=True, blank=True,
+                                  max_length=255)
+    result_file = models.FileField(upload_to=_background_job_upload,
+                                   null=True, blank=True,
+                                   max_length=255)
+    progress = models.PositiveIntegerField(default=0)
+    total = models.PositiveIntegerField(blank=True, null=True)
+    result_message = models.TextField(blank=True, null=True)
+    created_by = models.ForeignKey(get_user_model(),
+                                   on_delete=models.SET_NULL,
+                                   blank=True, null=True)
+    start_date = models.DateTimeField(blank=True, null=True)
+    end_date = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        ordering = ('-create',)
+        verbose_name = _('Attività in background')
+        verbose_name_plural = _('Attività in background')
+        indexes = [models.Index(fields=['status', 'create'],
+                                name='bgjob_status_create_idx')]
+
+    @classmethod
+    def enqueue(cls, kind, user=None, params=None, input_file=None):
+        """
+        queues a job, executed by the first free worker
+        """
+        return cls.objects.create(kind=kind,
+                                  params=params or {},
+                                  input_file=input_file,
+                                  created_by=user)
+
+    def set_progress(self, progress, total=None):
+        """
+        saves progress without touching other fields
+        (workers report it while the job runs)
+        """
+        self.progress = progress
+        fields = {'progress': progress, 'modified': timezone.now()}
+        if total is not None:
+            self.total = total
+            fields['total'] = total
+        BackgroundJob.objects.filter(pk=self.pk).update(**fields)
+
+    def heartbeat(self):
+        """
+        tells the stale jobs reclaim (jobs.requeue_stale_jobs)
+        that the worker is still running the job
+        """
+        BackgroundJob.objects.filter(pk=self.pk).update(modified=timezone.now())
+
+    def get_progress_percentage(self):
+        if self.status == self.DONE: return 100
+        if not self.total: return None
+        return min(100, int(self.progress * 100 / self.total))
+
+    def is_finished(self):
+        return self.status in (self.DONE, self.FAILED)
+
+    def __str__(self):
+        return '{} - {}'.format(self.get_kind_display(), self.get_status_display())
+
+
+def _archive_upload(instance, filename):
+    """
+    archived campaigns bundles location
+    """
+    return os.path.join('archives', filename)
+
+
+class ArchivedCampaign(TimeStampedModel):
+    """
+    campagna archiviata: consegne, beni, identificativi ed eventi
+    sono nel bundle JSON Lines compresso (vedi archive.py)
+    """
+    campaign_pk = models.PositiveIntegerField(unique=True)
+    name = models.CharField(max_length=255)
+    slug = models.SlugField(max_length=255, unique=True)
+    date_start = models.DateTimeField()
+    date_end = models.DateTimeField()
+    bundle = models.FileField(upload_to=_archive_upload, max_length=255)
+    deliveries = models.PositiveIntegerField(default=0)
+    items = models.PositiveIntegerField(default=0)
+    events = models.PositiveIntegerField(default=0)
+    archived_by = models.ForeignKey(get_user_model(),
+                                    on_delete=models.SET_NULL,
+                                    blank=True, null=True)
+
+    class Meta:
+        ordering = ('-date_end',)
+        verbose_name = _('Campagna archiviata')
+        verbose_name_plural = _('Campagne archiviate')
+
+    def __str__(self):
+        return '{}'.format(self.name)
+
+
+class ArchivedGoodDelivery(models.Model):
+    """
+    consegna di una campagna archiviata, per le verifiche
+    (chi ha ricevuto cosa) senza leggere il bundle
+    """
+    archive = models.ForeignKey(ArchivedCampaign,
+                                on_delete=models.CASCADE)
+    good_delivery_pk = models.PositiveIntegerField()
+    delivered_to = models.ForeignKey(get_user_model(),
+                                     on_delete=models.PROTECT)
+    delivery_date = models.DateTimeField(blank=True, null=True)
+    disabled_date = models.DateTimeField(blank=True, null=True)
+    # delivered goods identifiers codes
+    identifiers = models.JSONField(default=list, blank=True)
+
+    class Meta:
+        verbose_name = _('Consegna archiviata')
+        verbose_name_plural = _('Consegne archiviate')
+        indexes = [models.Index(fields=['good_delivery_pk'],
+                                name='agd_good_delivery_idx')]
+
+    def __str__(self):
+        return '{} - {}'.format(self.archive, self.delivered_to)
@@ -0,0 +1,98 @@
+import datetime
+import hashlib
+
+from django.conf import settings
+from django.core import signing
+from django.core.cache import cache
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+
+from . settings import (KEYSET_PAGE_MAX_SIZE,
+                        KEYSET_COUNT_CACHE_TTL)
+
+
+CURSOR_SALT = 'good_delivery.pagination.cursor'
+
+
+class InvalidCursor(Exception):
+    pass
+
+
+def encode_cursor(obj):
+    """
+    opaque (signed) cursor pointing after obj
+    """
+    return signing.dumps([obj.create.isoformat(), obj.pk],
+                         salt=CURSOR_SALT, compress=True)
+
+
+def decode_cursor(cursor):
+    try:
+        create, pk = signing.loads(cursor, salt=CURSOR_SALT)
+    except (signing.BadSignature, TypeError, ValueError):
+        raise InvalidCursor(cursor)
+    create = parse_datetime(create or '')
+    if not create: raise InvalidCursor(cursor)
+    return create, pk
+
+
+def get_approximate_count(queryset):
+    """
+    queryset count, cached for KEYSET_COUNT_CACHE_TTL seconds
+    """
+    # values('pk') leaves out annotations (e.g. with_state() subqueries)
+    queryset = queryset.values('pk')
+    sql, params = queryset.query.sql_with_params()
+    digest = hashlib.md5('{}{}'.format(sql, params).encode()).hexdigest()
+    key = 'good_delivery:count:{}'.format(digest)
+    count = cache.get(key)
+    if count is None:
+        count = queryset.count()
+        cache.set(key, count,
+                  getattr(settings, 'KEYSET_COUNT_CACHE_TTL', KEYSET_COUNT_CACHE_TTL))
+    return count
+
+
+def keyset_paginate(queryset, cursor=None, size=10):
+    """
+    page of queryset ordered by (create, pk), starting after cursor.
+    Every page costs as the first one (no OFFSET)
+
+    :type queryset: QuerySet (with create field)
+    :type cursor: String
+    :type size: Int
+
+    :param queryset: objects to paginate
+    :param cursor: cursor returned with previous page
+    :param size: page size
+
+    :return: (objects list, next page cursor or None)
+    """
+    max_size = getattr(settings, 'KEYSET_PAGE_MAX_SIZE', KEYSET_PAGE_MAX_SIZE)
+    size = max(1, min(size, max_size))
+    queryset = queryset.order_by('create', 'pk')
+    if cursor:
+        create, pk = decode_cursor(cursor)
+        queryset = queryset.filter(Q(create__gt=create) |
+                                   Q(create=create, pk__gt=pk))
+    objects = list(queryset[:size + 1])
+    next_cursor = encode_cursor(objects[size - 1]) if len(objects) > size else None
+    return objects[:size], next_cursor
+
+
+def get_row_data(obj, columns):
+    """
+    obj columns values as strings (as datatables rows)
+    """
+    row = []
+    for column in columns:
+        value = getattr(obj, column)
+        if not value:
+            row.append('')
+        elif isinstance(value, datetime.datetime):
+            row.append(value.strftime(settings.DEFAULT_DATETIME_FORMAT))
+        elif isinstance(value, datetime.date):
+            row.append(value.strftime(settings.DEFAULT_DATE_FORMAT))
+        else:
+            row.append(value.__str__())
+    return row
@@ -0,0 +1,106 @@
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+
+from . models import DeliveryPoint, OperatorDeliveryPoint
+from . settings import OPERATOR_GRANTS_CACHE_TTL
+
+
+# grants are cached with the versions they were built from:
+# the global version changes with delivery points and campaigns,
+# the user one with user OperatorDeliveryPoint rows
+GRANTS_VERSION_KEY = 'good_delivery:grants:version'
+USER_GRANTS_VERSION_KEY = 'good_delivery:grants:version:{}'
+
+
+def _get_versions(keys):
+    versions = cache.get_many(keys)
+    for key in keys:
+        if key in versions: continue
+        cache.add(key, uuid.uuid4().hex, None)
+        versions[key] = cache.get(key)
+    return [versions[key] for key in keys]
+
+
+def invalidate_grants(user_id=None):
+    """
+    invalidates cached grants of a user (or of all users)
+    """
+    key = USER_GRANTS_VERSION_KEY.format(user_id) if user_id else GRANTS_VERSION_KEY
+    cache.set(key, uuid.uuid4().hex, None)
+
+
+class OperatorGrants:
+    """
+    delivery points (with campaigns) an operator manages
+    and multi_tenant flags, loaded with one query
+    """
+    def __init__(self, user):
+        self.is_superuser = user.is_superuser
+        # delivery point id -> (DeliveryPoint, multi_tenant)
+        self.points = {}
+        if user.is_superuser:
+            for delivery_point in DeliveryPoint.objects.select_related('campaign'):
+                self.points[delivery_point.pk] = (delivery_point, True)
+            return
+        operator_points = OperatorDeliveryPoint.objects.filter(operator=user,
+                                                               is_active=True)\
+                                                       .select_related('delivery_point__campaign')
+        for operator_point in operator_points:
+            self.points[operator_point.delivery_point_id] = (operator_point.delivery_point,
+                                                             operator_point.multi_tenant)
+
+    def get_active_delivery_points(self):
+        """
+        active delivery points of active campaigns (@is_operator)
+        """
+        return [delivery_point for delivery_point, multi_tenant in self.points.values()
+                if delivery_point.is_active and delivery_point.campaign.is_active]
+
+    def get_campaign(self, slug):
+        """
+        active campaign with slug, if operator has one of its points
+        """
+        for delivery_point, multi_tenant in self.points.values():
+            campaign = delivery_point.campaign
+            if campaign.slug == slug and campaign.is_active:
+                return campaign
+
+    def get_campaign_delivery_points(self, campaign):
+        """
+        active delivery points of campaign (@is_campaign_operator)
+        """
+        return tuple(delivery_point for delivery_point, multi_tenant in self.points.values()
+                     if delivery_point.campaign_id == campaign.pk and delivery_point.is_active)
+
+    def get_delivery_point(self, campaign, delivery_point_id):
+        """
+        (active delivery point, multi_tenant) of campaign, or (None, False)
+        """
+        delivery_point, multi_tenant = self.points.get(delivery_point_id, (None, False))
+        if delivery_point and delivery_point.campaign_id == campaign.pk and delivery_point.is_active:
+            return delivery_point, multi_tenant
+        return None, False
+
+
+def get_operator_grants(request):
+    """
+    request user grants: memoized on request (stacked decorators)
+    and cached until they change (OPERATOR_GRANTS_CACHE_TTL at most)
+    """
+    grants = getattr(request, '_operator_grants', None)
+    if grants: return grants
+    user = request.user
+    versions = _get_versions([GRANTS_VERSION_KEY,
+                              USER_GRANTS_VERSION_KEY.format(user.pk)])
+    key = 'good_delivery:grants:{}:{}:{}:{}'.format(user.pk,
+                                                    int(user.is_superuser),
+                                                    *versions)
+    grants = cache.get(key)
+    if grants is None:
+        grants = OperatorGrants(user)
+        cache.set(key, grants,
+                  getattr(settings, 'OPERATOR_GRANTS_CACHE_TTL', OPERATOR_GRANTS_CACHE_TTL))
+    request._operator_grants = grants
+    return grants
@@ -0,0 +1,185 @@
+import re
+
+from django.contrib.auth import get_user_model
+from django.db import connections
+from django.db.models import BooleanField, Q
+from django.db.models.expressions import RawSQL
+
+from . models import DeliveryPoint, GoodDelivery
+
+
+SEARCH_DOCUMENT_SQLITE_TABLE = 'good_delivery_gooddelivery_search'
+
+
+def _word_similar(text):
+    """
+    PostgreSQL pg_trgm word similarity (fuzzy match, uses trigram index).
+    Built here, not registered as a TextField lookup:
+    other backends don't have the %> operator
+    """
+    sql = '"{}"."search_document" %%> %s'.format(GoodDelivery._meta.db_table)
+    return RawSQL(sql, [text], output_field=BooleanField())
+
+
+# GoodDelivery fields the search document is built from
+SEARCH_DOCUMENT_SOURCES = ('delivered_to_id',
+                           'choosen_delivery_point_id',
+                           'delivery_point_id',
+                           'notes')
+
+
+def build_search_document(good_delivery):
+    """
+    lowercase text searched by datatables search box.
+    Related objects already loaded (select_related) are used,
+    the missing ones are read with one query for users
+    and one for delivery points
+    """
+    values = []
+    if GoodDelivery.delivered_to.is_cached(good_delivery):
+        user = good_delivery.delivered_to
+        user = (user.username, user.first_name, user.last_name) if user else ()
+    else:
+        user = get_user_model().objects.filter(pk=good_delivery.delivered_to_id)\
+                                       .values_list('username', 'first_name', 'last_name')\
+                                       .first() if good_delivery.delivered_to_id else ()
+    values.extend(user or ())
+    names = {}
+    missing = []
+    for field in ('choosen_delivery_point', 'delivery_point'):
+        if getattr(GoodDelivery, field).is_cached(good_delivery):
+            delivery_point = getattr(good_delivery, field)
+            if delivery_point: names[delivery_point.pk] = delivery_point.name
+        elif getattr(good_delivery, '{}_id'.format(field)):
+            missing.append(getattr(good_delivery, '{}_id'.format(field)))
+    if missing:
+        names.update(DeliveryPoint.objects.filter(pk__in=missing)\
+                                          .values_list('pk', 'name'))
+    for delivery_point_id in (good_delivery.choosen_delivery_point_id,
+                              good_delivery.delivery_point_id):
+        if delivery_point_id: values.append(names.get(delivery_point_id))
+    values.append(good_delivery.notes)
+    return ' '.join(v for v in values if v).lower()
+
+
+def install_sqlite_search_index(using='default'):
+    """
+    creates (if missing) the SQLite FTS5 table of search documents
+    and the triggers that keep it updated.
+    Run after every migrate: SQLite alter table (remake) drops triggers
+    """
+    sqlite_connection = connections[using]
+    if sqlite_connection.vendor != 'sqlite': return
+    table = GoodDelivery._meta.db_table
+    fts = SEARCH_DOCUMENT_SQLITE_TABLE
+    triggers = {
+        '{}_insert'.format(fts):
+            'AFTER INSERT ON {table} BEGIN '
+            'INSERT INTO {fts}(rowid, search_document) '
+            'VALUES (new.id, new.search_document); END',
+        '{}_delete'.format(fts):
+            'AFTER DELETE ON {table} BEGIN '
+            'INSERT INTO {fts}({fts}, rowid, search_document) '
+            'VALUES (\'delete\', old.id, old.search_document); END',
+        '{}_update'.format(fts):
+            'AFTER UPDATE OF search_document ON {table} BEGIN '
+            'INSERT INTO {fts}({fts}, rowid, search_document) '
+            'VALUES (\'delete\', old.id, old.search_document); '
+            'INSERT INTO {fts}(rowid, search_document) '
+            'VALUES (new.id, new.search_document); END',
+    }
+    with sqlite_connection.cursor() as cursor:
+        cursor.execute("SELECT name FROM sqlite_master WHERE type='trigger'")
+        existent = {row[0] for row in cursor.fetchall()}
+        if set(triggers).issubset(existent): return
+        cursor.execute('CREATE VIRTUAL TABLE IF NOT EXISTS {fts} '
+                       'USING fts5(search_document, content={table}, '
+                       'content_rowid=id)'.format(fts=fts, table=table))
+        for name, sql in triggers.items():
+            cursor.execute('CREATE TRIGGER IF NOT EXISTS {} {}'.format(name,
+                           sql.format(fts=fts, table=table)))
+        cursor.execute("INSERT INTO {fts}({fts}) VALUES ('rebuild')".format(fts=fts))
+
+
+def refresh_search_documents(deliveries, batch_size=500):
+    """
+    rebuilds search documents of deliveries
+    (when users or delivery points names change)
+    """
+    deliveries = deliveries.select_related('delivered_to',
+                                           'choosen_delivery_point',
+                                           'delivery_point')
+    to_update = []
+    for good_delivery in deliveries.iterator(chunk_size=batch_size):
+        document = build_search_document(good_delivery)
+        if document == good_delivery.search_document: continue
+        good_delivery.search_document = document
+        to_update.append(good_delivery)
+    GoodDelivery.objects.bulk_update(to_update, ['search_document'],
+                                     batch_size=batch_size)
+    return len(to_update)
+
+
+def _fts_query(text):
+    # every word is a quoted prefix query
+    words = re.findall(r'\w+', text)
+    return ' '.join('"{}"*'.format(word) for word in words)
+
+
+def search_deliveries(deliveries, text):
+    """
+    filters deliveries whose search document matches text,
+    through the index available on current database:
+    PostgreSQL trigram index (substring and fuzzy match),
+    SQLite FTS5 table (words prefix match)
+    """
+    text = text.strip().lower()
+    if not text: return deliveries
+    vendor = connections[deliveries.db].vendor
+    if vendor == 'postgresql':
+        return deliveries.filter(search_document__contains=text) | \
+               deliveries.filter(_word_similar(text))
+    if vendor == 'sqlite':
+        query = _fts_query(text)
+        if not query: return deliveries.none()
+        sql = 'SELECT rowid FROM {} WHERE {} MATCH %s'.format(SEARCH_DOCUMENT_SQLITE_TABLE,
+                                                              SEARCH_DOCUMENT_SQLITE_TABLE)
+        return deliveries.filter(pk__in=RawSQL(sql, [query]))
+    return deliveries.filter(search_document__contains=text)
+
+
+def get_user_search_fields():
+    """
+    user fields searched by prefix (taxpayer_id only
+    exists on custom user models), PostgreSQL indexes
+    on them are created by migration 0056
+    """
+    user_fields = {field.name for field in get_user_model()._meta.get_fields()}
+    return [field for field in ('username', 'taxpayer_id', 'last_name', 'first_name')
+            if field in user_fields]
+
+
+def search_users(users, text):
+    """
+    filters users with every word of text as prefix
+    of username, taxpayer id, last name or first name
+    """
+    words = text.split()
+    if not words: return users
+    fields = get_user_search_fields()
+    for word in words:
+        condition = Q()
+        for field in fields:
+            condition |= Q(**{'{}__istartswith'.format(field): word})
+        users = users.filter(condition)
+    return users
+
+
+def get_user_label(user):
+    """
+    user description in recipient choices
+    """
+    name = ' '.join(v for v in (user.last_name, user.first_name) if v)
+    taxpayer_id = getattr(user, 'taxpayer_id', None)
+    details = ', '.join(v for v in (user.username, taxpayer_id) if v)
+    return '{} ({})'.format(name, details) if name else details
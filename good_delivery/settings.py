@@ -4,6 +4,52 @@ from django.utils.translation import gettext_lazy as _
 GOOD_DELIVERY_ITEMS_FORMS_PREFIX = "form"
 GOOD_STOCK_FORMS_PREFIX = "stock"
 
+# operator dashboard counters cache (seconds)
+DELIVERY_POINT_STATISTICS_CACHE_TTL = 30
+# operators grants cache (seconds),
+# invalidated when delivery points or operators change
+OPERATOR_GRANTS_CACHE_TTL = 300
+
+# stocks with more free identifiers than this are searched
+# in items forms by autocomplete (operator_stock_identifiers)
+IDENTIFIERS_AUTOCOMPLETE_THRESHOLD = 100
+IDENTIFIERS_AUTOCOMPLETE_PAGE_SIZE = 20
+# new delivery recipient is searched by autocomplete (operator_users),
+# shorter texts return no users
+USERS_AUTOCOMPLETE_MIN_LENGTH = 3
+USERS_AUTOCOMPLETE_PAGE_SIZE = 20
+
+# datatables keyset pagination (?pagination=keyset)
+KEYSET_PAGE_MAX_SIZE = 100
+# cache of approximate total counts (seconds)
+KEYSET_COUNT_CACHE_TTL = 60
+
+# deliveries marked as delivered for each query
+# (GoodDelivery.bulk_mark_as_delivered)
+BULK_DELIVERY_BATCH_SIZE = 500
+
+# stock identifiers CSV import, rows for each transaction
+IMPORT_CHUNK_SIZE = 1000
+# waiting deliveries exports, rows fetched (and streamed) each time
+EXPORT_CHUNK_SIZE = 2000
+# campaigns archival, rows read (and inserted on restore) each time
+ARCHIVE_CHUNK_SIZE = 2000
+
+# running background jobs without progress (or heartbeat)
+# for these seconds are considered dead and queued again
+BACKGROUND_JOB_STALE_TIMEOUT = 900
+
+# outbound emails are queued in database
+# and sent by "manage.py process_mail_queue"
+MAIL_QUEUE_ENABLED = True
+MAIL_QUEUE_BATCH_SIZE = 50
+MAIL_QUEUE_MAX_ATTEMPTS = 5
+# seconds, doubled on every failed attempt
+MAIL_QUEUE_RETRY_BACKOFF = 60
+# seconds after which emails claimed by a dead worker
+# (still "sending") are queued again
+MAIL_QUEUE_CLAIM_TIMEOUT = 600
+
 
 # E-mail messages
 MSG_HEADER = _("""<div>Gentile {user},<br>
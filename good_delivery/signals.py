@@ -0,0 +1,231 @@
+from django.db import transaction
+from django.db.models import Sum
+from django.contrib.auth import get_user_model
+from django.db.models.signals import (post_delete, post_init,
+                                      post_migrate, post_save, pre_save)
+from django.dispatch import receiver
+
+from . models import *
+from . permissions import invalidate_grants
+from . search import (SEARCH_DOCUMENT_SOURCES,
+                      build_search_document,
+                      install_sqlite_search_index,
+                      refresh_search_documents)
+
+
+# DeliveryPointGoodStockCounter maintenance
+# and DeliveryPoint.get_statistics() cache invalidation
+#
+# delivered_quantity counts the items of deliveries made in the stock
+# delivery point, free_identifiers the stock identifiers not assigned
+# to any item. Returned items keep their identifier and still count
+# as handed out, as get_available_items() always did, so a return
+# doesn't change any counter.
+
+
+@receiver(post_init, sender=GoodDeliveryItem)
+def good_delivery_item_snapshot(sender, instance, **kwargs):
+    # read from __dict__ to not trigger deferred fields loading
+    instance._counter_snapshot = (instance.__dict__.get('quantity'),
+                                  instance.__dict__.get('good_stock_identifier_id'))
+
+
+def _invalidate_item_statistics(instance):
+    if GoodDeliveryItem.good_delivery.is_cached(instance):
+        choosen_delivery_point = instance.good_delivery.choosen_delivery_point_id
+    else:
+        # the good delivery could be already deleted (CASCADE)
+        choosen_delivery_point = GoodDelivery.objects.filter(pk=instance.good_delivery_id)\
+                                                     .values_list('choosen_delivery_point', flat=True)\
+                                                     .first()
+    DeliveryPoint.invalidate_statistics(instance.delivery_point_id,
+                                        instance.returned_point_id,
+                                        choosen_delivery_point)
+
+
+@receiver(post_save, sender=GoodDeliveryItem)
+def good_delivery_item_update_counters(sender, instance, created, **kwargs):
+    old_quantity, old_identifier = (0, None) if created else instance._counter_snapshot
+    quantity = instance.quantity - (old_quantity or 0)
+    with transaction.atomic():
+        if quantity:
+            DeliveryPointGoodStockCounter.adjust(delivered_quantity=quantity,
+                                                 stock__good_id=instance.good_id,
+                                                 stock__delivery_point__delivered_point=instance.good_delivery_id)
+        if old_identifier != instance.good_stock_identifier_id:
+            if old_identifier:
+                DeliveryPointGoodStockCounter.adjust(free_identifiers=1,
+                                                     stock__deliverypointgoodstockidentifier=old_identifier)
+            if instance.good_stock_identifier_id:
+                DeliveryPointGoodStockCounter.adjust(free_identifiers=-1,
+                                                     stock__deliverypointgoodstockidentifier=instance.good_stock_identifier_id)
+    instance._counter_snapshot = (instance.quantity,
+                                  instance.good_stock_identifier_id)
+    _invalidate_item_statistics(instance)
+
+
+@receiver(post_delete, sender=GoodDeliveryItem)
+def good_delivery_item_delete_counters(sender, instance, **kwargs):
+    with transaction.atomic():
+        DeliveryPointGoodStockCounter.adjust(delivered_quantity=-instance.quantity,
+                                             stock__good_id=instance.good_id,
+                                             stock__delivery_point__delivered_point=instance.good_delivery_id)
+        if instance.good_stock_identifier_id:
+            DeliveryPointGoodStockCounter.adjust(free_identifiers=1,
+                                                 stock__deliverypointgoodstockidentifier=instance.good_stock_identifier_id)
+    _invalidate_item_statistics(instance)
+
+
+@receiver(post_init, sender=GoodDelivery)
+def good_delivery_snapshot(sender, instance, **kwargs):
+    instance._counter_snapshot = instance.__dict__.get('delivery_point_id')
+    instance._search_snapshot = _search_sources(instance)
+
+
+def _move_delivery_counters(instance, old_delivery_point):
+    # delivery moved to another delivery point:
+    # move its items quantities to the new delivery point stocks
+    quantities = GoodDeliveryItem.objects.filter(good_delivery=instance)\
+                                         .values('good')\
+                                         .annotate(total=Sum('quantity'))
+    with transaction.atomic():
+        for row in quantities:
+            if old_delivery_point:
+                DeliveryPointGoodStockCounter.adjust(delivered_quantity=-row['total'],
+                                                     stock__good_id=row['good'],
+                                                     stock__delivery_point_id=old_delivery_point)
+            if instance.delivery_point_id:
+                DeliveryPointGoodStockCounter.adjust(delivered_quantity=row['total'],
+                                                     stock__good_id=row['good'],
+                                                     stock__delivery_point_id=instance.delivery_point_id)
+
+
+@receiver(post_save, sender=GoodDelivery)
+def good_delivery_saved(sender, instance, created, **kwargs):
+    old_delivery_point = instance._counter_snapshot
+    instance._counter_snapshot = instance.delivery_point_id
+    if not created and old_delivery_point != instance.delivery_point_id:
+        _move_delivery_counters(instance, old_delivery_point)
+    DeliveryPoint.invalidate_statistics(old_delivery_point,
+                                        instance.delivery_point_id,
+                                        instance.choosen_delivery_point_id,
+                                        instance.disabled_point_id)
+
+
+@receiver(post_delete, sender=GoodDelivery)
+def good_delivery_deleted(sender, instance, **kwargs):
+    DeliveryPoint.invalidate_statistics(instance.delivery_point_id,
+                                        instance.choosen_delivery_point_id,
+                                        instance.disabled_point_id)
+
+
+@receiver(post_save, sender=DeliveryPointGoodStock)
+def stock_create_counter(sender, instance, created, **kwargs):
+    if created:
+        DeliveryPointGoodStockCounter.objects.get_or_create(stock=instance)
+
+
+@receiver(post_save, sender=DeliveryPointGoodStockIdentifier)
+def stock_identifier_create_counters(sender, instance, created, **kwargs):
+    if created:
+        DeliveryPointGoodStockCounter.adjust(identifiers=1,
+                                             free_identifiers=1,
+                                             stock_id=instance.delivery_point_stock_id)
+
+
+@receiver(post_delete, sender=DeliveryPointGoodStockIdentifier)
+def stock_identifier_delete_counters(sender, instance, **kwargs):
+    # items using this identifier are deleted (CASCADE) before it
+    # and have already given it back to free_identifiers
+    DeliveryPointGoodStockCounter.adjust(identifiers=-1,
+                                         free_identifiers=-1,
+                                         stock_id=instance.delivery_point_stock_id)
+
+
+# operators grants cache invalidation (permissions.get_operator_grants)
+#
+# versions are bumped now and again after commit: grants
+# read by other requests while the transaction runs are not kept
+
+
+def _invalidate_grants(user_id=None):
+    invalidate_grants(user_id)
+    transaction.on_commit(lambda: invalidate_grants(user_id))
+
+
+@receiver(post_save, sender=OperatorDeliveryPoint)
+@receiver(post_delete, sender=OperatorDeliveryPoint)
+def operator_delivery_point_invalidate_grants(sender, instance, **kwargs):
+    _invalidate_grants(instance.operator_id)
+
+
+@receiver(post_save, sender=DeliveryPoint)
+@receiver(post_delete, sender=DeliveryPoint)
+@receiver(post_save, sender=DeliveryCampaign)
+@receiver(post_delete, sender=DeliveryCampaign)
+def delivery_point_invalidate_grants(sender, instance, **kwargs):
+    _invalidate_grants()
+
+
+# GoodDelivery.search_document maintenance
+
+
+def _search_sources(instance):
+    # read from __dict__ to not trigger deferred fields loading
+    return tuple(instance.__dict__.get(field) for field in SEARCH_DOCUMENT_SOURCES)
+
+
+@receiver(pre_save, sender=GoodDelivery)
+def good_delivery_search_document(sender, instance, update_fields=None, **kwargs):
+    # rebuilt only when its source fields change
+    instance._search_document_changed = False
+    sources = _search_sources(instance)
+    if instance.pk and instance.search_document and \
+       sources == instance._search_snapshot: return
+    document = build_search_document(instance)
+    instance._search_document_changed = document != instance.search_document
+    instance.search_document = document
+
+
+@receiver(post_save, sender=GoodDelivery)
+def good_delivery_save_search_document(sender, instance, update_fields=None, **kwargs):
+    # update_fields without search_document (pre_save can't add it)
+    if instance._search_document_changed and update_fields and \
+       'search_document' not in update_fields:
+        GoodDelivery.objects.filter(pk=instance.pk)\
+                            .update(search_document=instance.search_document)
+    instance._search_snapshot = _search_sources(instance)
+
+
+@receiver(post_init, sender=get_user_model())
+def user_search_snapshot(sender, instance, **kwargs):
+    instance._search_snapshot = (instance.__dict__.get('username'),
+                                 instance.__dict__.get('first_name'),
+                                 instance.__dict__.get('last_name'))
+
+
+@receiver(post_save, sender=get_user_model())
+def user_refresh_search_documents(sender, instance, created, **kwargs):
+    snapshot = (instance.username, instance.first_name, instance.last_name)
+    if not created and snapshot != instance._search_snapshot:
+        refresh_search_documents(GoodDelivery.objects.filter(delivered_to=instance))
+    instance._search_snapshot = snapshot
+
+
+@receiver(post_init, sender=DeliveryPoint)
+def delivery_point_search_snapshot(sender, instance, **kwargs):
+    instance._search_snapshot = instance.__dict__.get('name')
+
+
+@receiver(post_save, sender=DeliveryPoint)
+def delivery_point_refresh_search_documents(sender, instance, created, **kwargs):
+    if not created and instance.name != instance._search_snapshot:
+        refresh_search_documents(GoodDelivery.objects.filter(Q(choosen_delivery_point=instance) |
+                                                             Q(delivery_point=instance)))
+    instance._search_snapshot = instance.name
+
+
+@receiver(post_migrate)
+def install_search_index(sender, using='default', **kwargs):
+    if sender.name == 'good_delivery':
+        install_sqlite_search_index(using=using)
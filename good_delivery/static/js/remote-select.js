@@ -0,0 +1,65 @@
+// select elements with data-remote-url attribute:
+// options are searched by the JSON endpoint
+// ({"results": [{"id": ..., "text": ...}], "more": bool, "next": cursor})
+// while the operator types in a search input.
+// Choosing the "..." option loads the next page (?after=next)
+function remoteSelect(select){
+    var search = document.createElement('input');
+    search.type = 'search';
+    search.className = 'form-control mb-2';
+    search.placeholder = select.dataset.placeholder || '';
+    select.parentNode.insertBefore(search, select);
+
+    var more = null;
+    var selected = select.value;
+
+    function load(after){
+        var url = select.dataset.remoteUrl + '?q=' + encodeURIComponent(search.value);
+        if (after) url += '&after=' + encodeURIComponent(after);
+        return fetch(url, {credentials: 'same-origin'})
+            .then(function(response){ return response.json(); })
+            .then(function(data){
+                if (more) more.remove();
+                more = null;
+                data.results.forEach(function(result){
+                    if (result.id == selected) return;
+                    select.add(new Option(result.text, result.id));
+                });
+                if (data.more) {
+                    more = new Option('...', '');
+                    more.dataset.after = data.next || '';
+                    // without a cursor the next page can't be requested
+                    more.disabled = !data.next;
+                    select.add(more);
+                }
+            });
+    }
+
+    var timeout = null;
+    search.addEventListener('input', function(){
+        clearTimeout(timeout);
+        timeout = setTimeout(function(){
+            // keep empty (first) and selected options
+            Array.from(select.options).forEach(function(option, index){
+                if (index && (!option.value || option.value != selected)) option.remove();
+            });
+            more = null;
+            load();
+        }, 300);
+    });
+
+    select.addEventListener('change', function(){
+        if (more && select.selectedOptions[0] === more) {
+            var after = more.dataset.after;
+            more.disabled = true;
+            select.value = selected;
+            load(after);
+            return;
+        }
+        selected = select.value;
+    });
+}
+
+document.addEventListener('DOMContentLoaded', function(){
+    document.querySelectorAll('select[data-remote-url]').forEach(remoteSelect);
+});
@@ -30,6 +30,8 @@ def settings_value(name, **kwargs):
 def markdown(value):
     return md.markdown(value, extensions=['markdown.extensions.fenced_code'])
 
+# deprecated: delivery events templates don't use it
+# anymore, kept for projects templates that do
 @register.simple_tag
 def user_from_pk(user_id):
     if not user_id: return False
@@ -40,5 +42,6 @@ def user_from_pk(user_id):
 
 @register.simple_tag
 def user_good_deliveries(user):
-    return GoodDelivery.objects.filter(delivered_to=user,
+    return GoodDelivery.objects.with_state()\
+                               .filter(delivered_to=user,
                                        campaign__is_active=True)
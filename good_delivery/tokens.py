@@ -0,0 +1,201 @@
+import json
+import logging
+import os
+
+from concurrent.futures import ProcessPoolExecutor
+
+from django.conf import settings
+from django.core.mail import get_connection
+from django.db import transaction
+from django.db.models import Exists, OuterRef
+from django.utils import timezone
+from django.utils.translation import gettext as _
+
+from . jwts import encrypt_to_jwe
+from . models import GoodDelivery, GoodDeliveryEvent, GoodDeliveryItem
+from . utils import build_custom_mail
+
+
+logger = logging.getLogger(__name__)
+
+
+def get_token_mail(good_delivery, token, uri, msg=''):
+    """
+    returns send_custom_mail() arguments of the email
+    with the good_delivery activation URL
+    """
+    mail_params = {'hostname': settings.HOSTNAME,
+                   'user': good_delivery.delivered_to,
+                   'url': '{}?token={}'.format(uri, token),
+                   'added_text': msg
+                  }
+    return {'subject': _('{} - {}').format(settings.HOSTNAME, good_delivery),
+            'recipients': [good_delivery.delivered_to],
+            'body': settings.NEW_DELIVERY_WITH_TOKEN_CREATED,
+            'params': mail_params}
+
+
+def get_deliveries_to_notify(campaign, delivery_point=None):
+    """
+    waiting good deliveries (items inserted by operator)
+    that users can confirm by token
+    """
+    items = GoodDeliveryItem.objects.filter(good_delivery=OuterRef('pk'))
+    deliveries = GoodDelivery.objects.filter(campaign=campaign,
+                                             delivery_point__isnull=False,
+                                             delivered_by__isnull=False,
+                                             delivery_date__isnull=True,
+                                             disabled_date__isnull=True)\
+                                     .filter(Exists(items))\
+                                     .exclude(delivered_to__email='')\
+                                     .exclude(delivered_to__email__isnull=True)\
+                                     .select_related('campaign', 'delivered_to')\
+                                     .order_by('pk')
+    if delivery_point:
+        deliveries = deliveries.filter(delivery_point=delivery_point)
+    return deliveries
+
+
+def exclude_notified_since(deliveries, date):
+    """
+    deliveries without a token sent from date
+    (TOKEN_SENT events, a requeued job resumes skipping them)
+    """
+    events = GoodDeliveryEvent.objects.filter(good_delivery=OuterRef('pk'),
+                                              code=GoodDeliveryEvent.TOKEN_SENT,
+                                              create__gte=date)
+    return deliveries.exclude(Exists(events))
+
+
+def _read_journal(journal):
+    sent = set()
+    if journal and os.path.exists(journal):
+        with open(journal) as f:
+            for line in f:
+                if line.strip():
+                    sent.add(json.loads(line)['good_delivery'])
+    return sent
+
+
+def issue_delivery_tokens(deliveries, uri, user, msg='', journal=None,
+                          processes=1, batch_size=100, progress=None):
+    """
+    Generates good deliveries tokens (encrypted in a process pool)
+    and sends them by email in batches over a single SMTP connection.
+    Every sent delivery is appended to journal (JSON Lines)
+    and gets a TOKEN_SENT event right after its email,
+    so that an interrupted run can be resumed skipping them.
+
+    :type deliveries: QuerySet of GoodDelivery
+    :type uri: String
+    :type user: User
+    :type msg: String
+    :type journal: String
+    :type processes: Int
+    :type batch_size: Int
+    :type progress: callable
+
+    :param deliveries: good deliveries to notify
+    :param uri: absolute URI of user_use_token view
+    :param user: user that issues tokens (for logs)
+    :param msg: text added to emails
+    :param journal: progress journal file path
+    :param processes: encryption processes
+    :param batch_size: emails sent for each batch
+    :param progress: called with the sent emails after each batch
+
+    :return: number of sent emails
+    """
+    already_sent = _read_journal(journal)
+    executor = ProcessPoolExecutor(max_workers=processes) if processes > 1 else None
+    connection = get_connection()
+    journal_file = open(journal, 'a') if journal else None
+    sent = 0
+    try:
+        connection.open()
+        batch = []
+        for good_delivery in deliveries.iterator(chunk_size=batch_size):
+            if good_delivery.pk in already_sent: continue
+            batch.append(good_delivery)
+            if len(batch) == batch_size:
+                sent += _send_tokens_batch(batch, uri, user, msg,
+                                           executor, connection, journal_file)
+                batch = []
+                if progress: progress(sent)
+        if batch:
+            sent += _send_tokens_batch(batch, uri, user, msg,
+                                       executor, connection, journal_file)
+            if progress: progress(sent)
+    finally:
+        connection.close()
+        if executor: executor.shutdown()
+        if journal_file: journal_file.close()
+    return sent
+
+
+def _send_tokens_batch(batch, uri, user, msg, executor, connection, journal_file):
+    payloads = [json.dumps(gd.get_jwt_data()).encode() for gd in batch]
+    if executor:
+        tokens = list(executor.map(encrypt_to_jwe, payloads))
+    else:
+        tokens = [encrypt_to_jwe(payload) for payload in payloads]
+
+    # each mail is recorded (event and journal) as soon as it's sent:
+    # if SMTP fails halfway resumed runs skip the sent ones
+    sent = 0
+    for good_delivery, token in zip(batch, tokens):
+        mail = build_custom_mail(**get_token_mail(good_delivery=good_delivery,
+                                                  token=token,
+                                                  uri=uri,
+                                                  msg=msg))
+        if not connection.send_messages([mail]): continue
+        sent += 1
+        email = good_delivery.delivered_to.email
+        good_delivery.log_event(GoodDeliveryEvent.TOKEN_SENT, user, email=email)
+        if journal_file:
+            journal_file.write(json.dumps({'good_delivery': good_delivery.pk,
+                                           'email': email,
+                                           'date': timezone.localtime().isoformat()}) + '\n')
+            journal_file.flush()
+    logger.info('{} delivery tokens sent'.format(sent))
+    return sent
+
+
+def confirm_delivery_token(decrypted, user):
+    """
+    Confirms the good delivery of a decrypted token
+    (delivery and log written in a single transaction).
+
+    :type decrypted: dict
+    :type user: User
+
+    :param decrypted: token payload (GoodDelivery.get_jwt_data())
+    :param user: user that uses the token
+
+    :return: (message, confirmed GoodDelivery or None)
+    """
+    user_id = decrypted.get('user', '')
+    good_delivery = GoodDelivery.objects.with_state()\
+                                        .select_related('campaign',
+                                                        'delivered_to',
+                                                        'delivered_by',
+                                                        'delivery_point')\
+                                        .get(pk=decrypted.get('id', ''),
+                                             delivered_to__pk=user_id,
+                                             delivery_point__pk=decrypted.get('delivery_point', ''))
+    campaign = good_delivery.campaign
+    if user.is_authenticated and not user.pk==user_id:
+        return _("Utente non autorizzato"), None
+    if not campaign.is_active or not campaign.is_in_progress():
+        return _("Campagna non attiva"), None
+    if good_delivery.disabled_date:
+        return _("Consegna disabilitata. Impossibile completare l'operazione"), None
+    if not good_delivery.delivered_by:
+        return _("Consegna non completata dall'operatore"), None
+    if good_delivery.delivery_date and not good_delivery.single_items_to_deliver():
+        return _("Consegna già effetuata"), None
+    with transaction.atomic():
+        good_delivery.mark_as_delivered(delivery_point=good_delivery.delivery_point,
+                                        operator=good_delivery.delivered_by)
+        good_delivery.log_event(GoodDeliveryEvent.CONFIRMED, user)
+    return _("Hai confermato correttamente la consegna"), good_delivery
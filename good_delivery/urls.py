@@ -16,6 +16,7 @@ urlpatterns = [
 
     # admin view
     path('import_from_file/', import_stockidentifiers_from_file, name='import_stockidentifiers_from_file'),
+    path('background_jobs/<int:job_id>/result/', background_job_result, name='background_job_result'),
 
     # user
     path(f'{prefix}', user_index, name='user_index'),
@@ -34,7 +35,9 @@ urlpatterns = [
 
     path(f'{op_prefix_camp}/<str:campaign_id>/<int:delivery_point_id>/new/', operator_new_delivery, name='operator_new_delivery'),
     path(f'{op_prefix_camp}/<str:campaign_id>/<int:delivery_point_id>/<int:good_delivery_id>/another/', operator_another_delivery, name='operator_another_delivery'),
+    path(f'{op_prefix_camp}/<str:campaign_id>/<int:delivery_point_id>/users.json', operator_users, name='operator_users'),
 
+    path(f'{op_prefix_camp}/<str:campaign_id>/<int:delivery_point_id>/stocks/<int:stock_id>/identifiers.json', operator_stock_identifiers, name='operator_stock_identifiers'),
     path(f'{op_prefix_camp}/<str:campaign_id>/<int:delivery_point_id>/<int:good_delivery_id>/', operator_good_delivery_detail, name='operator_good_delivery_detail'),
     path(f'{op_prefix_camp}/<str:campaign_id>/<int:delivery_point_id>/<int:good_delivery_id>/add-items/', operator_good_delivery_add_items, name='operator_good_delivery_add_items'),
     path(f'{op_prefix_camp}/<str:campaign_id>/<int:delivery_point_id>/<int:good_delivery_id>/add-replaced-item/<int:good_id>/', operator_good_delivery_add_replaced_item, name='operator_good_delivery_add_replaced_item'),
@@ -54,8 +57,5 @@ urlpatterns = [
 urlpatterns += [
     # User json
     path(f'{prefix}/<str:campaign_id>/<int:delivery_point_id>/delivery_point_deliveries.json', delivery_point_deliveries, name='delivery_point_deliveries_json'),
-    path(f'{prefix}/<str:campaign_id>/<int:delivery_point_id>/delivery_point_deliveries_delivered.json', delivery_point_deliveries_delivered, name='delivery_point_deliveries_delivered_json'),
-    path(f'{prefix}/<str:campaign_id>/<int:delivery_point_id>/delivery_point_deliveries_disabled.json', delivery_point_deliveries_disabled, name='delivery_point_deliveries_disabled_json'),
-    path(f'{prefix}/<str:campaign_id>/<int:delivery_point_id>/delivery_point_deliveries_to_define.json', delivery_point_deliveries_to_define, name='delivery_point_deliveries_to_define_json'),
-    path(f'{prefix}/<str:campaign_id>/<int:delivery_point_id>/delivery_point_deliveries_waiting.json', delivery_point_deliveries_waiting, name='delivery_point_deliveries_waiting_json'),
+    path(f'{prefix}/<str:campaign_id>/<int:delivery_point_id>/delivery_point_deliveries_<str:state>.json', delivery_point_deliveries, name='delivery_point_deliveries_state_json'),
 ]
@@ -1,14 +1,16 @@
-import csv
 import os
 import webbrowser
 
+from asgiref.sync import sync_to_async
 from django.conf import settings
-from django.core.mail import send_mail
+from django.core.mail import EmailMultiAlternatives
 from django.shortcuts import render
 from django.utils.html import strip_tags
 from django.utils.translation import gettext as _
 
-from . models import GoodDelivery
+from . exporters import csv_chunks, get_waiting_deliveries_rows
+from . models import OutboundMail
+from . settings import EXPORT_CHUNK_SIZE, MAIL_QUEUE_ENABLED
 
 
 def custom_message(request, message='', msg_type='danger', status=None):
@@ -19,9 +21,9 @@ def custom_message(request, message='', msg_type='danger', status=None):
                    'msg_type': msg_type},
                   status=status)
 
-# Custom email sender
-def send_custom_mail(subject, recipients, body, params={}):
-    if not recipients: return False
+# Custom email builder
+def build_custom_mail(subject, recipients, body, params={}):
+    if not recipients: return None
     recipients_list = []
     for recipient in recipients:
         if not recipient.email: continue
@@ -31,13 +33,38 @@ def send_custom_mail(subject, recipients, body, params={}):
         msg_body_list = [settings.MSG_HEADER, body,
                          settings.MSG_FOOTER]
         msg_body = ''.join([i.__str__() for i in msg_body_list]).format(**params)
-        result = send_mail(subject=subject,
-                           html_message=msg_body,
-                           message=strip_tags(msg_body),
-                           from_email=settings.EMAIL_SENDER,
-                           recipient_list=recipients_list,
-                           fail_silently=False)
-        return result
+        mail = EmailMultiAlternatives(subject=subject,
+                                      body=strip_tags(msg_body),
+                                      from_email=settings.EMAIL_SENDER,
+                                      to=recipients_list)
+        mail.attach_alternative(msg_body, 'text/html')
+        return mail
+
+# Custom email sender
+# (queued if MAIL_QUEUE_ENABLED, see mail_queue.py)
+def send_custom_mail(subject, recipients, body, params={}):
+    mail = build_custom_mail(subject=subject,
+                             recipients=recipients,
+                             body=body,
+                             params=params)
+    if not mail: return False
+    if getattr(settings, 'MAIL_QUEUE_ENABLED', MAIL_QUEUE_ENABLED):
+        return OutboundMail.enqueue(mail)
+    return mail.send(fail_silently=False)
+
+async def send_custom_mail_async(subject, recipients, body, params={}):
+    """
+    send_custom_mail() for async views: queued emails are
+    inserted in the ORM thread, SMTP sending runs in the thread pool
+    """
+    mail = build_custom_mail(subject=subject,
+                             recipients=recipients,
+                             body=body,
+                             params=params)
+    if not mail: return False
+    if getattr(settings, 'MAIL_QUEUE_ENABLED', MAIL_QUEUE_ENABLED):
+        return await sync_to_async(OutboundMail.enqueue)(mail)
+    return await sync_to_async(mail.send, thread_sensitive=False)(fail_silently=False)
 
 def get_labeled_errors(form):
     d = {}
@@ -56,33 +83,12 @@ def open_html_in_webbrowser(bhtml, fpath='/tmp'):  # pragma: no cover
 def export_waiting_deliveries_on_file(queryset, fopen,
                                       delimiter=';', quotechar='"'):
     """
+    writes waiting deliveries of all queryset campaigns as CSV
     """
-    writer = csv.writer(fopen, delimiter=delimiter, quotechar=quotechar)
-
-    # selected delivery campaigns
-    campaign = queryset.first()
-
-    # campaign waiting deliveries
-    deliveries = GoodDelivery.objects.filter(campaign=campaign,
-                                             delivery_point__isnull=True)
-
-    head = ['CF', 'Cognome', 'Nome',
-            'Via', 'Num', 'Città', 'CAP', 'Prov', 'Tel']
-
-    writer.writerow(head)
-
-    for delivery in deliveries:
-        user = delivery.delivered_to
-        row = [user.taxpayer_id,
-               user.last_name,
-               user.first_name,
-               delivery.address_road,
-               delivery.address_number,
-               delivery.address_city,
-               delivery.address_zip_code,
-               delivery.address_state,
-               delivery.phone]
-        writer.writerow(row)
-
+    chunk_size = getattr(settings, 'EXPORT_CHUNK_SIZE', EXPORT_CHUNK_SIZE)
+    rows = get_waiting_deliveries_rows(queryset, chunk_size=chunk_size)
+    for chunk in csv_chunks(rows, chunk_size,
+                            delimiter=delimiter, quotechar=quotechar):
+        fopen.write(chunk)
     return fopen
 
@@ -1,11 +1,13 @@
 import json
 import logging
 
+from asgiref.sync import sync_to_async
 from django.conf import settings
-from django.contrib.admin.models import LogEntry, ADDITION, CHANGE
+from django.contrib.auth import get_user_model
 from django.contrib.auth.decorators import login_required
-from django.contrib.contenttypes.models import ContentType
-from django.db.models import Count, Q
+from django.db import IntegrityError, transaction
+from django.db.models import Prefetch, Q, prefetch_related_objects
+from django.http import JsonResponse
 from django.shortcuts import get_object_or_404, render, redirect
 from django.urls import reverse
 from django.utils.decorators import method_decorator
@@ -17,7 +19,9 @@ from . decorators import *
 from . forms import *
 from . jwts import *
 from . models import *
+from . search import get_user_label, search_users
 from . settings import *
+from . tokens import confirm_delivery_token, get_token_mail
 from . utils import *
 
 
@@ -45,17 +49,10 @@ def _generate_good_delivery_token_email(request, good_delivery, msg=''):
 
         # build absolute URI, attach token and send email
         uri = request.build_absolute_uri(reverse('good_delivery:user_use_token'))
-        mail_params = {'hostname': settings.HOSTNAME,
-                       'user': good_delivery.delivered_to,
-                       'url': '{}?token={}'.format(uri, token),
-                       'added_text': msg
-                      }
-        m_subject = _('{} - {}').format(settings.HOSTNAME, good_delivery)
-
-        send_custom_mail(subject=m_subject,
-                         recipients=[good_delivery.delivered_to],
-                         body=settings.NEW_DELIVERY_WITH_TOKEN_CREATED,
-                         params=mail_params)
+        send_custom_mail(**get_token_mail(good_delivery=good_delivery,
+                                          token=token,
+                                          uri=uri,
+                                          msg=msg))
         return token
 
 @login_required
@@ -66,7 +63,8 @@ def user_index(request):
     return: render
     """
     title =_("Home page utente")
-    good_deliveries = GoodDelivery.objects.filter(delivered_to=request.user,
+    good_deliveries = GoodDelivery.objects.with_state()\
+                                          .filter(delivered_to=request.user,
                                                   campaign__is_active=True)
     template = "user_index.html"
     d = {'good_deliveries': good_deliveries,
@@ -154,10 +152,14 @@ def operator_new_delivery(request, campaign_id, delivery_point_id,
     :return: render
     """
     template = "operator_new_delivery.html"
-    form = GoodDeliveryPreloadForm()
+    remote_url = reverse('good_delivery:operator_users',
+                         kwargs={'campaign_id': campaign_id,
+                                 'delivery_point_id': delivery_point_id})
+    form = GoodDeliveryPreloadForm(remote_url=remote_url)
 
     if request.POST:
-        form = GoodDeliveryPreloadForm(data=request.POST)
+        form = GoodDeliveryPreloadForm(data=request.POST,
+                                       remote_url=remote_url)
         if form.is_valid():
             user = form.cleaned_data['user']
             good_delivery = GoodDelivery(delivered_to=user,
@@ -168,9 +170,7 @@ def operator_new_delivery(request, campaign_id, delivery_point_id,
                                  _("{} creata con successo.").format(user))
 
             # log action
-            good_delivery.log_action(_("Creazione della consegna"),
-                                     CHANGE,
-                                     request.user)
+            good_delivery.log_event(GoodDeliveryEvent.CREATED, request.user)
 
             return redirect('good_delivery:operator_good_delivery_detail',
                             campaign_id=campaign_id,
@@ -189,6 +189,52 @@ def operator_new_delivery(request, campaign_id, delivery_point_id,
 
     return render(request, template, d)
 
+@login_required
+@campaign_is_active
+@campaign_is_in_progress
+@operator_can_create
+@is_delivery_point_operator
+def operator_users(request, campaign_id, delivery_point_id,
+                   campaign, delivery_point, multi_tenant):
+    """
+    Operator - Active users search (new delivery recipient autocomplete)
+
+    :type campaign_id: String
+    :type delivery_point_id: Int
+    :type campaign: Campaign (from @campaign_is_active)
+    :type delievery_point: DeliveryPoint (from @is_delivery_point_operator)
+    :type multi_tenant: Boolean (from @is_delivery_point_operator)
+
+    :param campaign_id: campaign slug
+    :param delivery_point_id: delivery point id
+    :param campaign: Campaign object (from @campaign_is_active)
+    :param delievery_point: DeliveryPoint object (from @is_delivery_point_operator)
+    :param multi_tenant: if operator is multi_tenant (from @is_delivery_point_operator)
+
+    :return: JsonResponse (results, more and next, the "after" cursor of next page)
+    """
+    min_length = getattr(settings,
+                         "USERS_AUTOCOMPLETE_MIN_LENGTH",
+                         USERS_AUTOCOMPLETE_MIN_LENGTH)
+    page_size = getattr(settings,
+                        "USERS_AUTOCOMPLETE_PAGE_SIZE",
+                        USERS_AUTOCOMPLETE_PAGE_SIZE)
+    text = request.GET.get('q', '').strip()
+    # users are not listed, only searched
+    if len(text) < min_length:
+        return JsonResponse({'results': [], 'more': False, 'next': None})
+    users = search_users(get_user_model().objects.filter(is_active=True), text)\
+                .order_by('username')
+    after = request.GET.get('after')
+    if after:
+        users = users.filter(username__gt=after)
+    page = list(users[:page_size + 1])
+    more = len(page) > page_size
+    return JsonResponse({'results': [{'id': user.pk, 'text': get_user_label(user)}
+                                     for user in page[:page_size]],
+                         'more': more,
+                         'next': page[page_size - 1].username if more else None})
+
 @login_required
 @campaign_is_active
 @campaign_is_in_progress
@@ -241,7 +287,10 @@ def operator_another_delivery(request, campaign_id, delivery_point_id,
     # log action
     msg = _("Creazione nuova consegna in seguito a "
             "disabilitazione di {}").format(good_delivery)
-    new_delivery.log_action(msg, CHANGE, request.user)
+    new_delivery.log_event(GoodDeliveryEvent.CREATED_AFTER_DISABLE,
+                           request.user,
+                           previous='{}'.format(good_delivery),
+                           previous_id=good_delivery.pk)
 
     mail_params = {
                    'hostname': settings.HOSTNAME,
@@ -308,7 +357,8 @@ def operator_good_delivery_add_items(request, campaign_id, delivery_point_id,
     # else add single items to good_delivery
 
     # get delivery point good stocks
-    stocks = DeliveryPointGoodStock.objects.filter(delivery_point=delivery_point)
+    stocks = DeliveryPointGoodStock.objects.filter(delivery_point=delivery_point)\
+                                           .select_related('good__category')
     form = GoodDeliveryQuantityForm(stocks=stocks)
 
     if request.POST:
@@ -319,76 +369,53 @@ def operator_good_delivery_add_items(request, campaign_id, delivery_point_id,
             document_id = form.cleaned_data.get('document_id', '')
             notes = form.cleaned_data['notes']
 
-            for stock in stocks:
-                field_name = f'{settings.GOOD_STOCK_FORMS_PREFIX}{stock.pk}'
-                quantity = form.cleaned_data[field_name]
-
-                # zero!
-                if not quantity:
-                    messages.add_message(request, messages.INFO,
-                                         _("Non è stata inserita alcuna "
-                                           "unità di tipo <b>{}</b>")\
-                            .format(stock.good))
-                    continue
-
-                # check availability
-                available_items = stock.get_available_items()
-
-                # if choosen quantity exceeds stock availability
-                if type(available_items) == int and quantity > available_items:
-                    # delete already inserted items
-                    items = good_delivery.get_items()
-                    items.delete()
-                    messages.add_message(request, messages.ERROR,
-                                         _("La quantità residua nello "
-                                           "stock <b>{}</b> è di "
-                                           "<b>{}</b> unità").format(stock.good,
-                                                                     available_items))
-                    return redirect('good_delivery:operator_good_delivery_detail',
-                        campaign_id=campaign_id,
-                        delivery_point_id=delivery_point_id,
-                        good_delivery_id=good_delivery_id)
-
-                # else
-                else:
-                    # if stock provides a list of identification codes
-                    # then quantity must be 1 for each item
-                    # and user has to select an ID number for every one
-                    dpgsi = DeliveryPointGoodStockIdentifier
-                    has_identifier = dpgsi.objects.filter(delivery_point_stock=stock).first()
-
-                    if has_identifier:
-                        for i in range(quantity):
-                            good_delivery_item = GoodDeliveryItem.objects.\
-                                                    create(good_delivery=good_delivery,
-                                                           quantity=1,
-                                                           good=stock.good)
-                            # log action
-                            good_delivery.log_action(_("Inserimento item {}").format(good_delivery_item),
-                                                    CHANGE,
-                                                    request.user)
-                    # else (e.g. glasses of water, bananas...)
-                    # quantity is choosen by user
-                    else: # pragma: no cover
-                        good_delivery_item = GoodDeliveryItem(good_delivery=good_delivery,
-                                                              quantity=quantity,
-                                                              good=stock.good)
-                        good_delivery.delivered_by = request.user
-                        good_delivery_item.save()
-
-                        # log action
-                        good_delivery.log_action(_("Inserimento {} item {}").format(quantity,
-                                                                                    good_delivery_item),
-                                                CHANGE,
-                                                request.user)
-
-            # set operator data in good delivery
-            good_delivery.delivery_point = delivery_point
-            if campaign.identity_document_required:
-                good_delivery.document_type = document_type
-                good_delivery.document_id = document_id
-            good_delivery.notes = notes
-            good_delivery.save()
+            try:
+                with transaction.atomic():
+                    reservations = []
+                    for stock in stocks:
+                        field_name = f'{settings.GOOD_STOCK_FORMS_PREFIX}{stock.pk}'
+                        quantity = form.cleaned_data[field_name]
+
+                        # zero!
+                        if not quantity:
+                            messages.add_message(request, messages.INFO,
+                                                 _("Non è stata inserita alcuna "
+                                                   "unità di tipo <b>{}</b>")\
+                                    .format(stock.good))
+                            continue
+
+                        # reserve stock units
+                        # (other operators can't take them meanwhile)
+                        reservation = stock.reserve(quantity)
+
+                        # if stock provides a list of identification codes
+                        # then quantity must be 1 for each item
+                        # and user has to select an ID number for every one
+                        # else (e.g. glasses of water, bananas...)
+                        # quantity is choosen by user
+                        if not stock.get_counter().identifiers: # pragma: no cover
+                            good_delivery.delivered_by = request.user
+                        reservations.append(reservation)
+
+                    # set operator data in good delivery
+                    good_delivery.delivery_point = delivery_point
+                    if campaign.identity_document_required:
+                        good_delivery.document_type = document_type
+                        good_delivery.document_id = document_id
+                    good_delivery.notes = notes
+                    good_delivery.save()
+
+                    # one INSERT for all items, one log entry
+                    good_delivery.add_items(reservations, request.user)
+
+            # if choosen quantity exceeds stock availability
+            # (nothing has been inserted, reservations are rolled back)
+            except StockShortageError as e:
+                messages.add_message(request, messages.ERROR,
+                                     _("La quantità residua nello "
+                                       "stock <b>{}</b> è di "
+                                       "<b>{}</b> unità").format(e.stock.good,
+                                                                 e.available))
 
             return redirect('good_delivery:operator_good_delivery_detail',
                         campaign_id=campaign_id,
@@ -402,8 +429,7 @@ def operator_good_delivery_add_items(request, campaign_id, delivery_point_id,
 
     template = "operator_good_delivery_preload.html"
 
-    logs = LogEntry.objects.filter(content_type_id=ContentType.objects.get_for_model(good_delivery).pk,
-                                   object_id=good_delivery.pk)
+    logs = good_delivery.get_events()
 
 
     d = {'campaign': campaign,
@@ -447,8 +473,17 @@ def operator_good_delivery_detail(request, campaign_id, delivery_point_id,
 
     :return: redirect
     """
-    # actual good delivery items
-    good_delivery_items = GoodDeliveryItem.objects.filter(good_delivery=good_delivery)
+    # actual good delivery items, with all that forms and
+    # delivery details show (one query, whatever the items number)
+    items = GoodDeliveryItem.objects.select_related('good__category',
+                                                    'good_stock_identifier',
+                                                    'delivery_point',
+                                                    'delivered_by',
+                                                    'returned_point',
+                                                    'returned_to')
+    prefetch_related_objects([good_delivery],
+                             Prefetch('gooddeliveryitem_set', queryset=items))
+    good_delivery_items = good_delivery.gooddeliveryitem_set.all()
     if not good_delivery_items:
         return redirect('good_delivery:operator_good_delivery_add_items',
                         campaign_id=campaign_id,
@@ -460,22 +495,42 @@ def operator_good_delivery_detail(request, campaign_id, delivery_point_id,
     form_prefix = getattr(settings,
                           "GOOD_DELIVERY_ITEMS_FORMS_PREFIX",
                           GOOD_DELIVERY_ITEMS_FORMS_PREFIX)
+    # delivery point stocks with identifiers, keyed by good,
+    # and their free identifiers, shared by items forms
+    # (big stocks identifiers are searched by autocomplete)
+    stocks = {stock.good_id: stock for stock in
+              DeliveryPointGoodStock.objects.filter(delivery_point=delivery_point,
+                                                    counter__identifiers__gt=0)\
+                                            .select_related('delivery_point', 'counter')}
+    autocomplete_threshold = getattr(settings,
+                                     "IDENTIFIERS_AUTOCOMPLETE_THRESHOLD",
+                                     IDENTIFIERS_AUTOCOMPLETE_THRESHOLD)
+    free_identifiers = {}
+    remote_urls = {}
+    for stock in stocks.values():
+        if stock.counter.free_identifiers > autocomplete_threshold:
+            free_identifiers[stock.pk] = None
+            remote_urls[stock.pk] = reverse('good_delivery:operator_stock_identifiers',
+                                            kwargs={'campaign_id': campaign_id,
+                                                    'delivery_point_id': delivery_point_id,
+                                                    'stock_id': stock.pk})
     # build one form for each single item (with ID code)
     good_forms = []
     prefix_index = 1
     for item in good_delivery_items:
-        stock = DeliveryPointGoodStock.objects.filter(delivery_point=delivery_point,
-                                                      good=item.good).first()
-        has_identifier = DeliveryPointGoodStockIdentifier.objects.filter(delivery_point_stock=stock).first()
-        if has_identifier:
+        stock = stocks.get(item.good_id)
+        if stock:
+            if stock.pk not in free_identifiers:
+                free_identifiers[stock.pk] = list(stock.get_free_identifiers())
             form = GoodDeliveryItemForm(instance=item,
                                         stock=stock,
+                                        free_identifiers=free_identifiers[stock.pk],
+                                        remote_url=remote_urls.get(stock.pk),
                                         prefix="{}{}".format(form_prefix,
                                                              prefix_index))
             good_forms.append(form)
             prefix_index+=1
-    logs = LogEntry.objects.filter(content_type_id=ContentType.objects.get_for_model(good_delivery).pk,
-                                   object_id=good_delivery.pk)
+    logs = good_delivery.get_events()
 
     if request.POST:
         if good_delivery.delivery_point != delivery_point:
@@ -493,49 +548,74 @@ def operator_good_delivery_detail(request, campaign_id, delivery_point_id,
                             campaign_id=campaign_id,
                             delivery_point_id=delivery_point_id,
                             good_delivery_id=good_delivery_id)
+        # submitted values are validated against identifiers
+        # and codes loaded here once, not by each form
+        submitted = [(f, request.POST.get(f.add_prefix('good_stock_identifier')),
+                      (request.POST.get(f.add_prefix('good_identifier')) or '').strip())
+                     for f in good_forms]
+        identifiers = {}
+        for stock in stocks.values():
+            if stock.pk in remote_urls:
+                selected = [value for f, value, code in submitted
+                            if f.stock.pk == stock.pk and value and value.isdigit()]
+                stock_identifiers = stock.get_free_identifiers().filter(pk__in=selected) \
+                                    if selected else []
+            else:
+                stock_identifiers = free_identifiers.get(stock.pk) or []
+            identifiers[stock.pk] = {str(i.pk): i for i in stock_identifiers}
+        codes = {code for f, value, code in submitted if code}
+        assigned_codes = set()
+        if codes:
+            assigned_codes = set(GoodDeliveryItem.objects.filter(good_delivery__campaign=campaign,
+                                                                 good__in=list(stocks),
+                                                                 good_identifier__in=codes)\
+                                                         .exclude(good_delivery=good_delivery)\
+                                                         .values_list('good', 'good_identifier'))
         prefix_index = 1
         filled_forms = []
         for f in good_forms:
-            stock = DeliveryPointGoodStock.objects.filter(delivery_point=delivery_point,
-                                                          good=f.instance.good).first()
             form = GoodDeliveryItemForm(instance=f.instance,
                                         data=request.POST,
-                                        stock=stock,
+                                        stock=f.stock,
+                                        free_identifiers=free_identifiers[f.stock.pk],
+                                        remote_url=remote_urls.get(f.stock.pk),
+                                        identifiers=identifiers[f.stock.pk],
+                                        assigned_codes=assigned_codes,
                                         prefix="{}{}".format(form_prefix,
                                                              prefix_index))
             filled_forms.append(form)
             prefix_index+=1
         good_forms = filled_forms
 
+        # the same code twice in this delivery
+        codes = set()
+        for f in good_forms:
+            if not f.is_valid(): continue
+            code = (f.instance.good_id, f.cleaned_data['good_identifier'])
+            if code in codes:
+                f.add_error('good_identifier',
+                            _("Non è consentito l'inserimento "
+                              "di identificativi duplicati"))
+            codes.add(code)
+
         if all([f.is_valid() for f in good_forms]):
-            for f in good_forms:
-                f.save()
-            duplicates = GoodDeliveryItem.objects\
-                            .values('good_stock_identifier')\
-                            .annotate(name_count=Count('good_stock_identifier'))\
-                            .filter(name_count__gt=1)
-            if duplicates:
-                # TODO: cover
-                for duplicate in duplicates:
-                    value = duplicate['good_stock_identifier']
-                    duplicate_items = GoodDeliveryItem.objects\
-                                        .filter(good_stock_identifier=value,
-                                                good_delivery=good_delivery)
-                    for duplicate_item in duplicate_items:
-                        duplicate_item.good_stock_identifier = None
-                        duplicate_item.save()
+            try:
+                with transaction.atomic():
+                    good_delivery.assign_identifiers([f.instance for f in good_forms])
+                    good_delivery.delivered_by = request.user
+                    good_delivery.save()
+                    # log action
+                    good_delivery.log_event(GoodDeliveryEvent.IDENTIFIERS_ASSIGNED,
+                                            request.user,
+                                            items={f.instance.pk: f.instance.good_identifier
+                                                   for f in good_forms})
+                messages.add_message(request, messages.SUCCESS,
+                                     _("Modifica effettuata correttamente"))
+            except IntegrityError:
+                # assigned by another operator in the meantime
                 messages.add_message(request, messages.ERROR,
                                      _("Non è consentito l'inserimento "
                                        "di identificativi duplicati"))
-            else:
-                good_delivery.delivered_by = request.user
-                good_delivery.save()
-                # log action
-                good_delivery.log_action(_("Inserimento identificatori univoci"),
-                                         CHANGE,
-                                         request.user)
-                messages.add_message(request, messages.SUCCESS,
-                                     _("Modifica effettuata correttamente"))
             return redirect('good_delivery:operator_good_delivery_detail',
                             campaign_id=campaign_id,
                             delivery_point_id=delivery_point_id,
@@ -548,7 +628,7 @@ def operator_good_delivery_detail(request, campaign_id, delivery_point_id,
 
     returned_items_to_replace = {}
     if good_delivery.delivery_date:
-        returned_items_to_replace = good_delivery.get_returned_items_to_replace().items()
+        returned_items_to_replace = good_delivery.get_returned_items_to_replace(items=good_delivery_items).items()
     d = {'campaign': campaign,
          'delivery_point': delivery_point,
          'good_delivery': good_delivery,
@@ -559,6 +639,52 @@ def operator_good_delivery_detail(request, campaign_id, delivery_point_id,
          'title': title,}
     return render(request, template, d)
 
+@login_required
+@campaign_is_active
+@is_delivery_point_operator
+def operator_stock_identifiers(request, campaign_id, delivery_point_id,
+                               stock_id, campaign, delivery_point,
+                               multi_tenant):
+    """
+    Operator - Free identifiers of a delivery point stock
+    (items forms autocomplete)
+
+    :type campaign_id: String
+    :type delivery_point_id: Int
+    :type stock_id: Int
+    :type campaign: Campaign (from @campaign_is_active)
+    :type delievery_point: DeliveryPoint (from @is_delivery_point_operator)
+    :type multi_tenant: Boolean (from @is_delivery_point_operator)
+
+    :param campaign_id: campaign slug
+    :param delivery_point_id: delivery point id
+    :param stock_id: delivery point good stock id
+    :param campaign: Campaign object (from @campaign_is_active)
+    :param delievery_point: DeliveryPoint object (from @is_delivery_point_operator)
+    :param multi_tenant: if operator is multi_tenant (from @is_delivery_point_operator)
+
+    :return: JsonResponse (results, more and next, the "after" cursor of next page)
+    """
+    stock = get_object_or_404(DeliveryPointGoodStock.objects.select_related('delivery_point'),
+                              pk=stock_id,
+                              delivery_point=delivery_point)
+    page_size = getattr(settings,
+                        "IDENTIFIERS_AUTOCOMPLETE_PAGE_SIZE",
+                        IDENTIFIERS_AUTOCOMPLETE_PAGE_SIZE)
+    identifiers = stock.get_free_identifiers().order_by('good_identifier')
+    text = request.GET.get('q', '').strip()
+    if text:
+        identifiers = identifiers.filter(good_identifier__startswith=text)
+    after = request.GET.get('after')
+    if after:
+        identifiers = identifiers.filter(good_identifier__gt=after)
+    page = list(identifiers.values_list('pk', 'good_identifier')[:page_size + 1])
+    more = len(page) > page_size
+    return JsonResponse({'results': [{'id': pk, 'text': code}
+                                     for pk, code in page[:page_size]],
+                         'more': more,
+                         'next': page[page_size - 1][1] if more else None})
+
 @login_required
 @campaign_is_active
 @campaign_is_in_progress
@@ -604,7 +730,7 @@ def operator_good_delivery_deliver(request, campaign_id, delivery_point_id,
         msg = _("Consegna (senza conferma da parte dell'utente) "
                 "effettuata con successo").format(good_delivery)
         # log action
-        good_delivery.log_action(msg, CHANGE, request.user)
+        good_delivery.log_event(GoodDeliveryEvent.DELIVERED, request.user)
 
         # send mail to user
         mail_params = {
@@ -647,7 +773,7 @@ def operator_good_delivery_reset(request, campaign_id, delivery_point_id,
 
     :return: redirect
     """
-    good_delivery = get_object_or_404(GoodDelivery,
+    good_delivery = get_object_or_404(GoodDelivery.objects.with_state(),
                                       pk=good_delivery_id,
                                       delivery_point=delivery_point)
     if not good_delivery.is_waiting():
@@ -663,7 +789,7 @@ def operator_good_delivery_reset(request, campaign_id, delivery_point_id,
         good_delivery.notes = None
         good_delivery.save()
         msg = _("Reset effettuato con successo").format(good_delivery)
-        good_delivery.log_action(msg, CHANGE, request.user)
+        good_delivery.log_event(GoodDeliveryEvent.RESET, request.user)
         messages.add_message(request, messages.SUCCESS, msg)
     return redirect('good_delivery:operator_good_delivery_detail',
                     campaign_id=campaign_id,
@@ -721,7 +847,9 @@ def operator_good_delivery_disable(request, campaign_id, delivery_point_id,
                                               'modified'])
 
             msg = _("Disabilitazione effettuata successo").format(good_delivery)
-            good_delivery.log_action(msg, CHANGE, request.user)
+            good_delivery.log_event(GoodDeliveryEvent.DISABLED,
+                                    request.user,
+                                    notes=good_delivery.disable_notes)
 
             mail_params = {
                        'hostname': settings.HOSTNAME,
@@ -776,7 +904,7 @@ def operator_good_delivery_delete(request, campaign_id, delivery_point_id,
 
     :return: redirect
     """
-    good_delivery = get_object_or_404(GoodDelivery,
+    good_delivery = get_object_or_404(GoodDelivery.objects.with_state(),
                                       pk=good_delivery_id,
                                       delivery_point=delivery_point)
     if good_delivery.is_waiting():
@@ -800,71 +928,44 @@ def operator_good_delivery_delete(request, campaign_id, delivery_point_id,
     return redirect('good_delivery:operator_campaign_detail',
                     campaign_id=campaign_id)
 
-@login_required
-def user_use_token(request):
+@async_login_required
+async def user_use_token(request):
     """
     User - Confirm a good delivery by using URL token
+    (async: decryption and SMTP run in the thread pool,
+    the ORM in one transaction in the ORM thread)
 
     :return: message
     """
     title =_("Accettazione condizioni")
     try:
-        msg = ''
         token = request.GET.get('token', '')
-        decrypted = json.loads(decrypt_from_jwe(token))
-        pk = decrypted.get('id','')
-        user_id = decrypted.get('user','')
-        delivery_point_id = decrypted.get('delivery_point','')
-        modified = decrypted.get('modified', None)
-        good_delivery = get_object_or_404(GoodDelivery,
-                                          pk=pk,
-                                          delivered_to__pk=user_id,
-                                          delivery_point__pk=delivery_point_id,
-                                          # modified=modified
-                                          )
-        campaign = good_delivery.campaign
-        if request.user.is_authenticated and not request.user.pk==user_id:
-            msg = _("Utente non autorizzato")
-        elif not campaign.is_active or not campaign.is_in_progress():
-            msg = _("Campagna non attiva")
-        elif good_delivery.disabled_date:
-            msg = _("Consegna disabilitata. Impossibile completare l'operazione")
-        elif not good_delivery.delivered_by:
-            msg = _("Consegna non completata dall'operatore")
-        elif good_delivery.delivery_date and not good_delivery.single_items_to_deliver():
-            msg = _("Consegna già effetuata")
-        else:
-            # success!
-            good_delivery.mark_as_delivered(delivery_point=good_delivery.delivery_point,
-                                            operator=good_delivery.delivered_by)
-            # log action
-            good_delivery.log_action(_("Consegna confermata dall'utente"),
-                                     CHANGE,
-                                     request.user)
-
-            msg = _("Hai confermato correttamente la consegna")
-
-            # send mail to user
-            mail_params = {
-                           'hostname': settings.HOSTNAME,
-                           'user': good_delivery.delivered_to,
-                          }
-            send_custom_mail(subject=_("{} - consegnata").format(good_delivery),
-                             recipients=[good_delivery.delivered_to],
-                             body=msg,
-                             params=mail_params)
-
-            return custom_message(request=request,
-                                  message=msg,
-                                  msg_type='success')
-        return custom_message(request=request, message=msg, status=401)
+        decrypted = json.loads(await decrypt_from_jwe_async(token))
+        msg, good_delivery = await sync_to_async(confirm_delivery_token)(decrypted=decrypted,
+                                                                         user=request.user)
+        if not good_delivery:
+            return await sync_to_async(custom_message)(request=request,
+                                                       message=msg,
+                                                       status=401)
+        # send mail to user
+        mail_params = {
+                       'hostname': settings.HOSTNAME,
+                       'user': good_delivery.delivered_to,
+                      }
+        await send_custom_mail_async(subject=_("{} - consegnata").format(good_delivery),
+                                     recipients=[good_delivery.delivered_to],
+                                     body=msg,
+                                     params=mail_params)
+        return await sync_to_async(custom_message)(request=request,
+                                                   message=msg,
+                                                   msg_type='success')
     except Exception as e:
         logger.exception(e)
-        return custom_message(request=request,
-                              message=_("Token non valido. "
-                                        "Se la consegna ha subito ulteriori modifiche, "
-                                        "prova a inviarne uno nuovo"),
-                              status=500)
+        return await sync_to_async(custom_message)(request=request,
+                                                   message=_("Token non valido. "
+                                                             "Se la consegna ha subito ulteriori modifiche, "
+                                                             "prova a inviarne uno nuovo"),
+                                                   status=500)
 
 @login_required
 @campaign_is_active
@@ -894,11 +995,11 @@ def operator_good_delivery_send_token(request, campaign_id, delivery_point_id,
     :return: redirect
     """
     if multi_tenant:
-        good_delivery = get_object_or_404(GoodDelivery,
+        good_delivery = get_object_or_404(GoodDelivery.objects.with_state(),
                                           delivery_point__campaign=campaign,
                                           pk=good_delivery_id)
     else:
-        good_delivery = get_object_or_404(GoodDelivery,
+        good_delivery = get_object_or_404(GoodDelivery.objects.with_state(),
                                           delivery_point=delivery_point,
                                           pk=good_delivery_id)
 
@@ -915,7 +1016,9 @@ def operator_good_delivery_send_token(request, campaign_id, delivery_point_id,
         _generate_good_delivery_token_email(request, good_delivery)
         # log action
         msg = _("Token di attivazione generato e inviato a {}").format(good_delivery.delivered_to.email)
-        good_delivery.log_action(msg, CHANGE, request.user)
+        good_delivery.log_event(GoodDeliveryEvent.TOKEN_SENT,
+                                request.user,
+                                email=good_delivery.delivered_to.email)
         messages.add_message(request, messages.SUCCESS, msg)
     return redirect('good_delivery:operator_good_delivery_detail',
                     campaign_id=campaign_id,
@@ -975,7 +1078,11 @@ def operator_good_delivery_item_return(request, campaign_id, delivery_point_id,
         good_delivery_item.save()
 
         msg = _("{} restituito correttamente").format(good_delivery_item)
-        good_delivery.log_action(msg, CHANGE, request.user)
+        good_delivery.log_event(GoodDeliveryEvent.ITEM_RETURNED,
+                                request.user,
+                                item=good_delivery_item.pk,
+                                good='{}'.format(good_delivery_item),
+                                identifier=good_delivery_item.good_identifier)
 
         mail_params = {
                    'hostname': settings.HOSTNAME,
@@ -1046,22 +1153,33 @@ def operator_good_delivery_add_replaced_item(request, campaign_id, delivery_poin
                                               good=good,
                                               delivery_point=delivery_point,
                                               delivered_by=request.user)
-        good_delivery_item.save()
         form = GoodDeliveryItemForm(instance=good_delivery_item,
                                     data=request.POST,
                                     stock=stock)
         if form.is_valid():
-            good_stock_identifier = form.cleaned_data['good_stock_identifier']
-            good_identifier = form.cleaned_data['good_identifier']
-
-            good_delivery_item.good_stock_identifier=good_stock_identifier
-            good_delivery_item.good_identifier=good_identifier
-
             if not campaign.require_agreement:
                 good_delivery_item.delivery_date = timezone.localtime()
-            good_delivery_item.save()
+            try:
+                # the item is inserted with its identifier:
+                # if another operator has just assigned it,
+                # the database rejects the insert
+                with transaction.atomic():
+                    good_delivery_item.save()
+            except IntegrityError:
+                messages.add_message(request, messages.ERROR,
+                                     _("L'identificativo selezionato "
+                                       "è già stato assegnato"))
+                return redirect('good_delivery:operator_good_delivery_add_replaced_item',
+                                campaign_id=campaign_id,
+                                delivery_point_id=delivery_point_id,
+                                good_delivery_id=good_delivery_id,
+                                good_id=good_id)
             msg = _("{} aggiunto con successo").format(good)
-            good_delivery.log_action(msg, CHANGE, request.user)
+            good_delivery.log_event(GoodDeliveryEvent.ITEM_REPLACED,
+                                    request.user,
+                                    item=good_delivery_item.pk,
+                                    good='{}'.format(good),
+                                    identifier=good_delivery_item.good_identifier)
 
             mail_params = {
                    'hostname': settings.HOSTNAME,
@@ -1078,7 +1196,6 @@ def operator_good_delivery_add_replaced_item(request, campaign_id, delivery_poin
                             delivery_point_id=delivery_point_id,
                             good_delivery_id=good_delivery_id)
         else:
-            good_delivery_item.delete()
             for k,v in get_labeled_errors(form).items():
                 messages.add_message(request, messages.ERROR,
                                      "<b>{}</b>: {}".format(k, strip_tags(v)))
@@ -1139,7 +1256,11 @@ def operator_good_delivery_item_delete(request, campaign_id, delivery_point_id,
         good_delivery_item.delete()
 
         msg = _("{} eliminato correttamente").format(good_delivery_item)
-        good_delivery.log_action(msg, CHANGE, request.user)
+        good_delivery.log_event(GoodDeliveryEvent.ITEM_DELETED,
+                                request.user,
+                                item=int(good_delivery_item_id),
+                                good='{}'.format(good_delivery_item),
+                                identifier=good_delivery_item.good_identifier)
         messages.add_message(request, messages.SUCCESS, msg)
 
         mail_params = {
@@ -1193,44 +1314,12 @@ class OperatorDeliveryPointDetail(View):
         """
         title = _("Prenotazioni da gestire")
 
-        # all deliveries with choosen_delivery_point == delivery_point
-        deliveries = GoodDelivery.objects.filter(choosen_delivery_point=delivery_point)
-
-        pending_deliveries = deliveries.filter(delivery_point__isnull=True).count()
-        waiting_deliveries = deliveries.filter(delivery_point__isnull=False,
-                                               delivery_date__isnull=True,
-                                               disabled_date__isnull=True).count()
-        delivered_deliveries = GoodDelivery.objects.filter(Q(choosen_delivery_point=delivery_point) |
-                                                           Q(delivery_point=delivery_point),
-                                                           delivery_date__isnull=False).count()
-        disabled_deliveries = GoodDelivery.objects.filter(Q(choosen_delivery_point=delivery_point) |
-                                                          Q(disabled_point=delivery_point),
-                                                          disabled_date__isnull=False).count()
-
-        total_delivered_items = GoodDeliveryItem.objects.filter(delivery_date__isnull=False,
-                                                                delivery_point=delivery_point).count()
-        total_delivered_by_others_items = GoodDeliveryItem.objects.filter(delivery_date__isnull=False,
-                                                                          good_delivery__choosen_delivery_point=delivery_point).exclude(delivery_point=delivery_point).count()
-        total_returned_items = GoodDeliveryItem.objects.filter(return_date__isnull=False,
-                                                               returned_point=delivery_point).count()
-        total_disabled_deliveries = GoodDelivery.objects.filter(disabled_date__isnull=False,
-                                                                disabled_point=delivery_point).count()
-
         d = {'campaign': campaign,
              'delivery_point': delivery_point,
              'multi_tenant': multi_tenant,
              'sub_title': delivery_point,
-             'title': title,
-             'total_delivered_items': total_delivered_items,
-             'total_delivered_by_others_items': total_delivered_by_others_items,
-             'total_returned_items': total_returned_items,
-             'total_disabled_deliveries': total_disabled_deliveries,
-
-             'pending_deliveries': pending_deliveries,
-             'waiting_deliveries': waiting_deliveries,
-             'delivered_deliveries': delivered_deliveries,
-             'disabled_deliveries': disabled_deliveries
-            }
+             'title': title}
+        d.update(delivery_point.get_statistics())
 
         return render(request, self.template_name, d)
 
@@ -4,14 +4,20 @@ import json
 from django.conf import settings
 from django.contrib.auth.decorators import login_required
 from django.db.models import Q
-from django.http import JsonResponse
+from django.http import Http404, JsonResponse
 from django.utils import timezone
+from django.utils.translation import gettext as _
 from django.views.decorators.csrf import csrf_exempt
 
 from datatables_ajax.datatables import DjangoDatatablesServerProc
 
 from good_delivery.decorators import *
 from good_delivery.models import *
+from good_delivery.pagination import (InvalidCursor,
+                                      get_approximate_count,
+                                      get_row_data,
+                                      keyset_paginate)
+from good_delivery.search import search_deliveries
 
 
 _columns = ['pk', 'create', 'delivery_date', 'delivered_to',
@@ -19,134 +25,118 @@ _columns = ['pk', 'create', 'delivery_date', 'delivered_to',
             'state', 'notes']
 
 
+def filter_deliveries(deliveries, search_key):
+    """
+    datatables search box filter:
+    JSON with "text" and "delivery_point" id
+    """
+    if not search_key: return deliveries
+    params = json.loads(search_key)
+    if not isinstance(params, dict):
+        raise ValueError('search must be a JSON object')
+    text = params.get('text')
+    delivery_point = params.get('delivery_point')
+    if delivery_point and str(delivery_point).isdigit():
+        deliveries = deliveries.filter(Q(choosen_delivery_point__pk=delivery_point) |
+                                       Q(delivery_point__pk=delivery_point))
+    if text:
+        deliveries = search_deliveries(deliveries, text)
+    return deliveries
+
+
 class UsersDeliveryPointDTD(DjangoDatatablesServerProc):
 
     def get_queryset(self):
         """
         Sets DataTable tickets common queryset
         """
-        self.aqs = self.queryset
-        if self.search_key:
-            params = json.loads(self.search_key)
-            text = params['text']
-            delivery_point = params['delivery_point']
-            if delivery_point and delivery_point.isdigit():
-                self.aqs = self.aqs.filter(Q(choosen_delivery_point__pk=delivery_point) |
-                                           Q(delivery_point__pk=delivery_point))
-            if text:
-                self.aqs = self.aqs.filter(
-                    Q(delivered_to__username__icontains=text) | \
-                    Q(delivered_to__first_name__icontains=text) | \
-                    Q(delivered_to__last_name__icontains=text) | \
-                    Q(choosen_delivery_point__name__icontains=text) | \
-                    Q(delivery_point__name__icontains=text) | \
-                    Q(notes__icontains=text))
+        self.aqs = filter_deliveries(self.queryset, self.search_key)
 
-@csrf_exempt
-@login_required
-@campaign_is_active
-@is_delivery_point_operator
-def delivery_point_deliveries(request, campaign_id, delivery_point_id,
-                              campaign, delivery_point, multi_tenant):
-    """
-    :return: JsonResponse
-    """
-    columns = _columns
-    if multi_tenant:
-        deliveries = GoodDelivery.objects.filter(Q(choosen_delivery_point__campaign=campaign) |
-                                                 Q(delivery_point__campaign=campaign))
-    else:
-        deliveries = GoodDelivery.objects.filter(Q(choosen_delivery_point=delivery_point) |
-                                                 Q(delivery_point=delivery_point))
-    dtd = UsersDeliveryPointDTD( request, deliveries, columns )
-    return JsonResponse(dtd.get_dict())
 
-@csrf_exempt
-@login_required
-@campaign_is_active
-@is_delivery_point_operator
-def delivery_point_deliveries_to_define(request, campaign_id, delivery_point_id,
-                                        campaign, delivery_point, multi_tenant):
+def keyset_response(request, deliveries, columns):
     """
-    :return: JsonResponse
+    keyset paginated deliveries (?pagination=keyset&cursor=...):
+    stable (create, pk) ordering, opaque cursor, cached approximate counts
     """
-    columns = _columns
-    if multi_tenant:
-        deliveries = GoodDelivery.objects.filter(Q(choosen_delivery_point__campaign=campaign) |
-                                                 Q(delivery_point__campaign=campaign),
-                                                 delivery_point__isnull=True)
-    else:
-        deliveries = GoodDelivery.objects.filter(Q(choosen_delivery_point=delivery_point) |
-                                                 Q(delivery_point=delivery_point),
-                                                 delivery_point__isnull=True)
-    dtd = UsersDeliveryPointDTD( request, deliveries, columns )
-    return JsonResponse(dtd.get_dict())
+    try:
+        length = int(request.GET.get('length', 10))
+        filtered = filter_deliveries(deliveries, request.GET.get('search'))
+        objects, next_cursor = keyset_paginate(filtered,
+                                               cursor=request.GET.get('cursor'),
+                                               size=length)
+    except (InvalidCursor, ValueError):
+        return JsonResponse({'error': _('Parametri non validi')}, status=400)
+    return JsonResponse({'recordsTotal': get_approximate_count(deliveries),
+                         'recordsFiltered': get_approximate_count(filtered),
+                         'next': next_cursor,
+                         'data': [get_row_data(obj, columns) for obj in objects]})
 
-@csrf_exempt
-@login_required
-@campaign_is_active
-@is_delivery_point_operator
-def delivery_point_deliveries_delivered(request, campaign_id, delivery_point_id,
-                                        campaign, delivery_point, multi_tenant):
-    """
-    :return: JsonResponse
-    """
-    columns = _columns
-    if multi_tenant:
-        deliveries = GoodDelivery.objects.filter(Q(choosen_delivery_point__campaign=campaign) |
-                                                 Q(delivery_point__campaign=campaign),
-                                                 delivery_date__isnull=False,
-                                                 disabled_date__isnull=True)
-    else:
-        deliveries = GoodDelivery.objects.filter(Q(choosen_delivery_point=delivery_point) |
-                                                 Q(delivery_point=delivery_point),
-                                                 delivery_date__isnull=False,
-                                                 disabled_date__isnull=True)
-    dtd = UsersDeliveryPointDTD( request, deliveries, columns )
-    return JsonResponse(dtd.get_dict())
 
-@csrf_exempt
-@login_required
-@campaign_is_active
-@is_delivery_point_operator
-def delivery_point_deliveries_disabled(request, campaign_id, delivery_point_id,
-                                       campaign, delivery_point, multi_tenant):
+def deliveries_response(request, deliveries, columns):
+    if request.GET.get('pagination') == 'keyset':
+        return keyset_response(request, deliveries, columns)
+    try:
+        dtd = UsersDeliveryPointDTD( request, deliveries, columns )
+        return JsonResponse(dtd.get_dict())
+    except ValueError:
+        return JsonResponse({'error': _('Parametri non validi')}, status=400)
+
+# datatables listings filters
+_deliveries_states = {
+    'all': Q(),
+    'to_define': Q(delivery_point__isnull=True),
+    'delivered': Q(delivery_date__isnull=False,
+                   disabled_date__isnull=True),
+    'disabled': Q(disabled_date__isnull=False),
+    'waiting': Q(delivery_date__isnull=True,
+                 disabled_date__isnull=True,
+                 delivery_point__isnull=False),
+}
+
+# only what _columns rows render
+_deliveries_fields = ('create', 'delivery_date', 'disabled_date', 'notes',
+                      'campaign', 'delivered_by',
+                      'delivered_to__username',
+                      'choosen_delivery_point__name',
+                      'choosen_delivery_point__campaign__name',
+                      'delivery_point__name',
+                      'delivery_point__campaign__name')
+
+
+def get_deliveries_queryset(campaign, delivery_point, multi_tenant, state='all'):
     """
-    :return: JsonResponse
+    operator deliveries listing queryset,
+    one query for each page whatever its size
     """
-    columns = _columns
     if multi_tenant:
-        deliveries = GoodDelivery.objects.filter(Q(choosen_delivery_point__campaign=campaign) |
-                                                 Q(delivery_point__campaign=campaign),
-                                                 disabled_date__isnull=False)
+        operator_filter = Q(choosen_delivery_point__campaign=campaign) | \
+                          Q(delivery_point__campaign=campaign)
     else:
-        deliveries = GoodDelivery.objects.filter(Q(choosen_delivery_point=delivery_point) |
-                                                 Q(delivery_point=delivery_point),
-                                                 disabled_date__isnull=False)
-    dtd = UsersDeliveryPointDTD( request, deliveries, columns )
-    return JsonResponse(dtd.get_dict())
+        operator_filter = Q(choosen_delivery_point=delivery_point) | \
+                          Q(delivery_point=delivery_point)
+    return GoodDelivery.objects.with_state()\
+                               .filter(operator_filter, _deliveries_states[state])\
+                               .select_related('delivered_to',
+                                               'choosen_delivery_point__campaign',
+                                               'delivery_point__campaign')\
+                               .only(*_deliveries_fields)
+
 
 @csrf_exempt
 @login_required
 @campaign_is_active
 @is_delivery_point_operator
-def delivery_point_deliveries_waiting(request, campaign_id, delivery_point_id,
-                                      campaign, delivery_point, multi_tenant):
+def delivery_point_deliveries(request, campaign_id, delivery_point_id,
+                              campaign, delivery_point, multi_tenant,
+                              state='all'):
     """
+    :type state: String (all, to_define, delivered, disabled, waiting)
+
     :return: JsonResponse
     """
-    columns = _columns
-    if multi_tenant:
-        deliveries = GoodDelivery.objects.filter(Q(choosen_delivery_point__campaign=campaign) |
-                                                 Q(delivery_point__campaign=campaign),
-                                                 delivery_date__isnull=True,
-                                                 disabled_date__isnull=True,
-                                                 delivery_point__isnull=False)
-    else:
-        deliveries = GoodDelivery.objects.filter(Q(choosen_delivery_point=delivery_point) |
-                                                 Q(delivery_point=delivery_point),
-                                                 delivery_date__isnull=True,
-                                                 disabled_date__isnull=True,
-                                                 delivery_point__isnull=False)
-    dtd = UsersDeliveryPointDTD( request, deliveries, columns )
-    return JsonResponse(dtd.get_dict())
+    if state not in _deliveries_states: raise Http404
+    deliveries = get_deliveries_queryset(campaign=campaign,
+                                         delivery_point=delivery_point,
+                                         multi_tenant=multi_tenant,
+                                         state=state)
+    return deliveries_response(request, deliveries, _columns)
@@ -28,7 +28,8 @@ setup(
         "Development Status :: 5 - Production/Stable",
         "Environment :: Web Environment",
         "Framework :: Django",
-        "Framework :: Django :: 3.0",
+        "Framework :: Django :: 3.1",
+        "Framework :: Django :: 3.2",
         "Intended Audience :: Developers",
         "License :: OSI Approved :: Apache Software License",
         "Operating System :: OS Independent",
@@ -42,7 +43,7 @@ setup(
         "Topic :: Software Development :: Libraries :: Application Frameworks",
         ],
     install_requires=[
-        'django>=3.0,<4.0',
+        'django>=3.1,<4.0',
         'django_ckeditor>=6.0.0',
         'django-datatables-ajax>=0.8',
         'libsass>=0.20.1',
@@ -51,6 +52,9 @@ setup(
         'django-unical-bootstrap-italia>=1.0.2',
         'cryptojwt>=1.3.0'
     ],
+    extras_require={
+        'xlsx': ['openpyxl>=3.0'],
+    },
     tests_require=[
         'pytest-django>=3.9.0',
     ]